@@ -0,0 +1,185 @@
+"""\
+Bulk imports
+------------
+
+Load history (for example, months of sar data) much faster than sending it
+through :meth:`Records.extend <tsar.model.Records.extend>` chunk by chunk.
+The rows are sorted by series and time with an external merge sort, so at
+most :data:`runsize` rows are held in memory at once, and each series is then
+consolidated in a single pass and committed with :meth:`Records.bulk
+<tsar.model.Records.bulk>`, which takes one lock pipeline, one MGET and one
+transaction for a whole batch of series.
+
+Rows are read from CSV files (in the `subject,attribute,cf,timestamp,value`
+format accepted by the web service) or from binary files holding a frame
+for each series (see :func:`writebinary`):
+
+    >>> from StringIO import StringIO
+    >>> stream = StringIO()
+    >>> writebinary(stream, ("foo", "bar", "ave"), [(60, 1.0), (120, 2.5)])
+    >>> rows = readbinary(StringIO(stream.getvalue()))
+    >>> [(key, data) for key, data in groups(sort(rows))]
+    [(('foo', 'bar', 'ave'), [(60, '1.0'), (120, '2.5')])]
+"""
+
+import csv
+import heapq
+import struct
+import tempfile
+
+from itertools import groupby
+from operator import itemgetter
+
+from . import engines, errors, gorilla, model
+
+__all__ = ["groups", "load", "owner", "readbinary", "readcsv", "sort",
+    "writebinary"]
+
+header = ["subject", "attribute", "cf", "timestamp", "value"]
+"""Optional first row of CSV files."""
+runsize = 500000
+"""Number of rows sorted in memory before they're spilled to a temporary file."""
+batchsize = 100000
+"""Number of points committed by each call to :meth:`Records.bulk`."""
+frame = struct.Struct("<HI")
+"""Header of each frame in a binary file: the lengths of the key and the data."""
+
+def readcsv(stream):
+    """Yield (subject, attribute, cf, timestamp, value) rows from a CSV *stream*.
+
+    Empty rows and :data:`header` rows are skipped. Raises
+    :class:`errors.RecordError` if a row doesn't have five fields.
+    """
+    for row in csv.reader(stream):
+        if not row or row == header:
+            continue
+        if len(row) != len(header):
+            raise errors.RecordError("Wrong number of fields in CSV: %r" %
+                ','.join(row))
+        yield tuple(row)
+
+def writebinary(stream, key, data):
+    """Write a frame holding the (timestamp, value) *data* of series *key*.
+
+    *key* is a (subject, attribute, cf) tuple. The points are compressed with
+    :func:`tsar.gorilla.encode`, so the values are stored as doubles.
+    """
+    key = ' '.join(key)
+    data = gorilla.encode(data)
+    stream.write(frame.pack(len(key), len(data)))
+    stream.write(key)
+    stream.write(data)
+
+def readbinary(stream):
+    """Yield (subject, attribute, cf, timestamp, value) rows from a binary *stream*.
+
+    Raises :class:`errors.RecordError` if the stream ends in the middle of a
+    frame.
+    """
+    while True:
+        head = stream.read(frame.size)
+        if not head:
+            break
+        if len(head) < frame.size:
+            raise errors.RecordError("Truncated frame header")
+        keylen, datalen = frame.unpack(head)
+        key, data = stream.read(keylen), stream.read(datalen)
+        if len(key) < keylen or len(data) < datalen:
+            raise errors.RecordError("Truncated frame")
+        subject, attribute, cf = key.split(' ')
+        for timestamp, value in gorilla.decode(data):
+            yield (subject, attribute, cf, timestamp, engines.encode(value))
+
+def owner(key, workers):
+    """Return the worker (of *workers*) that imports the series *key*."""
+    return engines.Shards.hash(' '.join(key)) % workers
+
+def spill(rows, tmpdir=None):
+    """Write sorted *rows* to a temporary file and return it (rewound)."""
+    spilled = tempfile.TemporaryFile(dir=tmpdir)
+    csv.writer(spilled).writerows(rows)
+    spilled.seek(0)
+    return spilled
+
+def unspill(spilled):
+    """Yield the rows written by :func:`spill`."""
+    for subject, attribute, cf, timestamp, seq, value in csv.reader(spilled):
+        yield (subject, attribute, cf, int(timestamp), int(seq), value)
+    spilled.close()
+
+def sort(rows, size=None, tmpdir=None):
+    """Sort *rows* by series and time stamp, holding at most *size* in memory.
+
+    *size* defaults to :data:`runsize`; runs of that many rows are sorted and
+    spilled to temporary files in *tmpdir*, and the runs are then merged.
+    Rows with equal time stamps keep their order. Yields (subject,
+    attribute, cf, timestamp, value) rows with integer time stamps. Raises
+    :class:`errors.RecordError` if a time stamp is invalid.
+    """
+    if size is None:
+        size = runsize
+    types = model.Types()
+    runs, run = [], []
+    for seq, (subject, attribute, cf, timestamp, value) in enumerate(rows):
+        try:
+            timestamp = types.Time(timestamp)
+        except (TypeError, ValueError):
+            raise errors.RecordError("Invalid time stamp: %r" % (timestamp,))
+        run.append((subject, attribute, cf, timestamp, seq, value))
+        if len(run) >= size:
+            run.sort()
+            runs.append(spill(run, tmpdir))
+            run = []
+    run.sort()
+
+    merged = heapq.merge(run, *[unspill(r) for r in runs])
+    for subject, attribute, cf, timestamp, seq, value in merged:
+        yield (subject, attribute, cf, timestamp, value)
+
+def groups(rows):
+    """Group sorted *rows* by series.
+
+    Yields ((subject, attribute, cf), data) two-tuples, where *data* is a list
+    of (timestamp, value) two-tuples.
+    """
+    for key, group in groupby(rows, itemgetter(0, 1, 2)):
+        yield key, [(timestamp, value) for s, a, c, timestamp, value in group]
+
+def load(series, size=None):
+    """Record every ((subject, attribute, cf), data) two-tuple in *series*.
+
+    The series are committed with :meth:`Records.bulk
+    <tsar.model.Records.bulk>` in batches of about *size* points (default:
+    :data:`batchsize`); each series is recorded in one piece. Returns the
+    number of series and points recorded and a list of ((subject, attribute,
+    cf), exception) two-tuples describing the rejected series.
+    """
+    if size is None:
+        size = batchsize
+    totals = [0, 0]
+    rejected, batch = [], []
+
+    def commit(batch):
+        failed = dict((id(r), e) for r, e in model.Records.bulk(batch))
+        for records, data in batch:
+            if id(records) in failed:
+                rejected.append(((records.subject, records.attribute,
+                    records.cf), failed[id(records)]))
+            else:
+                totals[0] += 1
+                totals[1] += len(data)
+
+    points = 0
+    for key, data in series:
+        try:
+            batch.append((model.series(*key), data))
+        except (TypeError, ValueError, errors.RecordError), e:
+            rejected.append((key, e))
+            continue
+        points += len(data)
+        if points >= size:
+            commit(batch)
+            batch, points = [], 0
+    if batch:
+        commit(batch)
+    return totals[0], totals[1], rejected
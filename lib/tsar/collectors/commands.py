@@ -12,6 +12,7 @@ from cli.app import Abort
 from tsar import errors
 from tsar.commands import ClientMixin, Command, SubCommand
 from tsar.collectors.helpers import insert, median, replace
+from tsar.sketch import Sketch
 
 class Collect(ClientMixin, Command):
     collectors = {}
@@ -34,7 +35,8 @@ class Collect(ClientMixin, Command):
         self.add_param("-n", "--dryrun", default=False, action="store_true",
             help="print collected data instead of submitting it (default: submit)")
         self.add_param("-g", "--groups", nargs="*", 
-            help="list of aggregate groups to report to (default: none)")
+            help="list of aggregate groups to report to; queries can aggregate "
+                "series instead (see aggregate=) (default: none)")
         self.add_param("-s", "--subject", default=None,
             help="force record subject with SUBJECT")
 
@@ -108,22 +110,37 @@ class Collector(SubCommand):
         "max": max,
         "ave": median,
     }
+    samplecfs = {
+        "sketch": Sketch.of,
+    }
+    """Consolidation functions only used for lists of samples.
+
+    A quantile sketch keeps the shape of the samples' distribution, which
+    the :attr:`cfs` reduce to a single value.
+    """
 
     def pre_run(self):
         SubCommand.pre_run(self)
         self.client = self.parent.client
 
     def prepare(self, data, cfs=None):
+        reducers = cfs
         if cfs is None:
-            cfs = self.cfs
-
-        expand = lambda r: (insert(r, 2, cf) for cf in cfs)
+            cfs, reducers = self.cfs, dict(self.cfs, **self.samplecfs)
+
+        # Numbers are the same for every cf, so send them once to the group of
+        # cfs (see tsar.model.Group); samples are reduced for each cf here.
+        group = '+'.join(sorted(cfs))
+        def expand(r):
+            if isinstance(r[3], (int, float)):
+                return [insert(r, 2, group)]
+            return (insert(r, 2, cf) for cf in reducers)
         records = chain(*[len(r) == 5 and (r,) or expand(list(r)) for r in data])
 
         for record in records:
             value = record[4]
             if not isinstance(value, (int, float)):
-                record[4] = cfs[record[2]](value)
+                record[4] = reducers[record[2]](value)
 
             yield record
 
@@ -172,11 +172,35 @@ class Proc(DaemonizingMixin, Collector):
         "slabinfo": s_slabinfo,
         "swap_": s_swap,
     }
+    counters = ("net_", "disk_", "stat_cpu")
+    """Prefixes of the attributes that are monotonic counters.
+
+    Counters are also recorded with the "rate" cf, so their rates don't have
+    to be derived when they're read.
+    """
+    gauges = ("_major", "_minor", "_currentios")
+    """Suffixes of the attributes that aren't counters, despite their prefix."""
+    rates = {
+        "rate": sum,
+    }
 
     def __init__(self, main=None, **kwargs):
         Collector.__init__(self, main, **kwargs)
         DaemonizingMixin.__init__(self, **kwargs)
 
+    def iscounter(self, attribute):
+        return attribute.startswith(self.counters) and \
+            not attribute.endswith(self.gauges)
+
+    def prepare(self, data, cfs=None):
+        data = list(data)
+        for record in Collector.prepare(self, data, cfs=cfs):
+            yield record
+        if cfs is None:
+            counters = [r for r in data if len(r) == 4 and self.iscounter(r[1])]
+            for record in Collector.prepare(self, counters, cfs=self.rates):
+                yield record
+
     def open(self, fname):
         fd = self.fds.get(fname, None)
         if fd is None:
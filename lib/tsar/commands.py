@@ -4,7 +4,7 @@ from cli.daemon import DaemonizingMixin
 
 from . import model
 from .client import Tsar
-from .util import parsedsn
+from .util import parsedsn, parseschema
 
 class Command(LoggingApp):
 
@@ -61,16 +61,84 @@ class DBMixin(object):
         default_dsn = "redis://localhost:6379/0"
         self.add_param("-D", "--dsn", default=default_dsn,
             help="Database connection: "
-                "'<driver>://<username>:<password>@<host>:<port>/<database>' " 
-                "(default: %s)" % default_dsn)
-            
+                "'<driver>://<username>:<password>@<host>:<port>/<database>', "
+                "where driver is one of %s; separate several DSNs with commas "
+                "to shard the records across them, and follow a DSN with "
+                "'|<replica DSN>' to read from its replicas " 
+                "(default: %s)" % (", ".join(sorted(model.engines.drivers)),
+                    default_dsn))
+        default_writer = model.Records.writer
+        self.add_param("-W", "--writer", default=default_writer,
+            choices=model.Records.writers,
+            help="write path for new records (default: %s)" % default_writer)
+        default_layout = model.Records.layout
+        self.add_param("-L", "--layout", default=None,
+            choices=model.Records.layouts,
+            help="storage layout for records (default: %s, or the "
+                "storage engine's preferred layout)" % default_layout)
+        self.add_param("-R", "--retention", default=[], action="append",
+            help="retention schema for the matching series, as "
+                "'<pattern>=<interval>:<samples>,...'; may be repeated, and "
+                "the first matching schema wins (default: %s)" % ",".join(
+                    "%d:%d" % i for i in model.Records.intervals))
+        self.add_param("--lateness", default=model.Records.lateness, type=int,
+            help="seconds a value may arrive out of order and still be "
+                "merged into its bins (lock writer only); later values are "
+                "dropped and counted (default: %d, drop values no newer than "
+                "the last bins)" %
+                model.Records.lateness)
+        self.add_param("--pool-size", default=None, type=int,
+            help="maximum number of connections to each Redis server "
+                "(default: unlimited)")
+        self.add_param("--pool-timeout", default=None, type=float,
+            help="seconds to wait for a free connection when the pool is "
+                "full (default: wait forever)")
+        self.add_param("--socket-timeout", default=None, type=float,
+            help="timeout (seconds) for Redis commands (default: none)")
+        self.add_param("--keepalive", default=False, action="store_true",
+            help="enable TCP keepalive on Redis connections")
+
     def pre_run(self):
-        dsn = parsedsn(self.params.dsn)
-        del(dsn["username"])
-        del(dsn["driver"])
-        dsn["db"] = dsn.pop("database")
-        model.db = model.connect(**dsn)
+        for dsn in self.params.dsn.split(","):
+            driver = parsedsn(dsn.strip())["driver"]
+            if driver not in model.engines.drivers:
+                self.argparser.error("unknown storage engine: %s" % driver)
+        model.db = model.connectdsn(self.params.dsn, **self.pooloptions())
         self.db = model.db
+        layout = self.params.layout or getattr(model.engines.each(model.db)[0],
+            "layout", model.Records.layout)
+        if self.params.writer == "script":
+            primaries = [d.split("|")[0] for d in self.params.dsn.split(",")
+                if d.strip()]
+            unsupported = [dsn for dsn, db in
+                zip(primaries, model.engines.each(model.db))
+                if not hasattr(db, "register_script")]
+            if layout != "list":
+                self.argparser.error("the script writer requires the list layout")
+            elif unsupported:
+                self.argparser.error("the %s engine doesn't support the script "
+                    "writer" % parsedsn(unsupported[0].strip())["driver"])
+            elif self.params.lateness:
+                self.argparser.error("the script writer doesn't support a "
+                    "lateness window")
+        if self.params.lateness < 0:
+            self.argparser.error("the lateness must not be negative")
+        model.Records.writer = self.params.writer
+        model.Records.layout = layout
+        model.Records.lateness = self.params.lateness
+        try:
+            model.Records.schemas = [parseschema(s)
+                for s in self.params.retention]
+        except ValueError, e:
+            self.argparser.error("invalid retention schema: %s" % e.args[0])
+
+    def pooloptions(self):
+        """Return the connection pool options for :func:`model.connectdsn`."""
+        return dict(
+            pool_size=self.params.pool_size,
+            pool_timeout=self.params.pool_timeout,
+            socket_timeout=self.params.socket_timeout,
+            socket_keepalive=self.params.keepalive)
 
 class ClientMixin(object):
     
@@ -0,0 +1,1003 @@
+"""\
+Storage engines
+---------------
+
+:class:`tsar.model.Records` stores its data through an engine, a client
+providing the subset of the Redis command set used by the model (strings,
+lists, sets, sorted sets and pipelines). Engines are selected by the scheme
+of a DSN; see :data:`drivers`.
+"""
+
+from __future__ import with_statement
+
+import cPickle as pickle
+import errno
+import mmap
+import os
+import sys
+import threading
+import time
+
+from array import array
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
+from fnmatch import fnmatchcase
+from functools import wraps
+from urllib import quote, unquote
+
+from . import errors
+
+__all__ = ["File", "Memory", "Pool", "Redis", "Replicated", "Shards", "drivers",
+    "each", "parallel", "pools"]
+
+def Redis(host=None, port=None, db=None, password=None, pool_size=None,
+        pool_timeout=None, socket_timeout=None, socket_keepalive=False):
+    """Return a client for a Redis server.
+
+    The client's connections are kept in a :class:`Pool`. If *pool_size* is
+    not None, the pool holds at most that many connections, and threads
+    wait up to *pool_timeout* seconds for one to be released.
+    """
+    import redis
+    kwargs = dict(host=host or "localhost", port=port or 6379, db=db or 0,
+        password=password, socket_timeout=socket_timeout,
+        socket_keepalive=socket_keepalive)
+    if pool_size is None:
+        pool = redis.ConnectionPool(**kwargs)
+    else:
+        pool = redis.BlockingConnectionPool(max_connections=pool_size,
+            timeout=pool_timeout, **kwargs)
+    return redis.Redis(connection_pool=Pool(pool, pool_size))
+
+class Pool(object):
+    """Measure the use of a redis-py connection *pool* of *size* connections.
+
+    Counts the connections checked out of the pool and the time spent
+    waiting for them. When a blocking pool runs out of connections,
+    :exc:`errors.PoolError` is raised (and counted) instead.
+    """
+
+    def __init__(self, pool, size=None):
+        self.pool = pool
+        self.size = size
+        self.mutex = threading.Lock()
+        self.checkouts = 0
+        self.inuse = 0
+        self.wait = 0.0
+        self.maxwait = 0.0
+        self.exhausted = 0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.time()
+        try:
+            connection = self.pool.get_connection(*args, **kwargs)
+        except Exception:
+            if self.size is None:
+                raise
+            with self.mutex:
+                self.exhausted += 1
+            raise errors.PoolError("No connection available after %ss "
+                "(pool size: %d)" % (self.pool.timeout, self.size))
+        wait = time.time() - start
+        with self.mutex:
+            self.checkouts += 1
+            self.inuse += 1
+            self.wait += wait
+            self.maxwait = max(self.maxwait, wait)
+        return connection
+
+    def release(self, connection):
+        self.pool.release(connection)
+        with self.mutex:
+            self.inuse -= 1
+
+    def metrics(self):
+        """Return a dictionary describing the use of the pool."""
+        with self.mutex:
+            return {
+                "size": self.size,
+                "inuse": self.inuse,
+                "checkouts": self.checkouts,
+                "wait": self.wait,
+                "maxwait": self.maxwait,
+                "exhausted": self.exhausted,
+            }
+
+def pools(db):
+    """Return the :class:`Pool` of each Redis client behind *db*."""
+    result = []
+    for engine in each(db):
+        clients = [getattr(engine, "primary", engine)]
+        clients.extend(getattr(engine, "replicas", []))
+        for client in clients:
+            pool = getattr(client, "connection_pool", None)
+            if isinstance(pool, Pool):
+                result.append(pool)
+    return result
+
+def atomic(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.mutex:
+            self.depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.depth -= 1
+                if not self.depth:
+                    self.flush()
+    return wrapper
+
+def encode(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def parallel(func, items):
+    """Call *func* with each of *items* in its own thread.
+
+    Returns the results, in order. If any of the calls raised an exception,
+    the first is raised again.
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    failures = []
+    def run(i, item):
+        try:
+            results[i] = func(item)
+        except Exception:
+            failures.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(i, item)) \
+        for i, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return results
+
+def each(db):
+    """Return a list of the engines behind *db*."""
+    if isinstance(db, Shards):
+        return list(db.engines)
+    return [db]
+
+def scan(engine, name, count=None):
+    """Yield the members of set *name* in *engine*.
+
+    Redis is scanned incrementally with SSCAN (about *count* members at a
+    time), so large sets never block the server. Engines without SSCAN
+    return a snapshot of the set instead.
+    """
+    sscan_iter = getattr(engine, "sscan_iter", None)
+    if sscan_iter is None:
+        members = engine.smembers(name)
+    else:
+        members = sscan_iter(name, count=count)
+    for member in members:
+        yield member
+
+def lexscan(engine, name, prefix="", count=100):
+    """Yield the members of sorted set *name* in *engine* starting with *prefix*.
+
+    Every member should have the same score. The members are read in
+    lexicographic order with ZRANGEBYLEX, *count* at a time.
+    """
+    start, stop = "-", "+"
+    if prefix:
+        start, stop = "[" + prefix, "[" + prefix + "\xff"
+    while True:
+        page = engine.zrangebylex(name, start, stop, 0, count)
+        for member in page:
+            yield member
+        if len(page) < count:
+            break
+        start = "(" + page[-1]
+
+def span(start, end, length):
+    """Convert an inclusive Redis range to slice indices."""
+    if start < 0:
+        start = max(0, start + length)
+    if end < 0:
+        end += length
+    return start, max(start, min(end, length - 1) + 1)
+
+class Memory(object):
+    """An engine storing data in this process.
+
+    Each command is atomic, as are pipelines, so single-process deployments
+    (and benchmarks) can run the model without a Redis server. Strings
+    written with SETRANGE in steps of whole doubles (like the "packed"
+    :attr:`tsar.model.Records.layout`) are kept in :class:`array.array`
+    ring buffers and updated in place. The engine only sees byte offsets,
+    not retention schemas, so a ring grows as its bins are first written
+    and stops growing once it wraps. Every command (and pipeline) holds the
+    engine's :attr:`mutex`, which is what keeps pipelines atomic when
+    threads share the engine. Lua scripts are not supported.
+    """
+    width = array('d').itemsize
+    layout = "packed"
+    """Preferred :attr:`tsar.model.Records.layout`."""
+    buffers = (array,)
+    """Types of the buffers returned by :meth:`allocate`."""
+
+    def __init__(self, **kwargs):
+        # Connection parameters (host, port and so on) mean nothing here.
+        self.data = {}
+        self.mutex = threading.RLock()
+        self.depth = 0
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    @atomic
+    def run(self, commands):
+        results = []
+        for method, args, kwargs in commands:
+            try:
+                results.append(method(*args, **kwargs))
+            except Exception, e:
+                results.append(e)
+        return results
+
+    def allocate(self, name):
+        """Return a new, empty buffer of doubles for key *name*."""
+        return array('d')
+
+    def slice(self, buffer, start=0, stop=None):
+        """Return doubles *start* to *stop* of *buffer* as a string."""
+        return buffer[start:stop].tostring()
+
+    def touch(self, *names):
+        """Note that keys *names* were changed by the current command."""
+
+    def amend(self, name, added=(), removed=()):
+        """Note that members were *added* to or *removed* from set *name*."""
+        self.touch(name)
+
+    def flush(self):
+        """Called when a command (or pipeline) finishes."""
+
+    def lookup(self, name, type=None):
+        value = self.data.get(name)
+        if value is None:
+            return None
+        elif type is not None and not isinstance(value, type):
+            raise TypeError("Operation against a key holding the wrong kind of value")
+        return value
+
+    def string(self, name):
+        value = self.lookup(name, (str,) + self.buffers)
+        if isinstance(value, self.buffers):
+            value = self.slice(value)
+        return value
+
+    # Keys.
+    @atomic
+    def delete(self, *names):
+        self.touch(*names)
+        return len([self.data.pop(n) for n in names if n in self.data])
+
+    @atomic
+    def exists(self, name):
+        return name in self.data
+
+    @atomic
+    def flushdb(self):
+        self.touch(*self.data)
+        self.data.clear()
+        return True
+
+    @atomic
+    def keys(self, pattern="*"):
+        return [k for k in self.data if fnmatchcase(k, pattern)]
+
+    @atomic
+    def renamenx(self, src, dst):
+        if src not in self.data:
+            raise KeyError("no such key")
+        if dst in self.data:
+            return False
+        self.data[dst] = self.data.pop(src)
+        self.touch(src, dst)
+        return True
+
+    @atomic
+    def dump(self, name):
+        value = self.data.get(name)
+        if value is None:
+            return None
+        elif isinstance(value, self.buffers):
+            value = (array, self.slice(value))
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    @atomic
+    def restore(self, name, ttl, value):
+        if name in self.data:
+            raise KeyError("target key name is busy")
+        value = pickle.loads(value)
+        if isinstance(value, tuple):
+            buffer = self.allocate(name)
+            buffer.extend(array('d', value[1]))
+            value = buffer
+        self.data[name] = value
+        self.touch(name)
+        return True
+
+    @atomic
+    def type(self, name):
+        value = self.data.get(name)
+        for kind, typename in ((str, "string"), (self.buffers, "string"),
+                (list, "list"), (set, "set"), (dict, "zset")):
+            if isinstance(value, kind):
+                return typename
+        return "none"
+
+    # Strings.
+    @atomic
+    def get(self, name):
+        return self.string(name)
+
+    @atomic
+    def mget(self, *names):
+        if len(names) == 1 and not isinstance(names[0], basestring):
+            names = names[0]
+        return [self.string(n) for n in names]
+
+    @atomic
+    def set(self, name, value):
+        self.data[name] = encode(value)
+        self.touch(name)
+        return True
+
+    @atomic
+    def mset(self, mapping):
+        for name, value in mapping.items():
+            self.data[name] = encode(value)
+        self.touch(*mapping)
+        return True
+
+    @atomic
+    def setnx(self, name, value):
+        if name in self.data:
+            return False
+        self.data[name] = encode(value)
+        self.touch(name)
+        return True
+
+    @atomic
+    def getset(self, name, value):
+        old = self.string(name)
+        self.data[name] = encode(value)
+        self.touch(name)
+        return old
+
+    @atomic
+    def incr(self, name, amount=1):
+        value = int(self.string(name) or 0) + amount
+        self.data[name] = encode(value)
+        self.touch(name)
+        return value
+
+    @atomic
+    def strlen(self, name):
+        return len(self.string(name) or "")
+
+    @atomic
+    def getrange(self, name, start, end):
+        value = self.lookup(name, (str,) + self.buffers) or ""
+        if isinstance(value, self.buffers):
+            if start >= 0 and not start % self.width \
+                    and end >= 0 and not (end + 1) % self.width:
+                return self.slice(value, start/self.width, (end + 1)/self.width)
+            value = self.slice(value)
+        start, end = span(start, end, len(value))
+        return value[start:end]
+
+    @atomic
+    def setrange(self, name, offset, value):
+        value = encode(value)
+        aligned = not (offset % self.width or len(value) % self.width)
+        current = self.lookup(name, (str,) + self.buffers) or ""
+        if isinstance(current, self.buffers) and not aligned:
+            current = self.slice(current)
+        if isinstance(current, str):
+            if not aligned or len(current) % self.width:
+                return self.setstring(name, current, offset, value)
+            buffer = self.allocate(name)
+            if current:
+                buffer.extend(array('d', current))
+            current = buffer
+
+        # Grow the buffer (with zeros, like Redis) and write in place.
+        start = offset/self.width
+        stop = start + (len(value)/self.width)
+        if len(current) < stop:
+            current.extend([0.0] * (stop - len(current)))
+        current[start:stop] = array('d', value)
+        self.data[name] = current
+        self.touch(name)
+        return len(current) * self.width
+
+    def setstring(self, name, current, offset, value):
+        current = current.ljust(offset, "\0")
+        self.data[name] = current[:offset] + value + current[offset + len(value):]
+        self.touch(name)
+        return len(self.data[name])
+
+    # Lists.
+    @atomic
+    def llen(self, name):
+        return len(self.lookup(name, list) or [])
+
+    @atomic
+    def lpush(self, name, *values):
+        current = self.data.setdefault(name, [])
+        current[:0] = [encode(v) for v in reversed(values)]
+        self.touch(name)
+        return len(current)
+
+    @atomic
+    def rpush(self, name, *values):
+        current = self.data.setdefault(name, [])
+        current.extend(encode(v) for v in values)
+        self.touch(name)
+        return len(current)
+
+    @atomic
+    def lindex(self, name, index):
+        current = self.lookup(name, list) or []
+        try:
+            return current[index]
+        except IndexError:
+            return None
+
+    @atomic
+    def lset(self, name, index, value):
+        current = self.lookup(name, list) or []
+        try:
+            current[index] = encode(value)
+        except IndexError:
+            raise errors.Error("index out of range")
+        self.touch(name)
+        return True
+
+    @atomic
+    def lpop(self, name):
+        current = self.lookup(name, list)
+        if not current:
+            return None
+        value = current.pop(0)
+        if not current:
+            del(self.data[name])
+        self.touch(name)
+        return value
+
+    @atomic
+    def lrange(self, name, start, end):
+        current = self.lookup(name, list) or []
+        start, end = span(start, end, len(current))
+        return current[start:end]
+
+    @atomic
+    def ltrim(self, name, start, end):
+        current = self.lookup(name, list)
+        if current is not None:
+            start, end = span(start, end, len(current))
+            if end - start == len(current):
+                return True
+            current[:] = current[start:end]
+            if not current:
+                del(self.data[name])
+            self.touch(name)
+        return True
+
+    # Sets.
+    @atomic
+    def sadd(self, name, *values):
+        current = self.lookup(name, set)
+        new = set(encode(v) for v in values)
+        if current is None:
+            self.data[name] = new
+            self.touch(name)
+            return len(new)
+        new -= current
+        if new:
+            current.update(new)
+            self.amend(name, added=new)
+        return len(new)
+
+    @atomic
+    def srem(self, name, *values):
+        current = self.lookup(name, set) or set()
+        old = set(encode(v) for v in values) & current
+        if not old:
+            return 0
+        current.difference_update(old)
+        if not current:
+            del(self.data[name])
+            self.touch(name)
+        else:
+            self.amend(name, removed=old)
+        return len(old)
+
+    @atomic
+    def smembers(self, name):
+        return set(self.lookup(name, set) or ())
+
+    @atomic
+    def scard(self, name):
+        return len(self.lookup(name, set) or ())
+
+    @atomic
+    def sinter(self, *names):
+        sets = [self.lookup(n, set) or set() for n in names]
+        return set.intersection(*sets)
+
+    @atomic
+    def spop(self, name):
+        current = self.lookup(name, set)
+        if not current:
+            return None
+        value = current.pop()
+        if not current:
+            del(self.data[name])
+        self.touch(name)
+        return value
+
+    # Sorted sets.
+    @atomic
+    def zadd(self, name, *args):
+        """Add members to a sorted set: ``zadd(name, member, score, ...)``."""
+        current = self.data.setdefault(name, {})
+        new = changed = 0
+        for member, score in zip(args[::2], args[1::2]):
+            member, score = encode(member), float(score)
+            new += member not in current
+            changed += current.get(member) != score
+            current[member] = score
+        if changed:
+            self.touch(name)
+        return new
+
+    @atomic
+    def zrem(self, name, *values):
+        current = self.lookup(name, dict) or {}
+        old = [v for v in (encode(v) for v in values) if v in current]
+        for member in old:
+            del(current[member])
+        if not current:
+            self.data.pop(name, None)
+        if old:
+            self.touch(name)
+        return len(old)
+
+    @atomic
+    def zcard(self, name):
+        return len(self.lookup(name, dict) or {})
+
+    @atomic
+    def zrangebyscore(self, name, min, max):
+        current = self.lookup(name, dict) or {}
+        min, max = float(min), float(max)
+        members = sorted((s, m) for m, s in current.items() if min <= s <= max)
+        return [m for s, m in members]
+
+    @atomic
+    def zrangebylex(self, name, min, max, start=None, num=None):
+        def bound(value, low):
+            if value in ("-", "+"):
+                return lambda m: (value == "-") == low
+            inclusive, edge = value[0] == "[", value[1:]
+            if low:
+                return lambda m: m > edge or (inclusive and m == edge)
+            return lambda m: m < edge or (inclusive and m == edge)
+        above, below = bound(min, True), bound(max, False)
+        members = sorted(m for m in self.lookup(name, dict) or {}
+            if above(m) and below(m))
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    @atomic
+    def zremrangebyscore(self, name, min, max):
+        current = self.lookup(name, dict) or {}
+        min, max = float(min), float(max)
+        old = [m for m, s in current.items() if min <= s <= max]
+        for member in old:
+            del(current[member])
+        if not current:
+            self.data.pop(name, None)
+        if old:
+            self.touch(name)
+        return len(old)
+
+class Pipeline(object):
+    """Queue commands for a :class:`Memory` engine.
+
+    Queued commands are run together, atomically, by :meth:`execute`. Like
+    Redis' WATCH, :meth:`watch` makes the following commands run at once,
+    until :meth:`multi` starts queueing them again. The engine stays locked
+    from :meth:`watch` until the commands are executed (or the pipeline is
+    :meth:`reset`), so nothing else can change the watched keys and the
+    transaction always goes through.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.commands = []
+        self.watching = False
+        self.queueing = True
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+        if not self.queueing:
+            return method
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def watch(self, *names):
+        if not self.watching:
+            self.engine.mutex.acquire()
+            self.watching = True
+        self.queueing = False
+        return True
+
+    def multi(self):
+        self.queueing = True
+
+    def reset(self):
+        self.commands = []
+        self.queueing = True
+        if self.watching:
+            self.watching = False
+            self.engine.mutex.release()
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        try:
+            results = self.engine.run(commands)
+        finally:
+            self.reset()
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+class Ring(object):
+    """A buffer of doubles in a memory-mapped file.
+
+    The file is mapped when it's first used. The rings of an engine share
+    the *mapped* dictionary (used under the engine's lock), and at most
+    :attr:`maxmaps` of them are mapped at once; the least recently mapped
+    are closed first.
+    """
+    itemsize = Memory.width
+    maxmaps = 512
+    """Maximum number of files mapped at once by each engine."""
+
+    def __init__(self, path, mapped):
+        self.path = path
+        self.mapped = mapped
+        self.map = None
+
+    def open(self):
+        if self.map is not None:
+            return self.map
+        elif not os.path.exists(self.path):
+            return None
+
+        with open(self.path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        self.mapped[self] = True
+        while len(self.mapped) > self.maxmaps:
+            self.mapped.popitem(last=False)[0].close()
+        return self.map
+
+    def close(self):
+        self.mapped.pop(self, None)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def __len__(self):
+        map = self.open()
+        return map is not None and len(map)/self.itemsize or 0
+
+    def read(self, start=0, stop=None):
+        map = self.open()
+        if map is None:
+            return ""
+        if stop is None:
+            stop = len(map)/self.itemsize
+        return map[start * self.itemsize:stop * self.itemsize]
+
+    def extend(self, values):
+        data = array('d', values).tostring()
+        map = self.open()
+        if map is None:
+            makedirs(os.path.dirname(self.path))
+            with open(self.path, "wb") as f:
+                f.write(data)
+        else:
+            size = len(map)
+            map.resize(size + len(data))
+            map[size:] = data
+
+    def __setitem__(self, index, values):
+        map = self.open()
+        map[index.start * self.itemsize:index.stop * self.itemsize] = \
+            values.tostring()
+
+    def move(self, path):
+        self.close()
+        makedirs(os.path.dirname(path))
+        os.rename(self.path, path)
+        self.path = path
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class File(Memory):
+    """An engine storing data in a directory.
+
+    Keys are split on :attr:`delim` into a tree of files below the
+    directory. Buffers of doubles (like the intervals of the "packed"
+    :attr:`tsar.model.Records.layout`) are kept in :class:`Ring` files,
+    which are memory-mapped and updated in place, so reads and writes only
+    touch the bins involved. Sets (the namespace set and its indexes) are
+    kept in journals: members added or removed are appended to the set's
+    file, which is only rewritten (compacted) once it holds more than
+    :attr:`maxjournal` changes. Other values are small (`!last` and
+    `!origin` keys); they're written (atomically, by renaming) after each
+    command or pipeline that changes them. Everything but the rings is
+    loaded into memory when the engine starts.
+
+    Only one process should use a directory at a time.
+    """
+    delim = "!"
+    """Key delimiter."""
+    buffers = (Ring,)
+    suffixes = (".ring", ".pickle", ".set")
+    maxjournal = 1000
+    """Number of changes appended to a set's journal before it's compacted."""
+
+    def __init__(self, host=None, db=None, **kwargs):
+        super(File, self).__init__()
+        self.root = os.path.join(host or "/", db or "")
+        self.dirty = set()
+        self.journal = {}
+        self.journaled = {}
+        self.mapped = OrderedDict()
+        makedirs(self.root)
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                base, suffix = os.path.splitext(path)
+                if suffix == ".ring":
+                    self.data[self.key(base)] = Ring(path, self.mapped)
+                elif suffix == ".pickle":
+                    with open(path, "rb") as f:
+                        self.data[self.key(base)] = pickle.load(f)
+                elif suffix == ".set":
+                    self.data[self.key(base)] = self.replay(base)
+
+    def replay(self, path):
+        """Return the set stored in the journal at *path* (without suffix)."""
+        members, changes = set(), 0
+        with open(path + ".set", "rb") as f:
+            while True:
+                try:
+                    added, removed = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError):
+                    # A change cut short by a crash is lost.
+                    break
+                members.update(added)
+                members.difference_update(removed)
+                changes += 1
+        self.journaled[self.key(path)] = changes
+        return members
+
+    def path(self, name):
+        """Return the path (without suffix) for key *name*."""
+        chunks = [quote(c, safe="").replace(".", "%2E") or "%00" \
+            for c in name.split(self.delim)]
+        return os.path.join(self.root, *chunks)
+
+    def key(self, path):
+        """Return the key stored at *path* (without suffix)."""
+        chunks = os.path.relpath(path, self.root).split(os.sep)
+        return self.delim.join(c != "%00" and unquote(c) or "" for c in chunks)
+
+    def allocate(self, name):
+        return Ring(self.path(name) + ".ring", self.mapped)
+
+    def slice(self, buffer, start=0, stop=None):
+        return buffer.read(start, stop)
+
+    def touch(self, *names):
+        self.dirty.update(names)
+
+    def amend(self, name, added=(), removed=()):
+        if name in self.dirty:
+            return
+        # Sets without a journal yet (like those written by older versions)
+        # and long journals are rewritten instead.
+        changes = self.journaled.get(name, self.maxjournal) + \
+            len(self.journal.get(name, ()))
+        if changes >= self.maxjournal:
+            self.touch(name)
+            return
+        self.journal.setdefault(name, []).append((added, removed))
+
+    def flush(self):
+        dirty, self.dirty = self.dirty, set()
+        journal, self.journal = self.journal, {}
+        present = [n for n in dirty if n in self.data]
+        for name in present:
+            value, path = self.data[name], self.path(name)
+            if isinstance(value, Ring):
+                if value.path != path + ".ring":
+                    value.move(path + ".ring")
+                suffix = ".ring"
+            else:
+                suffix = isinstance(value, set) and ".set" or ".pickle"
+                if suffix == ".set":
+                    value, self.journaled[name] = (value, ()), 1
+                makedirs(os.path.dirname(path))
+                with open(path + ".tmp", "wb") as f:
+                    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(path + ".tmp", path + suffix)
+            for other in self.suffixes:
+                if other != suffix:
+                    remove(path + other)
+        for name in dirty.difference(present):
+            self.journaled.pop(name, None)
+            for suffix in self.suffixes:
+                remove(self.path(name) + suffix)
+        for name, changes in journal.items():
+            if name in dirty:
+                continue
+            with open(self.path(name) + ".set", "ab") as f:
+                for change in changes:
+                    pickle.dump(change, f, pickle.HIGHEST_PROTOCOL)
+            self.journaled[name] = self.journaled.get(name, 0) + len(changes)
+
+class Replicated(object):
+    """A *primary* engine with read-only *replicas*.
+
+    Commands are sent to the primary. Readers that can tolerate some
+    staleness ask :meth:`reader` for an engine instead; it picks the
+    replicas in turn, skipping those that are unhealthy or lag too far
+    behind the primary.
+    """
+    interval = 5
+    """Seconds between health checks of each replica."""
+    staleness = 10
+    """Default maximum replica lag (in seconds) accepted by :meth:`reader`."""
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.status = [(0, None)] * len(self.replicas)
+        self.turn = 0
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def check(self, i, now=None):
+        """Check the health of replica *i* and return its lag.
+
+        Redis replicas are healthy if their link to the primary is up; their
+        lag is the time since they last heard from it. Engines that can't
+        report their replication state are assumed to be healthy. Returns
+        None if the replica is unhealthy.
+        """
+        if now is None:
+            now = time.time()
+        lag = 0
+        info = getattr(self.replicas[i], "info", None)
+        if info is not None:
+            try:
+                info = info("replication")
+            except Exception:
+                info = {}
+            lag = None
+            if info.get("role") == "slave" and info.get("master_link_status") == "up":
+                lag = int(info.get("master_last_io_seconds_ago", 0))
+        self.status[i] = (now, lag)
+        return lag
+
+    def fail(self, replica):
+        """Mark *replica* unhealthy until its next health check."""
+        for i, r in enumerate(self.replicas):
+            if r is replica:
+                self.status[i] = (time.time(), None)
+
+    def reader(self, staleness=None):
+        """Return an engine to read from.
+
+        Replicas lagging more than *staleness* seconds (by default,
+        :attr:`staleness`) behind the primary are skipped; if none are
+        suitable, or *staleness* is zero, the primary is returned.
+        """
+        if staleness is None:
+            staleness = self.staleness
+        if staleness <= 0:
+            return self.primary
+
+        now = time.time()
+        for n in range(len(self.replicas)):
+            i = self.turn = (self.turn + 1) % len(self.replicas)
+            checked, lag = self.status[i]
+            if (now - checked) >= self.interval:
+                lag = self.check(i, now)
+            if lag is not None and lag <= staleness:
+                return self.replicas[i]
+        return self.primary
+
+class Shards(object):
+    """Engines holding disjoint sets of series.
+
+    Each series is placed on one of the *engines* by a consistent hash of its
+    key (see :meth:`shard`). *names* identify the engines (by their DSNs, for
+    example) on the hash ring, so adding an engine only moves about 1/N of
+    the series, and only to the new engine.
+    """
+    replicas = 160
+    """Number of points on the hash ring for each engine."""
+
+    def __init__(self, engines, names):
+        self.engines = list(engines)
+        self.names = list(names)
+        self.ring = sorted((self.hash("%s#%d" % (name, i)), n) \
+            for n, name in enumerate(self.names) for i in range(self.replicas))
+        self.points = [point for point, n in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int(md5(key).hexdigest()[:16], 16)
+
+    def shard(self, key):
+        """Return the engine holding the series identified by *key*."""
+        i = bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.engines[self.ring[i][1]]
+
+    def map(self, func):
+        """Call *func* with each engine in parallel and return the results."""
+        return parallel(func, self.engines)
+
+drivers = {
+    "file": File,
+    "memory": Memory,
+    "redis": Redis,
+}
+"""Engines, keyed by DSN scheme."""
@@ -25,3 +25,6 @@ class LockError(Error):
         self.key = key
         message = "Failed to lock key %r" % key
         super(LockError, self).__init__(message)
+
+class PoolError(Error):
+    """Raised when no database connection is available in time."""
@@ -0,0 +1,177 @@
+"""\
+Compress time series
+--------------------
+
+Encode (timestamp, value) series as described in "Gorilla: A Fast, Scalable,
+In-Memory Time Series Database" (Pelkonen et al, VLDB 2015). Time stamps are
+stored as deltas of their deltas and values as the XOR of their bits with the
+bits of the previous value, so regular series with slowly changing values
+compress to a few bits per point.
+
+    >>> data = [(86400 * i, 10.0) for i in range(30)]
+    >>> decode(encode(data)) == data
+    True
+"""
+
+import struct
+
+from array import array
+
+__all__ = ["decode", "encode"]
+
+# Delta of delta buckets: (control bits, control width, value width).
+buckets = [
+    (0x2, 2, 7),
+    (0x6, 3, 9),
+    (0xe, 4, 12),
+]
+"""Time stamp delta of delta encodings, smallest first.
+
+A zero delta of delta is stored as a single 0 bit. Otherwise, the delta of
+delta is offset to be non-negative and stored in the first bucket that fits.
+Anything that doesn't fit is stored as a 64 bit integer after the 1111
+control bits.
+"""
+
+def dtoi(value):
+    """Return the bits of a float *value* as an integer."""
+    return struct.unpack("<Q", struct.pack("<d", value))[0]
+
+def itod(value):
+    """Return the float represented by the integer *value*."""
+    return struct.unpack("<d", struct.pack("<Q", value))[0]
+
+class BitWriter(object):
+
+    def __init__(self):
+        self.data = array('B')
+        self.acc = 0
+        self.nacc = 0
+
+    def write(self, value, nbits):
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.nacc += nbits
+        while self.nacc >= 8:
+            self.nacc -= 8
+            self.data.append((self.acc >> self.nacc) & 0xff)
+        self.acc &= (1 << self.nacc) - 1
+
+    def getvalue(self):
+        data = array('B', self.data)
+        if self.nacc:
+            data.append((self.acc << (8 - self.nacc)) & 0xff)
+        return data.tostring()
+
+class BitReader(object):
+
+    def __init__(self, data, pos=0):
+        self.data = array('B', data)
+        self.pos = pos
+
+    def read(self, nbits):
+        value = 0
+        while nbits:
+            byte = self.data[self.pos >> 3]
+            avail = 8 - (self.pos & 7)
+            n = min(avail, nbits)
+            value = (value << n) | ((byte >> (avail - n)) & ((1 << n) - 1))
+            nbits -= n
+            self.pos += n
+        return value
+
+def encode(data):
+    """Compress *data*, a sequence of (timestamp, value) two-tuples.
+
+    Time stamps must be integers; values must be floats (or integers, which
+    are stored as floats). Returns a string.
+    """
+    writer = BitWriter()
+    lasttime, lastdelta, lastbits = 0, 0, 0
+    leading, trailing = None, None
+    for i, (timestamp, value) in enumerate(data):
+        bits = dtoi(float(value))
+        if i == 0:
+            writer.write(timestamp, 64)
+            writer.write(bits, 64)
+            lasttime, lastbits = timestamp, bits
+            continue
+
+        delta = timestamp - lasttime
+        dod = delta - lastdelta
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for control, cwidth, vwidth in buckets:
+                low = -(1 << (vwidth - 1)) + 1
+                if low <= dod <= (1 << (vwidth - 1)):
+                    writer.write(control, cwidth)
+                    writer.write(dod - low, vwidth)
+                    break
+            else:
+                writer.write(0xf, 4)
+                writer.write(dod, 64)
+        lasttime, lastdelta = timestamp, delta
+
+        xor = bits ^ lastbits
+        lastbits = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        lead = min(64 - xor.bit_length(), 31)
+        trail = (xor & -xor).bit_length() - 1
+        if leading is not None and lead >= leading and trail >= trailing:
+            # The meaningful bits fit in the previous window.
+            writer.write(0x2, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = lead, trail
+            width = 64 - leading - trailing
+            writer.write(0x3, 2)
+            writer.write(leading, 5)
+            writer.write(width - 1, 6)
+            writer.write(xor >> trailing, width)
+
+    return struct.pack("<I", len(data)) + writer.getvalue()
+
+def decode(data):
+    """Decompress *data* produced by :func:`encode`.
+
+    Returns a list of (timestamp, value) two-tuples, where each value is a
+    float.
+    """
+    count, = struct.unpack("<I", data[:4])
+    reader = BitReader(data[4:])
+    result = []
+    lasttime, lastdelta, lastbits = 0, 0, 0
+    leading, trailing = 0, 0
+    for i in xrange(count):
+        if i == 0:
+            lasttime = reader.read(64)
+            if lasttime >= (1 << 63):
+                lasttime -= (1 << 64)
+            lastbits = reader.read(64)
+            result.append((lasttime, itod(lastbits)))
+            continue
+
+        if reader.read(1) == 0:
+            dod = 0
+        else:
+            for control, cwidth, vwidth in buckets:
+                if reader.read(1) == 0:
+                    dod = reader.read(vwidth) - (1 << (vwidth - 1)) + 1
+                    break
+            else:
+                dod = reader.read(64)
+                if dod >= (1 << 63):
+                    dod -= (1 << 64)
+        lastdelta += dod
+        lasttime += lastdelta
+
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                trailing = 64 - leading - (reader.read(6) + 1)
+            lastbits ^= reader.read(64 - leading - trailing) << trailing
+        result.append((lasttime, itod(lastbits)))
+
+    return result
@@ -1,6 +1,14 @@
-from itertools import chain
+import logging
+import random
+import time
+
+from itertools import chain, islice
+
+from . import engines, errors
+from .model import Records, series
 
 delim = '!'
+log = logging.getLogger(__name__)
 
 def fromkey(key):
     return key.split(delim)
@@ -45,17 +53,100 @@ def consolidate(records, interval, cf=None):
         yield bin, cf(values)
 
 def work(db):
-    # Pull a recently updated record set from the queue set.
-    queues = tokey("queues", "records", "raw")
-    key = db.spop(queues)
-    if key is None:
-        return
-
-    # If the record is already being processed, return it to the queue and bail.
-    lock = tokey("locks", key)
-    if db.exists(lock):
-        db.sadd(queues, key)
-        return
-
-	# :q
+    """Record the waiting values of one series in the pending set.
+
+    The series is popped from the :attr:`Records.pending` set and its queue
+    drained (see :meth:`Records.drain`), so several workers can run at once.
+    If the values can't be recorded, they're set aside (see
+    :meth:`Records.quarantine`) instead of being retried forever. Returns
+    the number of values recorded, or None if no series were waiting. With
+    :class:`engines.Shards`, the shards are tried in a random order.
+    """
+    shards = engines.each(db)
+    random.shuffle(shards)
+    for db in shards:
+        member = db.spop(Records.pending)
+        if member is not None:
+            break
+    else:
+        return None
+
+    records = series(*member.split())
+    records.db = db
+    try:
+        return records.drain()
+    except errors.LockError:
+        # Somebody else is working on this series; return it to the queue.
+        db.sadd(Records.pending, member)
+        return 0
+    except Exception, e:
+        try:
+            quarantined = records.quarantine()
+        except:
+            db.sadd(Records.pending, member)
+            raise
+        log.error("Quarantined %d values of %s: %s", quarantined, member, e)
+        return 0
+
+def sweep(db, age=None, retention=None, count=100, pause=0, now=None):
+    """Enforce the retention limits of every series.
+
+    Series whose most recent bin is more than *age* seconds old are deleted,
+    and the bins of the last (unbounded) interval of the others are dropped
+    after *retention* seconds (see :meth:`Records.expire`); either limit may
+    be None. The records sets are scanned incrementally (see
+    :func:`engines.scan`), *count* series at a time, sleeping *pause*
+    seconds between batches. Returns a dictionary with the number of "series"
+    scanned and "reaped", and the number of "keys" and "bytes" reclaimed.
+
+    Only series in the records sets are found: the queue (or rate counter)
+    of a series that was never recorded, for example because a worker died
+    after taking it from :attr:`Records.pending`, isn't reclaimed.
+    """
+    if now is None:
+        now = time.time()
+    totals = dict.fromkeys(("series", "reaped", "keys", "bytes"), 0)
+    for engine in engines.each(db):
+        members = engines.scan(engine, Records.namespace, count)
+        while True:
+            batch = list(islice(members, count))
+            if not batch:
+                break
+            for name, value in reap(engine, batch, age, retention, now).items():
+                totals[name] += value
+            if pause:
+                time.sleep(pause)
+    return totals
+
+def reap(engine, members, age, retention, now):
+    """Apply the limits of :func:`sweep` to the series *members* in *engine*."""
+    totals = dict.fromkeys(("series", "reaped", "keys", "bytes"), 0)
+    everything = [Records(*member.split()) for member in members]
+    for records in everything:
+        records.db = engine
+    totals["series"] = len(everything)
+
+    reaped = set()
+    if age is not None:
+        lasts = engine.mget([r.subkey(r.intervals[0][0], "last")
+            for r in everything])
+        stale = [r for r, last in zip(everything, lasts)
+            if last is None or r.fromlast(last)[0] < now - age]
+    else:
+        stale = []
+    for records in stale:
+        # The series may have moved on since the MGET; reap() checks again.
+        values = records.reap(now - age)
+        if values is None:
+            continue
+        reaped.add(id(records))
+        totals["reaped"] += 1
+        totals["keys"] += len(values)
+        totals["bytes"] += sum(len(v) for v in values)
+
+    if retention is not None:
+        for records in everything:
+            if id(records) not in reaped:
+                totals["bytes"] += records.expire(retention)
+    return totals
 
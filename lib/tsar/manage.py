@@ -1,3 +1,4 @@
+import multiprocessing
 import re
 import time
 
@@ -5,9 +6,9 @@ import cli
 
 from itertools import chain
 
-from . import model
+from . import backfill, maintenance, model
 from .commands import ClientMixin, DBMixin, SubCommand
-from .util import Decorator, nearest
+from .util import Decorator, literal, nearest
 
 def intorfloat(value):
     try:
@@ -33,14 +34,116 @@ def dtos(delta):
         count = nearest(delta, n)/n
         return "%d %s%s" % (count, identifier, count != 1 and 's' or '')
 
+def matching(pattern):
+    """Yield the records whose subkeys match regular expression *pattern*.
+
+    Only the records sharing the literal prefix of *pattern* are read from the
+    index (see :meth:`model.Records.find`).
+    """
+    regex = re.compile(pattern)
+    prefix = literal(pattern)
+    root = model.Records.namespace + model.Types.keydelim
+    if prefix.startswith(root):
+        prefix = prefix[len(root):].replace(model.Types.keydelim, " ")
+        records = model.Records.find(prefix=prefix)
+    elif root.startswith(prefix):
+        records = model.Records.all()
+    else:
+        records = []
+    for record in records:
+        if regex.match(record.subkey("")):
+            yield record
+
 def lastkeys(db):
     split = lambda x: tuple(x.split())
-    records = db.smembers("records")
-    lkeys = ["records!%s!%s!%s!60!last" % split(x) for x in records]
-    last = zip(records, [v.split() for v in db.mget(lkeys)])
+    def last(db):
+        records = list(model.engines.scan(db, model.Records.namespace))
+        lkeys = ["records!%s!%s!%s!60!last" % split(x) for x in records]
+        return zip(records, [v.split() for v in db.mget(lkeys)])
+    last = chain(*model.engines.parallel(last, model.engines.each(db)))
     return [(k, [intorfloat(x) for x in v]) for k, v in last]
 
 
+class Import(DBMixin, SubCommand):
+
+    def main(self):
+        workers = int(self.params.workers)
+        if workers < 2:
+            return self.report(*self.work(0, 1))
+
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=lambda i: results.put(
+            self.work(i, workers)), args=(i,)) for i in range(workers)]
+        for process in processes:
+            process.start()
+        totals = [results.get() for process in processes]
+        for process in processes:
+            process.join()
+        self.report(sum(t[0] for t in totals), sum(t[1] for t in totals),
+            sum(t[2] for t in totals), max(t[3] for t in totals))
+
+    def work(self, worker, workers):
+        """Import the series owned by *worker* (of *workers*).
+
+        Returns the number of series, points and rejected series and the
+        elapsed time.
+        """
+        start = time.time()
+        rows = chain(*[self.read(name) for name in self.params.files])
+        if workers > 1:
+            rows = (r for r in rows if backfill.owner(r[:3], workers) == worker)
+        rows = backfill.sort(rows, int(self.params.runsize), self.params.tmpdir)
+        nseries, npoints, rejected = backfill.load(backfill.groups(rows),
+            int(self.params.batch))
+        for key, e in rejected:
+            self.log.warning("Rejected %s: %s", " ".join(key), e)
+        elapsed = time.time() - start
+        if workers > 1:
+            self.log.info("Worker %d imported %d points in %d series in %.1fs",
+                worker, npoints, nseries, elapsed)
+        return nseries, npoints, len(rejected), elapsed
+
+    def read(self, name):
+        """Yield the rows in file *name* ('-' for stdin)."""
+        binary = self.params.format == "binary"
+        if name == "-":
+            stream = self.stdin
+        else:
+            stream = open(name, binary and "rb" or "r")
+        reader = binary and backfill.readbinary or backfill.readcsv
+        for row in reader(stream):
+            yield row
+
+    def report(self, nseries, npoints, nrejected, elapsed):
+        rate = elapsed and npoints / elapsed or 0
+        self.log.info("Imported %d points in %d series (%d rejected) in %.1fs: "
+            "%.0f points/s", npoints, nseries, nrejected, elapsed, rate)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("import", 
+            help="load history from files in bulk")
+        DBMixin.setup(self)
+
+        default_workers = 1
+        self.add_param("-w", "--workers", default=default_workers,
+            help="number of worker processes, each importing a share of the "
+                "series (default: %s)" % default_workers)
+        self.add_param("-f", "--format", default="csv",
+            choices=["csv", "binary"],
+            help="input format: 'subject,attribute,cf,timestamp,value' rows "
+                "or tsar.backfill frames (default: csv)")
+        self.add_param("-r", "--runsize", default=backfill.runsize,
+            help="rows sorted in memory before spilling to a temporary file "
+                "(default: %s)" % backfill.runsize)
+        self.add_param("-b", "--batch", default=backfill.batchsize,
+            help="points committed in each bulk write "
+                "(default: %s)" % backfill.batchsize)
+        self.add_param("-T", "--tmpdir", default=None,
+            help="directory for temporary files (default: the system's)")
+        self.add_param("files", nargs="+",
+            help="files to import ('-' for standard input)")
+
 class Last(DBMixin, SubCommand):
 
     def main(self):
@@ -71,13 +174,10 @@ class Last(DBMixin, SubCommand):
 class Clean(DBMixin, SubCommand):
     
     def main(self):
-        pattern = re.compile(self.params.pattern[0])
-        for record in model.Records.all():
-            key = record.subkey("")
-            if pattern.match(key):
-                self.stdout.write("%s*\n" % key)
-                if not self.params.dryrun:
-                    record.delete()
+        for record in matching(self.params.pattern[0]):
+            self.stdout.write("%s*\n" % record.subkey(""))
+            if not self.params.dryrun:
+                record.delete()
 
     def setup(self):
         SubCommand.setup(self)
@@ -89,6 +189,189 @@ class Clean(DBMixin, SubCommand):
             help="don't actually remove records")
         self.add_param("pattern", nargs=1, help="regular expression to match subkeys against")
 
+class Consolidate(DBMixin, SubCommand):
+
+    def main(self):
+        workers = int(self.params.workers)
+        if workers < 2:
+            return self.work()
+
+        processes = [multiprocessing.Process(target=self.work) \
+            for i in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+    def work(self):
+        interval = float(self.params.interval)
+        total = 0
+        while True:
+            try:
+                recorded = maintenance.work(self.db)
+            except Exception:
+                # The database is probably unavailable; try again later.
+                self.log.exception("Failed to record queued values")
+                if self.params.once:
+                    raise
+                time.sleep(interval)
+                continue
+            if recorded is not None:
+                total += recorded
+                continue
+
+            backlog = model.Records.backlog()
+            self.log.info("Recorded %d values; %d values in %d series waiting "
+                "(lag: %ds)", total, backlog["values"], backlog["series"],
+                backlog["lag"])
+            if self.params.once:
+                break
+            time.sleep(interval)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("consolidate", 
+            help="record values queued by the web service (serve -Q)")
+        DBMixin.setup(self)
+
+        default_workers = 1
+        default_interval = 1
+        self.add_param("-w", "--workers", default=default_workers,
+            help="number of worker processes (default: %s)" % default_workers)
+        self.add_param("-i", "--interval", default=default_interval,
+            help="seconds to wait when the queues are empty "
+                "(default: %s)" % default_interval)
+        self.add_param("-o", "--once", default=False, action="store_true",
+            help="exit when the queues are empty")
+
+class Migrate(DBMixin, SubCommand):
+
+    def main(self):
+        layout = self.params.target[0]
+        for record in matching(self.params.pattern):
+            key = record.subkey("")
+            self.stdout.write("%s* %s -> %s\n" % (key, record.layout, layout))
+            if not self.params.dryrun:
+                record.migrate(layout)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("migrate", 
+            help="convert records from one storage layout (-L) to another")
+        DBMixin.setup(self)
+
+        self.add_param("-n", "--dryrun", default=False, action="store_true",
+            help="don't actually convert records")
+        self.add_param("target", nargs=1, choices=model.Records.layouts,
+            help="new storage layout")
+        self.add_param("pattern", nargs="?", default=".*", 
+            help="regular expression to match subkeys against")
+
+class Rebalance(DBMixin, SubCommand):
+
+    def main(self):
+        sources = model.engines.each(self.db)
+        sources.extend(model.connectdsn(dsn) for dsn in self.params.drain)
+        total = 0
+        for source in sources:
+            for record in model.Records.all(source):
+                if record.db is source:
+                    continue
+                self.stdout.write("%s*\n" % record.subkey(""))
+                if not self.params.dryrun:
+                    total += record.move(source)
+        self.log.info("Moved %d keys", total)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("rebalance", 
+            help="move records to their shards after changing the DSN list (-D)")
+        DBMixin.setup(self)
+
+        self.add_param("-n", "--dryrun", default=False, action="store_true",
+            help="don't actually move records")
+        self.add_param("drain", nargs="*", default=[],
+            help="DSNs of removed shards to move records from")
+
+class Reindex(DBMixin, SubCommand):
+
+    def main(self):
+        total = model.Records.reindex()
+        self.log.info("Indexed %d series", total)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("reindex", 
+            help="rebuild the subject, attribute and prefix indexes")
+        DBMixin.setup(self)
+
+class Seal(DBMixin, SubCommand):
+
+    def main(self):
+        age = int(self.params.age)
+        total = 0
+        for record in matching(self.params.pattern):
+            sealed = record.seal(age)
+            if sealed:
+                self.stdout.write("%s* %d\n" % (record.subkey(""), sealed))
+            total += sealed
+        self.log.info("Sealed %d bins", total)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("seal", 
+            help="compress old records in the last interval")
+        DBMixin.setup(self)
+
+        default_age = 90 * 86400
+        self.add_param("-a", "--age", default=default_age,
+            help="seal records older than AGE seconds (default: %s)" % default_age)
+        self.add_param("pattern", nargs="?", default=".*", 
+            help="regular expression to match subkeys against")
+
+class Sweep(DBMixin, SubCommand):
+
+    def main(self):
+        if self.params.age is None and self.params.keep is None:
+            self.argparser.error("at least one of --age and --keep is required")
+        age = self.params.age and int(self.params.age)
+        retention = self.params.keep and int(self.params.keep)
+        interval = float(self.params.interval)
+        while True:
+            start = time.time()
+            result = maintenance.sweep(self.db, age=age, retention=retention,
+                count=int(self.params.count), pause=float(self.params.pause))
+            self.log.info("Swept %d series in %.1fs: reaped %d series, "
+                "reclaimed %d keys and %d bytes", result["series"],
+                time.time() - start, result["reaped"], result["keys"],
+                result["bytes"])
+            if self.params.once:
+                break
+            time.sleep(interval)
+
+    def setup(self):
+        SubCommand.setup(self)
+        self.argparser = self.parent.subparsers.add_parser("sweep", 
+            help="delete abandoned series and expire old bins")
+        DBMixin.setup(self)
+
+        default_interval = 3600
+        default_count = 100
+        default_pause = 0
+        self.add_param("-a", "--age", default=None,
+            help="delete series without new bins for AGE seconds")
+        self.add_param("-k", "--keep", default=None,
+            help="drop bins of the last (unbounded) interval more than KEEP "
+                "seconds older than its most recent bin")
+        self.add_param("-c", "--count", default=default_count,
+            help="series examined in each batch (default: %s)" % default_count)
+        self.add_param("-p", "--pause", default=default_pause,
+            help="seconds to wait between batches (default: %s)" % default_pause)
+        self.add_param("-i", "--interval", default=default_interval,
+            help="seconds to wait between sweeps (default: %s)" % default_interval)
+        self.add_param("-o", "--once", default=False, action="store_true",
+            help="exit after one sweep")
+
 class Record(ClientMixin, SubCommand):
     service = "http://tsar.hep.wisc.edu/records"
     
@@ -2,19 +2,22 @@ from __future__ import with_statement
 
 import logging
 import operator
+import struct
 import time
 
 from calendar import timegm
+from contextlib import nested
 from datetime import datetime
+from fnmatch import fnmatchcase, translate
 from itertools import chain, dropwhile
 from string import digits, letters, punctuation
 
 from neat.util import validate, validator
 
-from . import errors
-from .util import nearest
+from . import engines, errors, gorilla, numeric, sketch
+from .util import literal, nearest, parsedsn, wildcard
 
-__all__ = ["Records", "connect", "db"]
+__all__ = ["Group", "Records", "connect", "connectdsn", "db", "series"]
 
 db = None
 
@@ -22,9 +25,44 @@ def logger(cls): # pragma: nocover
     name = "%s.%s" % (__name__, cls.__class__.__name__)
     return logging.getLogger(name)
 
-def connect(**kwargs):
-    import redis
-    return redis.Redis(**kwargs)
+def connect(driver="redis", **kwargs):
+    """Return a storage engine for *driver* (see :data:`engines.drivers`)."""
+    try:
+        engine = engines.drivers[driver]
+    except KeyError:
+        raise errors.Error("Unknown storage engine: %s" % driver)
+    return engine(**kwargs)
+
+def connectdsn(dsns, **options):
+    """Return a storage engine for a comma-separated list of DSNs.
+
+    Each DSN looks like "<driver>://<password>@<host>:<port>/<database>". A
+    list of several DSNs returns :class:`engines.Shards`, with the series
+    spread across all of them. Each DSN may be followed by the DSNs of its
+    read replicas, separated by "|" (see :class:`engines.Replicated`).
+    Additional keyword *options* are passed to every Redis engine (see
+    :func:`engines.Redis`).
+    """
+    def dbfromdsn(dsn):
+        params = parsedsn(dsn.strip())
+        driver = params.pop("driver")
+        del(params["username"])
+        params["db"] = params.pop("database")
+        if driver == "redis":
+            params.update(options)
+        return connect(driver, **params)
+
+    dbs, names = [], []
+    for dsn in (d for d in dsns.split(",") if d.strip()):
+        primary, replicas = dsn.split("|")[0], dsn.split("|")[1:]
+        db = dbfromdsn(primary)
+        if replicas:
+            db = engines.Replicated(db, [dbfromdsn(r) for r in replicas])
+        dbs.append(db)
+        names.append(primary.strip())
+    if len(dbs) == 1:
+        return dbs[0]
+    return engines.Shards(dbs, names)
 
 def cma(last, next, i):
     """Calculate the moving average of two items in a larger series.
@@ -36,6 +74,37 @@ def cma(last, next, i):
         i += 1
     return (i, last + float(next - last)/(i + 1))
 
+def percentile(values, q):
+    """Return the *q*th percentile of *values*, interpolating linearly."""
+    values = sorted(values)
+    rank = (len(values) - 1) * (q / 100.0)
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def combine(data, reduce, count=False):
+    """Combine the aligned bins of several series (see :meth:`Records.aggregate`).
+
+    *data* is a list of lists of (timestamp, value) two-tuples. Yields a
+    (timestamp, value) two-tuple for every timestamp in *data*, where the
+    value is *reduce* applied to the values that aren't None. Bins without
+    values are None (or 0, if *count* is True).
+    """
+    bins = {}
+    for series in data:
+        for timestamp, value in series:
+            values = bins.setdefault(timestamp, [])
+            if value is not None:
+                values.append(value)
+    for timestamp in sorted(bins):
+        values = bins[timestamp]
+        if values:
+            yield (timestamp, reduce(values))
+        elif count:
+            yield (timestamp, 0)
+        else:
+            yield (timestamp, None)
+
 class Types(validate):
     keylen = 256
     keydelim = '!'
@@ -44,6 +113,8 @@ class Types(validate):
     numbertypes = (int, float, long)
     precision = 2
     now = None
+    sketches = False
+    """If True, values may be quantile sketches (see :mod:`tsar.sketch`)."""
     
     @validator
     def Key(self, value):
@@ -92,10 +163,67 @@ class Types(validate):
         if value == "None":
             value = None
         if value is not None:
-            value = self.Number(value)
+            if self.sketches:
+                value = self.Sketch(value)
+            else:
+                value = self.Number(value)
 
         return value
 
+    @validator
+    def Sketch(self, value):
+        # Sketch series store bins of a single value as plain numbers.
+        if isinstance(value, sketch.Sketch):
+            return value
+        if isinstance(value, basestring) and value.startswith(sketch.Sketch.prefix):
+            return sketch.decode(value)
+        return self.Number(value)
+
+    @validator
+    def Quantiles(self, value):
+        if not self.sketches:
+            raise TypeError("quantiles require the sketch cf")
+        if isinstance(value, basestring):
+            value = value.split(',')
+        elif isinstance(value, self.numbertypes):
+            value = [value]
+        quantiles = [float(q) for q in value]
+        for q in quantiles:
+            if not 0 <= q <= 1:
+                raise ValueError("quantile out of range: %r" % q)
+        if not quantiles:
+            raise ValueError("no quantiles")
+        return quantiles
+
+    @validator
+    def Step(self, value):
+        value = int(self.Number(value))
+        if value <= 0:
+            raise ValueError("step must be positive: %r" % value)
+        return value
+
+    @validator
+    def Flag(self, value):
+        if isinstance(value, basestring):
+            value = value.lower()
+        if value in (True, 1, "1", "true", "yes", "on"):
+            return True
+        if value in (None, False, 0, "", "0", "false", "no", "off"):
+            return False
+        raise ValueError("invalid flag: %r" % value)
+
+    @validator
+    def Double(self, value):
+        # Binary layouts store every value as a double, with NaN standing in for
+        # None. Convert them here to match the values stored as strings.
+        # Integral floats are boxed in a NaN by Records.pack and unboxed
+        # before they get here, so an integral double was an integer.
+        if value != value:
+            return None
+        if value.is_integer():
+            return int(value)
+        return round(value, self.precision)
+
 class Records(object):
     """A series of records."""
 
@@ -115,7 +243,15 @@ class Records(object):
 
     These intervals determine the size of the bins into which new data is
     consolidated. The samples determine the number of bins kept for each
-    interval.
+    interval. Series matching one of the :attr:`schemas` use its intervals
+    instead.
+    """
+    schemas = []
+    """Retention schemas, as (pattern, intervals) two-tuples.
+
+    A series uses the intervals of the first schema whose pattern (see
+    :mod:`fnmatch`) matches its "<subject>/<attribute>/<cf>" id, so
+    resolution and storage can be spent where they matter.
     """
     cfs = {
         "ave": cma,
@@ -125,10 +261,109 @@ class Records(object):
         "last": lambda x, y, i: (i, y),
         "add": lambda x, y, i: (i, operator.add(x, y)),
         "sub": lambda x, y, i: (i, operator.sub(x, y)),
+        "sketch": sketch.merge,
+        "rate": cma,
     }
-    """Supported consolidation functions."""
-    
-    def __init__(self, subject, attribute, cf, exception=None, excs=None):
+    """Supported consolidation functions.
+
+    The "sketch" cf keeps a mergeable quantile sketch of the values in each
+    bin (see :mod:`tsar.sketch`); :meth:`query` estimates its quantiles. The
+    "rate" cf records counters as per-second rates (see :meth:`derive`).
+    """
+    folds = {"rate": "ave"}
+    """Consolidation functions that consolidate like another one."""
+    lateness = 0
+    """Seconds a point may arrive late and still be recorded.
+
+    Normally, each interval ignores points no newer than its last bin, and
+    the points no newer than the first interval's last bin are dropped and
+    counted in :attr:`latekey`. With a lateness window, the "lock" writer
+    merges such points into the bins already written instead (see
+    :meth:`late`); only points older than the window are dropped and
+    counted.
+    """
+    latekey = "metrics!records!late"
+    """Number of points dropped for arriving too late.
+
+    Each point is counted once per series, even if the series is a
+    :class:`Group`.
+    """
+    vectorize = True
+    """If True, consolidate with :func:`numeric.consolidate` when NumPy is installed."""
+    batchsize = 500
+    """Maximum number of series committed together by :meth:`bulk`."""
+    bulkexpire = 10
+    """Lifetime (in seconds) of the locks held by :meth:`bulk`."""
+    layouts = ("list", "packed")
+    layout = "list"
+    """Storage layout for the consolidated intervals.
+
+    The "list" layout stores each bin as a string element in a list, most
+    recent first. The "packed" layout stores each interval as a Redis string
+    of packed little-endian doubles (with NaN for missing values), oldest
+    first, and reads and writes ranges of bins with GETRANGE and SETRANGE.
+    Bounded intervals are ring buffers of *samples* + 1 bins; the last
+    interval grows from its origin, the first bin ever written to it.
+
+    A double can't tell 1 from 1.0, so the packed layout boxes integral
+    floats in a NaN (see :meth:`pack`) and returns the same values as the
+    list layout. Bins sealed by :meth:`seal` (in either layout) return
+    integral floats as integers.
+    """
+    width = struct.calcsize("<d")
+    """Size (in bytes) of a bin in the packed layout."""
+    boxed = 0x7ffc000000000000
+    """Bits set in a packed bin holding a boxed integral float."""
+    boxlimit = 2 ** 50
+    """Integral floats this large or larger are packed as plain doubles."""
+    chunksize = 30
+    """Number of bins in each compressed chunk sealed by :meth:`seal`."""
+    chunkcache = {}
+    """Decoded chunks, shared by all instances.
+
+    Sealed chunks are immutable, so they're cached by their content.
+    """
+    cachesize = 4096
+    """Maximum number of chunks in the :attr:`chunkcache`."""
+    pending = "queues!records!raw"
+    """Set of the series with values waiting in their :meth:`queue`."""
+    quarantined = "queues!records!quarantine"
+    """Set of the series with queued values set aside by :meth:`quarantine`."""
+    quarantinecount = "metrics!records!quarantined"
+    """Number of queued values set aside by :meth:`quarantine`."""
+    indexes = "indexes!records"
+    """Prefix of the keys indexing the :attr:`namespace` set.
+
+    Each series is listed in a set for its subject, a set for its attribute
+    and a sorted set of every member (all scored 0) that can be scanned by
+    prefix (see :meth:`find`).
+    """
+    maxmatches = 1000
+    """Maximum number of series matched by a wildcard query (see :meth:`glob`)."""
+    aggregates = {
+        "sum": sum,
+        "avg": lambda values: sum(values) / float(len(values)),
+        "min": min,
+        "max": max,
+        "count": len,
+    }
+    """Operators combining the bins of several series (see :meth:`aggregate`).
+
+    Percentiles are named "p" followed by a number from 0 to 100 (like "p95"
+    or "p99.9").
+    """
+    writers = ("lock", "script")
+    writer = "lock"
+    """Write path used by :meth:`extend`.
+
+    The "lock" writer takes a client-side :class:`Lock` and queues the
+    consolidated data in a pipeline; the "script" writer consolidates and
+    records the data in a single atomic call to a server-side :class:`Script`.
+    Both produce identical data.
+    """
+
+    def __init__(self, subject, attribute, cf, exception=None, excs=None,
+            intervals=None):
         super(Records, self).__init__()
 
         global db
@@ -138,9 +373,35 @@ class Records(object):
         if cf not in self.cfs:
             raise errors.RecordError("Invalid cf: %s" % cf)
         self.cf = cf
+        if intervals is None:
+            intervals = self.schema(subject, attribute, cf)
+        if intervals is not None:
+            self.intervals = intervals
         self.types = Types()
         self.types.exception = exception
         self.types.excs = excs
+        if cf == "sketch":
+            # Sketches are merged in Python and don't fit in a double.
+            self.types.sketches = True
+            self.layout, self.writer = "list", "lock"
+        elif cf == "rate":
+            # Rates depend on the last counter, which the script can't track.
+            self.writer = "lock"
+        if isinstance(self.db, engines.Shards):
+            # Every cf of a series lives on the same shard (see Group).
+            self.db = self.db.shard(self.tokey(subject, attribute))
+
+    @classmethod
+    def schema(cls, subject, attribute, cf):
+        """Return the intervals of the first schema matching the series.
+
+        Returns None if none of the :attr:`schemas` match.
+        """
+        id = "%s/%s/%s" % (subject, attribute, cf)
+        for pattern, intervals in cls.schemas:
+            if fnmatchcase(id, pattern):
+                return intervals
+        return None
 
     def __eq__(self, other):
         if not isinstance(other, Records):
@@ -149,23 +410,377 @@ class Records(object):
         return self.subkey("__eq__") == other.subkey("__eq__")
 
     @classmethod
-    def all(self):
-        """Return an iterable with all records known to the database."""
+    def all(self, source=None):
+        """Return an iterable with all records known to the database.
+
+        The :attr:`namespace` set is scanned incrementally (see :meth:`find`);
+        with :class:`engines.Shards`, the shards are read in turn. If *source*
+        is not None, only the records stored in that engine are returned.
+        """
+        return self.find(source=source)
+
+    @classmethod
+    def find(self, subject=None, attribute=None, prefix=None, source=None,
+            count=100):
+        """Return an iterable with the records matching the arguments.
+
+        The records are looked up in the :attr:`indexes`: those with
+        *subject* and/or *attribute*, and those whose :attr:`member` starts
+        with *prefix*. Sets are read with SSCAN (see :func:`engines.scan`)
+        and prefixes with ZRANGEBYLEX, about *count* records at a time, so
+        the records are streamed instead of read in one reply. If *source* is
+        not None, only the records stored in that engine are returned.
+        """
         global db
-        for record in db.smembers(self.namespace):
-            yield Records(*record.split())
+        if source is None:
+            source = db
+        for engine in engines.each(source):
+            if subject is not None and attribute is not None:
+                members = engine.sinter(self.index("subject", subject),
+                    self.index("attribute", attribute))
+            elif subject is not None:
+                members = engines.scan(engine, self.index("subject", subject),
+                    count)
+            elif attribute is not None:
+                members = engines.scan(engine,
+                    self.index("attribute", attribute), count)
+            elif prefix is not None:
+                members = engines.lexscan(engine, self.index("lex"), prefix,
+                    count)
+            else:
+                members = engines.scan(engine, self.namespace, count)
+            for member in members:
+                if prefix is None or member.startswith(prefix):
+                    yield Records(*member.split())
+
+    @classmethod
+    def glob(self, subject, attribute, cf, source=None, limit=None, count=100):
+        """Return a list of the records matching glob patterns (see :mod:`fnmatch`).
+
+        A None *subject*, *attribute* or *cf* matches anything. The candidates
+        are looked up in the :attr:`indexes` (see :meth:`find`) by the
+        literal subject and/or attribute, or else by the literal prefix of
+        the subject pattern, so the :attr:`namespace` set is only scanned for
+        patterns like "*". The records are sorted by :attr:`member`. Raises
+        :class:`errors.RecordError` if more than *limit* (default:
+        :attr:`maxmatches`) records match.
+        """
+        if limit is None:
+            limit = self.maxmatches
+        patterns = [p is None and "*" or p for p in (subject, attribute, cf)]
+        literals = [not wildcard(p) and p or None for p in patterns[:2]]
+        prefix = None
+        if literals == [None, None]:
+            prefix = literal(translate(patterns[0]))
+        candidates = self.find(literals[0], literals[1], prefix or None,
+            source=source, count=count)
+
+        matches = []
+        for records in candidates:
+            names = (records.subject, records.attribute, records.cf)
+            if not all(fnmatchcase(n, p) for n, p in zip(names, patterns)):
+                continue
+            matches.append(records)
+            if len(matches) > limit:
+                raise errors.RecordError("More than %d series match %s" %
+                    (limit, "/".join(patterns)))
+        return sorted(matches, key=lambda r: r.member)
+
+    @classmethod
+    def survey(self, series):
+        """Return the values of the :meth:`statekeys` of each of *series*.
+
+        The keys of the series stored in each engine are read with one MGET,
+        and the engines are read in parallel.
+        """
+        log = logger(self)
+        batches = {}
+        for i, records in enumerate(series):
+            batches.setdefault(id(records.db), []).append((i, records))
+
+        def run(batch):
+            keys = []
+            for i, records in batch:
+                keys.extend(records.statekeys())
+            log.debug("MGET %r", keys)
+            values = batch[0][1].db.mget(keys)
+            states = []
+            for i, records in batch:
+                nkeys = len(records.statekeys())
+                states.append((i, values[:nkeys]))
+                values = values[nkeys:]
+            return states
+
+        states = [None] * len(series)
+        for result in engines.parallel(run, batches.values()):
+            for i, state in result:
+                states[i] = state
+        return states
+
+    @classmethod
+    def fetch(self, queries, states=None):
+        """Run the :meth:`query` of many series at once.
+
+        *queries* is a list of (records, query) two-tuples, where *query* is a
+        dictionary of keyword arguments for :meth:`query`. The series read
+        from each engine (see :meth:`reader`) cost two round trips in all
+        (see :meth:`gather`), and the engines are read in parallel; a batch
+        that fails on a replica is read again from the primary. *states* may
+        hold the values of the series' :meth:`statekeys` (see :meth:`survey`).
+        Returns a list holding the bins of each query.
+        """
+        batches = {}
+        for i, (records, query) in enumerate(queries):
+            types = records.types
+            options = {"interval": query.get("interval"), "quantiles": None,
+                "stitch": types.Flag(query.get("stitch", False)),
+                "step": query.get("step")}
+            q = query.get("q")
+            if q is not None or types.sketches:
+                options["quantiles"] = types.Quantiles(q is None and 0.5 or q)
+            if options["interval"] is not None:
+                options["interval"] = int(options["interval"])
+            if options["step"] is not None:
+                options["step"] = types.Step(options["step"])
+            start = types.Time(query.get("start", 0))
+            stop = types.Time(query.get("stop", -1))
+            db = records.reader(query.get("staleness"))
+            batch = batches.setdefault(id(db), (db, []))[1]
+            batch.append((i, records, start, stop, options))
+
+        def run(item):
+            db, batch = item
+            primary = batch[0][1].db
+            if db is primary:
+                return self.gather(db, batch, states)
+            try:
+                return self.gather(db, batch, states)
+            except Exception, e:
+                logger(self).warning("Failed to read from replica: %s", e)
+                primary.fail(db)
+                return self.gather(primary, batch, states)
+
+        data = [[] for query in queries]
+        for result in engines.parallel(run, batches.values()):
+            for i, bins in result:
+                data[i] = bins
+        return data
+
+    @classmethod
+    def gather(self, db, batch, states=None):
+        """Read a *batch* of queries planned by :meth:`fetch` from engine *db*.
+
+        The states of the series are read with one MGET (unless *states*
+        holds them), and the reads chosen by :meth:`plan` (or, to stitch
+        intervals together, :meth:`segments`) are sent in one pipeline.
+        Returns a list of (index, bins) two-tuples.
+        """
+        log = logger(self)
+        if states is None:
+            keys = []
+            for i, records, start, stop, options in batch:
+                keys.extend(records.statekeys())
+            log.debug("MGET %r", keys)
+            values = db.mget(keys)
+
+        pipe = db.pipeline(transaction=False)
+        reads = []
+        for i, records, start, stop, options in batch:
+            if states is None:
+                nkeys = len(records.statekeys())
+                state, values = values[:nkeys], values[nkeys:]
+            else:
+                state = states[i]
+            if options["stitch"]:
+                plans = records.segments(start, stop, state)
+            else:
+                plan = records.plan(start, stop, options["interval"], state)
+                plans = plan and [plan + (start, stop)] or []
+            pieces = []
+            for interval, lasttime, origin, begin, end in plans:
+                commands, decode = records.reads(begin, end, interval, lasttime,
+                    origin)
+                for method, args in commands:
+                    log.debug("%s %r", method.upper(), args)
+                    getattr(pipe, method)(*args)
+                pieces.append((interval, len(commands), decode))
+            if pieces:
+                reads.append((i, records, start, stop, options, pieces))
+
+        results = reads and pipe.execute() or []
+        data = []
+        for i, records, start, stop, options, pieces in reads:
+            bins = []
+            for interval, ncommands, decode in pieces:
+                bins.extend((t, v, interval) for t, v in
+                    decode(results[:ncommands]))
+                results = results[ncommands:]
+            if options["step"] is not None:
+                bins = records.resample(bins, options["step"], start, stop)
+            elif not options["stitch"]:
+                bins = [(t, v) for t, v, interval in bins]
+            if options["quantiles"] is not None:
+                bins = records.estimate(bins, options["quantiles"])
+            data.append((i, list(bins)))
+        return data
+
+    @classmethod
+    def aggregate(self, series, operator, start=0, stop=-1, interval=None):
+        """Combine the bins of several *series* with an *operator*.
+
+        *operator* is one of the :attr:`aggregates` or a percentile (like
+        "p95"). Every series is read (with :meth:`fetch`) from the same
+        *interval*; by default, that's the coarsest of the intervals
+        :meth:`query` would choose for each of them, so the bins line up.
+        Series without bins in that interval don't contribute. Each bin is
+        then combined across the series, ignoring missing values, with
+        :func:`numeric.aggregate` (or :func:`combine`, without NumPy).
+
+        Returns a list of (timestamp, value) two-tuples. Raises
+        :class:`errors.RecordError` if the *operator* is unknown or any of
+        the series holds sketches.
+        """
+        reduce = self.aggregator(operator)
+        if any(records.types.sketches for records in series):
+            raise errors.RecordError("Sketch series can't be aggregated")
+        states = self.survey(series)
+        if interval is None:
+            plans = [records.plan(records.types.Time(start),
+                records.types.Time(stop), None, state)
+                for records, state in zip(series, states)]
+            intervals = [plan[0] for plan in plans if plan is not None]
+            interval = intervals and max(intervals) or None
+        if interval is None:
+            return []
+
+        # The states were read from the primary, so the bins must be, too.
+        query = {"start": start, "stop": stop, "interval": interval,
+            "staleness": 0}
+        data = self.fetch([(records, query) for records in series], states)
+        result = None
+        if self.vectorize and numeric.numpy is not None:
+            result = numeric.aggregate(data, operator)
+        if result is None:
+            result = list(combine(data, reduce, operator == "count"))
+        return result
+
+    @classmethod
+    def aggregator(self, operator):
+        """Return the function applying *operator* (see :meth:`aggregate`)."""
+        if operator in self.aggregates:
+            return self.aggregates[operator]
+        try:
+            if not operator.startswith("p"):
+                raise ValueError(operator)
+            q = float(operator[1:])
+        except ValueError:
+            q = -1
+        if not 0 <= q <= 100:
+            raise errors.RecordError("Invalid aggregate: %s" % operator)
+        return lambda values: percentile(values, q)
+
+    @classmethod
+    def index(self, *chunks):
+        """Return the key of one of the :attr:`indexes`."""
+        return Types.keydelim.join((self.indexes,) + chunks)
+
+    @classmethod
+    def reindex(self, source=None, count=100):
+        """Add every series in the :attr:`namespace` set to the :attr:`indexes`.
+
+        Returns the number of series indexed.
+        """
+        global db
+        if source is None:
+            source = db
+        total = 0
+        for engine in engines.each(source):
+            pipe = engine.pipeline(transaction=False)
+            for member in engines.scan(engine, self.namespace, count):
+                Records(*member.split()).register(pipe)
+                total += 1
+                if not total % count:
+                    pipe.execute()
+            pipe.execute()
+        return total
+
+    def indexkeys(self):
+        """Return the keys of the :attr:`indexes` listing the series."""
+        return [self.index("subject", self.subject),
+            self.index("attribute", self.attribute), self.index("lex")]
+
+    def register(self, pipeline):
+        """Queue the commands adding the series to the :attr:`namespace` set.
+
+        The series is added to the :attr:`indexes`, too.
+        """
+        subjects, attributes, lex = self.indexkeys()
+        pipeline.sadd(self.namespace, self.member)
+        pipeline.sadd(subjects, self.member)
+        pipeline.sadd(attributes, self.member)
+        pipeline.zadd(lex, self.member, 0)
+
+    def unregister(self, pipeline):
+        """Queue the commands removing the series from the :attr:`namespace` set."""
+        subjects, attributes, lex = self.indexkeys()
+        pipeline.srem(self.namespace, self.member)
+        pipeline.srem(subjects, self.member)
+        pipeline.srem(attributes, self.member)
+        pipeline.zrem(lex, self.member)
 
     def delete(self):
         """Remove the instance from the database."""
         with self.lock(self.db, self.subkey("lock")):
             pipe = self.db.pipeline(transaction=True)
-            pipe.delete(*self.keys())
-            pipe.srem(self.namespace, "%s %s %s" % (
-                    self.subject, self.attribute, self.cf))
+            self.purge(pipe)
             pipe.execute()
 
+    def purge(self, pipeline):
+        """Queue the commands removing the instance from the database."""
+        pipeline.delete(*self.allkeys())
+        pipeline.srem(self.quarantined, self.member)
+        self.unregister(pipeline)
+
+    def allkeys(self):
+        """Return every key the series may have, including its queues."""
+        return list(self.keys()) + [self.chunkkey(), self.rawkey(),
+            self.quarantinekey(), self.counterkey()]
+
+    def reap(self, cutoff):
+        """Delete the series if it hasn't been written since *cutoff*.
+
+        The first interval's `!last` value and the raw queue are read again
+        under the lock and WATCHed, so a series extended (or with values
+        queued) since it was found stale is kept, even if the writer doesn't
+        take the lock (like the "script" writer and :meth:`queue`). Returns
+        the DUMP values of the deleted keys, or None if the series was kept.
+        """
+        from redis.exceptions import WatchError
+
+        lkey, rkey = self.subkey(self.intervals[0][0], "last"), self.rawkey()
+        with self.lock(self.db, self.subkey("lock")):
+            with self.db.pipeline(transaction=True) as pipe:
+                pipe.watch(lkey, rkey)
+                last, queued = pipe.get(lkey), pipe.llen(rkey)
+                if queued or (last is not None and self.fromlast(last)[0] >= cutoff):
+                    return None
+                values = [v for v in (pipe.dump(k) for k in self.allkeys())
+                    if v is not None]
+                pipe.multi()
+                self.purge(pipe)
+                try:
+                    pipe.execute()
+                except WatchError:
+                    return None
+        return values
+
     def rename(self, new):
         """Rename the series in the database."""
+        if new.db is not self.db:
+            raise errors.RecordError("New Records instance is on another shard")
+        if new.intervals != self.intervals:
+            raise errors.RecordError("New Records instance has another "
+                "retention schema")
         keys = list(self.keys())
         keymap = zip(keys, new.keys())
         if len(keymap) != len(keys):
@@ -180,13 +795,102 @@ class Records(object):
                 elif check:
                     check = False
                 pipe.renamenx(src, dst)
+            if self.db.exists(self.chunkkey()):
+                pipe.renamenx(self.chunkkey(), new.chunkkey())
+            if self.db.exists(self.counterkey()):
+                pipe.renamenx(self.counterkey(), new.counterkey())
+            if self.db.exists(self.rawkey()):
+                pipe.renamenx(self.rawkey(), new.rawkey())
+                pipe.sadd(self.pending, new.member)
+            self.unregister(pipe)
+            new.register(pipe)
+            pipe.execute()
+
+    def move(self, source):
+        """Move the series from the engine *source* to :attr:`db`.
+
+        Used to rebalance :class:`engines.Shards` when shards are added or
+        removed. The series' keys are copied with DUMP and RESTORE (so both
+        engines must be of the same kind) and then removed from *source*.
+        Returns the number of keys moved.
+        """
+        keys = [self.chunkkey(), self.rawkey(), self.counterkey()]
+        for interval, samples in self.intervals:
+            keys.extend([self.subkey(interval), self.subkey(interval, "last"),
+                self.subkey(interval, "origin")])
+
+        with self.lock(source, self.subkey("lock")):
+            pipe = source.pipeline(transaction=True)
+            for key in keys:
+                pipe.dump(key)
+            values = [(k, v) for k, v in zip(keys, pipe.execute()) if v is not None]
+            if not values:
+                return 0
+            for key, value in values:
+                if self.db.exists(key):
+                    raise errors.RecordError("Key %s already exists" % key)
+
+            pipe = self.db.pipeline(transaction=True)
+            for key, value in values:
+                pipe.restore(key, 0, value)
+            self.register(pipe)
+            if self.rawkey() in dict(values):
+                pipe.sadd(self.pending, self.member)
             pipe.execute()
 
+            pipe = source.pipeline(transaction=True)
+            pipe.delete(*[k for k, v in values])
+            self.unregister(pipe)
+            pipe.srem(self.pending, self.member)
+            pipe.execute()
+        return len(values)
+
+    @property
+    def member(self):
+        """The instance's member in the :attr:`namespace` set."""
+        return "%s %s %s" % (self.subject, self.attribute, self.cf)
+
     def keys(self):
         """Return an iterable of keys used by this instance."""
         for i, samples in self.intervals:
             yield self.subkey(i)
             yield self.subkey(i, "last")
+            if self.layout == "packed":
+                yield self.subkey(i, "origin")
+
+    def lockkeys(self):
+        """Return the keys locked while the series is written."""
+        return [self.subkey("lock")]
+
+    def chunkkey(self):
+        """Return the key holding the last interval's sealed chunks."""
+        return self.subkey(self.intervals[-1][0], "chunks")
+
+    def rawkey(self):
+        """Return the key holding values waiting to be recorded by :meth:`drain`."""
+        return self.subkey("raw")
+
+    def quarantinekey(self):
+        """Return the key holding queued values that couldn't be recorded."""
+        return self.subkey("quarantine")
+
+    def counterkey(self):
+        """Return the key holding the last counter value of a "rate" series."""
+        return self.subkey("counter")
+
+    def statekeys(self):
+        """Return the keys describing the current state of the series.
+
+        The first keys are the `!last` keys of each interval. The packed
+        layout also needs the origin of each interval, and "rate" series end
+        with their :meth:`counterkey`.
+        """
+        keys = [self.subkey(i, "last") for i, s in self.intervals]
+        if self.layout == "packed":
+            keys.extend(self.subkey(i, "origin") for i, s in self.intervals)
+        if self.cf == "rate":
+            keys.append(self.counterkey())
+        return keys
 
     def subkey(self, *chunks):
         """Return a key within this :class:`Record`'s :attr:`namespace`."""
@@ -249,7 +953,7 @@ class Records(object):
         return self.types.Time(timestamp), self.types.Value(value), int(points)
 
     def tolast(self, timestamp, value, points):
-        return "%d %r %d" % (timestamp, value, points)
+        return "%d %s %d" % (timestamp, engines.encode(value), points)
 
     class Lock(object):
 
@@ -297,16 +1001,347 @@ class Records(object):
 
     lock = Lock()
 
-    def query(self, start=0, stop=-1, interval=None, **kwargs):
+    class Script(object):
+        """Consolidate and record new data atomically inside Redis.
+
+        The script mirrors :meth:`Records.record` (and :meth:`consolidate`)
+        step for step, so the lists and `!last` keys it writes are identical
+        to those written by the lock-based path. One call records the same
+        values into one or more series (the members of a :class:`Group`).
+        Everything is computed before the first write; on error, the script
+        returns without touching the database.
+
+        For each series, KEYS holds the interval and `!last` keys for each
+        interval (in :attr:`Records.intervals` order) followed by the
+        namespace and the :meth:`indexkeys` (which are only written for new
+        series); the last KEY is the :attr:`Records.latekey`, where the points
+        the first series drops are counted. ARGV is the number of series,
+        then for each series its cf, namespace member, number of intervals
+        and (interval, samples) pairs, and finally the (timestamp, value)
+        pairs to record.
+        """
+        source = """
+-- Errors raised with fail() are returned to the client as error replies.
+local function fail(kind, message)
+    error({kind .. ": " .. message})
+end
+
+-- Values are {number, isfloat} pairs; false stands in for Python's None.
+local function parse(s)
+    if s == "None" then return false end
+    local x = tonumber(s)
+    if x == nil then fail("TypeError", "invalid value: " .. s) end
+    return {x, string.find(s, "[%.eEnN]") ~= nil}
+end
+
+-- Python 2's round(x, 2), which rounds halfway cases away from zero.
+local function round2(x)
+    if x ~= x or x == math.huge or x == -math.huge then return x end
+    local y = x * 8
+    if y == math.floor(y) and y % 2 == 1 then
+        local z = x * 100
+        if z > 0 then z = z + 0.5 else z = z - 0.5 end
+        return tonumber(string.format("%.0fe-2", z))
+    end
+    return tonumber(string.format("%.2f", x))
+end
+
+-- Types.Value, as applied to the values stored in !last keys.
+local function value(s)
+    if s == "None" then return false end
+    if string.find(s, ".", 1, true) then
+        local x = tonumber(s)
+        if x == nil then fail("TypeError", "invalid value: " .. s) end
+        return {round2(x), true}
+    end
+    if not string.find(s, "^%s*[-+]?%d+%s*$") then
+        fail("TypeError", "invalid literal for int(): " .. s)
+    end
+    return {tonumber(s), false}
+end
+
+-- Python 2's repr(float).
+local function repr(x)
+    if x ~= x then return "nan" end
+    if x == math.huge then return "inf" end
+    if x == -math.huge then return "-inf" end
+    if x == 0 then
+        if 1/x < 0 then return "-0.0" end
+        return "0.0"
+    end
+    local s
+    for p = 0, 16 do
+        s = string.format("%." .. p .. "e", x)
+        if tonumber(s) == x then break end
+    end
+    local sign, int, frac, exp = string.match(s, "^(-?)(%d)%.?(%d*)e([-+]%d+)$")
+    local digits = (string.gsub(int .. frac, "0+$", ""))
+    exp = tonumber(exp)
+    local out
+    if exp >= -4 and exp < 16 then
+        if exp < 0 then
+            out = "0." .. string.rep("0", -exp - 1) .. digits
+        elseif #digits <= exp + 1 then
+            out = digits .. string.rep("0", exp + 1 - #digits) .. ".0"
+        else
+            out = string.sub(digits, 1, exp + 1) .. "." .. string.sub(digits, exp + 2)
+        end
+    else
+        out = string.sub(digits, 1, 1)
+        if #digits > 1 then out = out .. "." .. string.sub(digits, 2) end
+        out = out .. "e" .. (exp < 0 and "-" or "+") .. string.format("%02d", math.abs(exp))
+    end
+    return sign .. out
+end
+
+local function format(v)
+    if not v then return "None" end
+    if v[2] then return repr(v[1]) end
+    return string.format("%d", v[1])
+end
+
+-- Python 2 orders None before any number.
+local function less(x, y)
+    if not y then return false end
+    if not x then return true end
+    return x[1] < y[1]
+end
+
+local function number(x, y)
+    if not x or not y then
+        fail("TypeError", "unsupported operand type(s): 'NoneType'")
+    end
+end
+
+local cfs = {
+    ave = function(x, y, i)
+        number(x, y)
+        if i == 0 then i = i + 1 end
+        return i, {x[1] + (y[1] - x[1])/(i + 1), true}
+    end,
+    min = function(x, y, i) if less(y, x) then return i, y end return i, x end,
+    max = function(x, y, i) if less(x, y) then return i, y end return i, x end,
+    first = function(x, y, i) return i, x end,
+    last = function(x, y, i) return i, y end,
+    add = function(x, y, i) number(x, y); return i, {x[1] + y[1], x[2] or y[2]} end,
+    sub = function(x, y, i) number(x, y); return i, {x[1] - y[1], x[2] or y[2]} end,
+}
+
+local function nearest(t, interval)
+    local distance = t % interval
+    if distance > math.floor(interval/2) then distance = distance - interval end
+    return t - distance
+end
+
+local function consolidate(data, interval, cfunc)
+    local bins = {}
+    local lasttime, lastval, i = nil, 0, 0
+    for _, point in ipairs(data) do
+        local timestamp = nearest(point[1], interval)
+        if lasttime and lasttime > timestamp then
+            fail("RecordError", string.format(
+                "Series out of order: %d more recent than %d", lasttime, timestamp))
+        end
+        while lasttime and (timestamp - lasttime) > interval do
+            bins[#bins + 1] = {lasttime, lastval, i}
+            lasttime = lasttime + interval; lastval = false; i = 0
+        end
+        if timestamp ~= lasttime then
+            if lasttime then bins[#bins + 1] = {lasttime, lastval, i} end
+            lasttime, lastval, i = timestamp, point[2], 0
+        else
+            i, lastval = cfunc(lastval, point[2], i)
+            i = i + 1
+        end
+    end
+    if lasttime then bins[#bins + 1] = {lasttime, lastval, i} end
+    return bins
+end
+
+local function main()
+local series, a, offset = {}, 2, 0
+for s = 1, tonumber(ARGV[1]) do
+    local cf, n = ARGV[a], tonumber(ARGV[a + 2])
+    local cfunc = cfs[cf]
+    if cfunc == nil then fail("RecordError", "Invalid cf: " .. cf) end
+    local intervals = {}
+    for k = 1, n do
+        intervals[k] = {tonumber(ARGV[a + 1 + 2*k]), tonumber(ARGV[a + 2 + 2*k])}
+    end
+    series[s] = {cfunc = cfunc, member = ARGV[a + 1], n = n,
+        intervals = intervals, offset = offset}
+    a, offset = a + 3 + 2*n, offset + 2*n + 4
+end
+
+local data = {}
+for j = a, #ARGV, 2 do
+    data[#data + 1] = {tonumber(ARGV[j]), parse(ARGV[j + 1])}
+end
+
+local dropped = 0
+for s, spec in ipairs(series) do
+    local n, o = spec.n, spec.offset
+    local lkeys = {}
+    for k = 1, n do lkeys[k] = KEYS[o + 2*k] end
+    local lasts = redis.call("MGET", unpack(lkeys))
+    spec.updates = {}
+    for k = 1, n do
+        local idata = data
+        if lasts[k] then
+            local t, v = string.match(lasts[k], "^(%S+)%s+(%S+)")
+            local lasttime = tonumber(t)
+            idata = {{lasttime, value(v)}}
+            local j = 1
+            while j <= #data and data[j][1] <= lasttime do j = j + 1 end
+            if s == 1 and k == 1 then dropped = j - 1 end
+            for m = j, #data do idata[#idata + 1] = data[m] end
+        end
+        spec.updates[k] = consolidate(idata, spec.intervals[k][1], spec.cfunc)
+    end
+end
+
+local written = 0
+for _, spec in ipairs(series) do
+    local n, o = spec.n, spec.offset
+    local mset = {}
+    for k = 1, n do
+        local ikey, bins = KEYS[o + 2*k - 1], spec.updates[k]
+        if #bins > 0 then
+            redis.call("LPOP", ikey)
+            local values = {}
+            for m, bin in ipairs(bins) do
+                values[#values + 1] = format(bin[2])
+                if #values >= 1000 or m == #bins then
+                    redis.call("LPUSH", ikey, unpack(values))
+                    values = {}
+                end
+            end
+            local bin = bins[#bins]
+            mset[#mset + 1] = KEYS[o + 2*k]
+            mset[#mset + 1] = string.format("%d %s %d", bin[1], format(bin[2]), bin[3])
+            -- Don't trim the last interval, letting it grow.
+            if k < n then
+                redis.call("LTRIM", ikey, 0, spec.intervals[k][2])
+            end
+        end
+    end
+    if #mset > 0 then
+        redis.call("MSET", unpack(mset))
+        if redis.call("SADD", KEYS[o + 2*n + 1], spec.member) == 1 then
+            redis.call("SADD", KEYS[o + 2*n + 2], spec.member)
+            redis.call("SADD", KEYS[o + 2*n + 3], spec.member)
+            redis.call("ZADD", KEYS[o + 2*n + 4], 0, spec.member)
+        end
+    end
+    written = written + #mset
+end
+if dropped > 0 then
+    redis.call("INCRBY", KEYS[offset + 1], dropped)
+end
+return written
+end
+
+local ok, result = pcall(main)
+if not ok then
+    if type(result) == "table" then return redis.error_reply(result[1]) end
+    error(result)
+end
+return result
+"""
+
+        def __init__(self):
+            self.scripts = {}
+
+        def __call__(self, db, keys, args, client=None):
+            from redis.exceptions import ResponseError
+
+            script = self.scripts.get(id(db))
+            if script is None:
+                script = self.scripts[id(db)] = db.register_script(self.source)
+            if client is not None:
+                # Errors will be returned when the pipeline is executed.
+                return script(keys=keys, args=args, client=client)
+            try:
+                return script(keys=keys, args=args)
+            except ResponseError, e:
+                raise self.error(e)
+
+        def error(self, e):
+            """Convert an error reply from the script to a local exception."""
+            kind, _, message = str(e).partition(": ")
+            if kind.endswith("RecordError"):
+                return errors.RecordError(message)
+            elif kind.endswith("TypeError"):
+                return TypeError(message)
+            return e
+
+    script = Script()
+
+    def reader(self, staleness=None):
+        """Return the engine to read from.
+
+        If :attr:`db` has read replicas, one that lags the primary by at most
+        *staleness* seconds is returned (see :meth:`engines.Replicated.reader`).
+        """
+        if isinstance(self.db, engines.Replicated):
+            if staleness is not None:
+                staleness = self.types.Number(staleness)
+            return self.db.reader(staleness)
+        return self.db
+
+    def query(self, start=0, stop=-1, interval=None, staleness=None, q=None,
+            stitch=False, step=None, **kwargs):
         """Select a range of data from the series.
 
         The range spans from Unix time stamps *start* to *stop*, inclusive. If
         all of the requested range could be selected from multiple intervals,
         data from the smallest interval (and the highest resolution) will be
-        chosen.
+        chosen. The data may be read from a replica that lags by up to
+        *staleness* seconds (see :meth:`reader`); if that fails, it's read
+        from the primary.
+
+        Sketch series return the *q* quantile of each bin (default: the
+        median). If *q* lists several quantiles (like "0.5,0.99"), each value
+        is a list of them.
+
+        If *stitch* is True, each part of the range is read from the finest
+        interval holding it instead (see :meth:`segments`), and each bin is
+        a (timestamp, value, interval) three-tuple. If *step* is not None,
+        the bins are resampled to *step* seconds (see :meth:`resample`).
 
         Returns an iterator.
         """
+        if self.types.Flag(stitch) or step is not None:
+            query = {"start": start, "stop": stop, "interval": interval,
+                "staleness": staleness, "q": q, "stitch": stitch, "step": step}
+            return iter(self.fetch([(self, query)])[0])
+        if q is not None or self.types.sketches:
+            quantiles = self.types.Quantiles(q is None and 0.5 or q)
+        db = self.reader(staleness)
+        if db is self.db:
+            data = self.search(start, stop, interval, db)
+        else:
+            try:
+                data = iter(list(self.search(start, stop, interval, db)))
+            except Exception, e:
+                logger(self).warning("Failed to read from replica: %s", e)
+                self.db.fail(db)
+                data = self.search(start, stop, interval, self.db)
+        if self.types.sketches:
+            data = self.estimate(data, quantiles)
+        return data
+
+    def estimate(self, data, quantiles):
+        """Replace the sketches in *data* with their *quantiles* (see :meth:`query`)."""
+        for point in data:
+            timestamp, value = point[:2]
+            values = [sketch.quantile(value, q) for q in quantiles]
+            if len(values) == 1:
+                values = values[0]
+            yield (timestamp, values) + tuple(point[2:])
+
+    def search(self, start, stop, interval, db):
+        """Select a range of data from engine *db* (see :meth:`query`)."""
         log = logger(self)
         empty = (x for x in [])
         start, stop = self.types.Time(start), self.types.Time(stop)
@@ -315,79 +1350,456 @@ class Records(object):
         # guessing (see below).
         if interval is not None:
             interval = int(interval)
-            samples = None
-            for i, s in self.intervals:
-                if i == interval:
-                    interval, samples = i, s
-                    break
-            if samples is None:
+            if interval not in [i for i, s in self.intervals]:
                 return empty
+            return self.select(start, stop, interval, db=db)
+
+        lkeys = self.statekeys()
+        log.debug("MGET %r", lkeys)
+        plan = self.plan(start, stop, None, db.mget(lkeys))
+        if plan is None:
+            return empty
+        return self.select(start, stop, *plan, db=db)
 
-            return self.select(start, stop, interval)
+    def plan(self, start, stop, interval, state):
+        """Choose the interval to answer a query (see :meth:`query`).
 
-        # Choose the most appropriate consolidation interval to answer the
-        # query.
+        *state* holds the values of the series' :meth:`statekeys`. If
+        *interval* is None, the smallest interval whose bins cover *start*
+        to *stop* is chosen (or the last interval, if none does). Returns the
+        (interval, lasttime, origin) of the chosen interval, or None if there
+        is no data to select.
+        """
         nintervals = len(self.intervals) - 1
-        lkeys = [self.subkey(i, "last") for i, s in self.intervals]
-        ikey = None
-        log.debug("MGET %r", lkeys)
-        for i, last in enumerate(self.db.mget(lkeys)):
-            interval, samples = self.intervals[i]
-            istart, istop = nearest(start, interval), nearest(stop, interval)
-            lkey = lkeys[i]
+        origins = []
+        if self.layout == "packed":
+            origins = state[nintervals + 1:2 * (nintervals + 1)]
+        for i, last in enumerate(state[:nintervals + 1]):
+            ival, samples = self.intervals[i]
+            if interval is not None and ival != interval:
+                continue
 
             # Bail if we don't have any data yet.
             if last is None:
-                return empty
+                return None
 
             # Choose the first interval that might encompass the requested
             # range. If we're on the last interval, just use that (it's the best
             # we'll be able to do).
             lasttime = self.fromlast(last)[0]
-            earliest = lasttime - (interval * samples)
+            earliest = lasttime - (ival * samples)
 
-            inrange = (start > (earliest - interval)) and (stop < (lasttime + interval))
-            if inrange or (i >= nintervals):
-                ikey = self.subkey(interval)
-                break
+            inrange = (start > (earliest - ival)) and (stop < (lasttime + ival))
+            if interval is not None or inrange or (i >= nintervals):
+                return ival, lasttime, origins and origins[i] or None
 
-        # Bail if we didn't find a suitable interval.
-        if ikey is None:
-            return empty
+        # We didn't find a suitable interval.
+        return None
+
+    def segments(self, start, stop, state):
+        """Split *start* to *stop* among the intervals, finest first.
+
+        *state* holds the values of the series' :meth:`statekeys`. The most
+        recent part of the range is read from the finest interval, as far
+        back as its bins go; the part before that from the next interval,
+        and so on, without overlapping. Returns a list of (interval,
+        lasttime, origin, start, stop) tuples, oldest first, with at most one
+        for each interval.
+        """
+        nintervals = len(self.intervals)
+        origins = [None] * nintervals
+        if self.layout == "packed":
+            origins = state[nintervals:2 * nintervals]
+
+        segments = []
+        upper = stop
+        for i, (interval, samples) in enumerate(self.intervals):
+            last = state[i]
+            if last is None:
+                break
+            if segments:
+                # Stop at the last bin before the finer segment's first one.
+                upper = min(stop, ((segments[-1][3] - 1) // interval) * interval)
+            lasttime = self.fromlast(last)[0]
+            lower = start
+            if i < nintervals - 1:
+                lower = max(start, lasttime - (interval * samples))
+            if lower <= upper:
+                segments.append((interval, lasttime, origins[i], lower, upper))
+            if lower <= start:
+                break
+        segments.reverse()
+        return segments
 
-        return self.select(start, stop, interval, lasttime)
+    def resample(self, data, step, start, stop):
+        """Resample (timestamp, value, interval) *data* to bins *step* seconds wide.
 
-    def select(self, start, stop, interval, lasttime=None):
+        Points from intervals wider than *step* are repeated in each of the
+        bins they cover. The values in each bin are then consolidated with
+        the series' cf (see :meth:`consolidate`), and gaps are filled with
+        None. Only the bins from *start* to *stop* are returned, as
+        (timestamp, value) two-tuples.
+        """
+        points = [x for x in data if x[1] is not None]
+
+        def lowest(point):
+            # The first bin each point lands in.
+            timestamp, value, interval = point
+            if interval <= step:
+                return nearest(timestamp, step)
+            first = timestamp - (interval / 2)
+            return first + (-first % step)
+
+        def spread():
+            for k, (timestamp, value, interval) in enumerate(points):
+                if interval <= step:
+                    yield (timestamp, value)
+                    continue
+                # Don't run into the next point (from a finer segment).
+                end = timestamp - (interval / 2) + interval
+                if k + 1 < len(points):
+                    end = min(end, lowest(points[k + 1]))
+                for t in xrange(lowest(points[k]), end, step):
+                    yield (t, value)
+
+        cfunc = self.cfs[self.folds.get(self.cf, self.cf)]
+        first, last = nearest(start, step), nearest(stop, step)
+        return [(t, v) for t, v, i in self.consolidate(spread(), step, cfunc)
+            if first <= t <= last]
+
+    def select(self, start, stop, interval, lasttime=None, origin=None, db=None):
         log = logger(self)
+        if db is None:
+            db = self.db
         start, stop = self.types.Time(start), self.types.Time(stop)
-        istart, istop = nearest(start, interval), nearest(stop, interval)
-        ikey = self.subkey(interval)
 
-        if lasttime is None:
-            last = self.db.get(self.subkey(interval, "last"))
+        if lasttime is None or (self.layout == "packed" and origin is None):
+            last, origin = db.mget(
+                self.subkey(interval, "last"), self.subkey(interval, "origin"))
             if not last:
                 raise StopIteration()
             lasttime = self.fromlast(last)[0]
 
+        commands, decode = self.reads(start, stop, interval, lasttime, origin)
+        pipe = db.pipeline(transaction=False)
+        for method, args in commands:
+            log.debug("%s %r", method.upper(), args)
+            getattr(pipe, method)(*args)
+        for item in decode(pipe.execute()):
+            yield item
+
+    def reads(self, start, stop, interval, lasttime, origin=None):
+        """Plan the reads that :meth:`select` a range of bins from an *interval*.
+
+        *lasttime* and *origin* are the interval's most recent and (in the
+        packed layout) first bins. Returns a list of (command, arguments)
+        two-tuples and a function that takes the commands' results and
+        yields the (timestamp, value) bins, so several ranges (and series) can
+        be read in a single pipeline.
+        """
+        istart, istop = nearest(start, interval), nearest(stop, interval)
+        ikey = self.subkey(interval)
+
+        # The last interval may have older bins sealed in compressed chunks
+        # (see seal()).
+        sealed = interval == self.intervals[-1][0]
+        ckey = self.chunkkey()
+
+        if self.layout == "packed":
+            origin = int(origin)
+            sealed = sealed and istart < origin
+            commands = []
+            if sealed:
+                commands.append(("zrangebyscore", (ckey, istart, "+inf")))
+            first, ranges = self.spans(istart, istop, interval, lasttime, origin)
+            commands.extend(("getrange", (ikey, begin, end))
+                for begin, end in ranges)
+
+            def decode(results):
+                if sealed:
+                    chunks, results = results[0], results[1:]
+                    for item in self.unseal(chunks, istart,
+                            min(istop, origin - interval)):
+                        yield item
+                for item in self.unpacked(''.join(results), first, interval):
+                    yield item
+            return commands, decode
+
         # Convert start and stop to indexes on the series. Since the series is
         # stored from most recent to oldest in the database, we flip the order
         # here.
         if istop > lasttime:
             istop = lasttime
+        if istart > istop:
+            return [], lambda results: iter([])
         first, last = (lasttime - istop)/interval, (lasttime - istart)/interval
+        commands = [("lrange", (ikey, first, last))]
+        if sealed:
+            commands.append(("zrangebyscore", (ckey, istart, "+inf")))
 
         # The data here runs from most to least recent, so we need to yield it
         # in reverse order.
-        log.debug("LRANGE %s %r %r", ikey, first, last)
-        data = self.db.lrange(ikey, first, last)
-        dlen = len(data)
-        timestamp = istop - ((dlen - 1)* interval)
-        for i in xrange(dlen):
-            value = self.types.Value(data[-(i + 1)])
+        def decode(results):
+            data = results[0]
+            dlen = len(data)
+            timestamp = istop - ((dlen - 1)* interval)
+            if sealed:
+                before = min(istop, timestamp - interval)
+                for item in self.unseal(results[1], istart, before):
+                    yield item
+            for i in xrange(dlen):
+                value = self.types.Value(data[-(i + 1)])
+                yield (timestamp, value)
+                timestamp += interval
+        return commands, decode
+
+    def unseal(self, chunks, start, stop):
+        """Decode sealed *chunks*, yielding the bins between *start* and *stop*.
+
+        Decoded chunks are kept in the :attr:`chunkcache`.
+        """
+        cache = self.chunkcache
+        for chunk in chunks:
+            data = cache.get(chunk)
+            if data is None:
+                data = gorilla.decode(chunk)
+                if len(cache) >= self.cachesize:
+                    cache.popitem()
+                cache[chunk] = data
+            for timestamp, value in data:
+                if start <= timestamp <= stop:
+                    yield (timestamp, self.types.Double(value))
+
+    def seal(self, age):
+        """Seal old bins in the last (unbounded) interval.
+
+        Bins more than *age* seconds older than the interval's most recent bin
+        are compressed (see :mod:`tsar.gorilla`) into immutable chunks of
+        :attr:`chunksize` bins and removed from the interval. Sealed bins are
+        still returned by :meth:`query` and :meth:`select`. Returns the number
+        of bins sealed (always 0 for sketch series).
+        """
+        log = logger(self)
+        if self.types.sketches:
+            # Chunks only hold doubles.
+            return 0
+        interval, samples = self.intervals[-1]
+        ikey, lkey = self.subkey(interval), self.subkey(interval, "last")
+        ckey = self.chunkkey()
+
+        with self.lock(self.db, self.subkey("lock")):
+            if self.layout == "packed":
+                last, origin = self.db.mget(lkey, self.subkey(interval, "origin"))
+                if last is None:
+                    return 0
+                lasttime = self.fromlast(last)[0]
+                data = self.dump(interval, lasttime, origin)
+                first, length = data[0][0], len(data)
+            else:
+                pipe = self.db.pipeline(transaction=True)
+                pipe.get(lkey)
+                pipe.llen(ikey)
+                last, length = pipe.execute()
+                if last is None:
+                    return 0
+                lasttime = self.fromlast(last)[0]
+                first = lasttime - ((length - 1) * interval)
+
+            # Only seal whole chunks, and always leave the most recent bin.
+            cutoff = lasttime - age
+            count = max(0, min(length - 1, (cutoff - first + interval - 1)/interval))
+            count -= count % self.chunksize
+            if not count:
+                return 0
+
+            if self.layout == "list":
+                # New bins are only ever pushed onto the head of the list, so
+                # the tail can be sealed without blocking scripted writers.
+                log.debug("LRANGE %s %r %r", ikey, -count, -1)
+                values = self.db.lrange(ikey, -count, -1)
+                values.reverse()
+                data = [(first + (i * interval), self.parse(v)) \
+                    for i, v in enumerate(values)]
+
+            pipe = self.db.pipeline(transaction=True)
+            for i in xrange(0, count, self.chunksize):
+                chunk = data[i:i + self.chunksize]
+                points = [(t, v is None and float("nan") or v) for t, v in chunk]
+                log.debug("ZADD %s %r <%d bins>", ckey, chunk[-1][0], len(chunk))
+                pipe.zadd(ckey, gorilla.encode(points), chunk[-1][0])
+            if self.layout == "packed":
+                pipe.set(ikey, self.pack([v for t, v in data[count:]]))
+                pipe.set(self.subkey(interval, "origin"), data[count][0])
+            else:
+                log.debug("LTRIM %s %r %r", ikey, 0, -(count + 1))
+                pipe.ltrim(ikey, 0, -(count + 1))
+            pipe.execute()
+
+        return count
+
+    def expire(self, age):
+        """Drop old bins from the last (unbounded) interval.
+
+        Bins (and sealed chunks) more than *age* seconds older than the
+        interval's most recent bin are removed for good; the most recent bin
+        is always kept. Returns the number of bytes reclaimed.
+        """
+        log = logger(self)
+        interval, samples = self.intervals[-1]
+        ikey, lkey = self.subkey(interval), self.subkey(interval, "last")
+        okey, ckey = self.subkey(interval, "origin"), self.chunkkey()
+
+        with self.lock(self.db, self.subkey("lock")):
+            pipe = self.db.pipeline(transaction=True)
+            pipe.get(lkey)
+            pipe.get(okey)
+            if self.layout == "packed":
+                pipe.strlen(ikey)
+            else:
+                pipe.llen(ikey)
+            last, origin, length = pipe.execute()
+            if last is None:
+                return 0
+            lasttime = self.fromlast(last)[0]
+            cutoff = lasttime - age
+            if self.layout == "packed":
+                length /= self.width
+                first = int(origin)
+            else:
+                first = lasttime - ((length - 1) * interval)
+            count = max(0, min(length - 1, (cutoff - first + interval - 1)/interval))
+
+            # Chunks are scored by their most recent bin.
+            chunks = self.db.zrangebyscore(ckey, "-inf", cutoff - 1)
+            reclaimed = sum(len(c) for c in chunks)
+            pipe = self.db.pipeline(transaction=True)
+            if chunks:
+                log.debug("ZREMRANGEBYSCORE %s -inf %r", ckey, cutoff - 1)
+                pipe.zremrangebyscore(ckey, "-inf", cutoff - 1)
+            if count and self.layout == "packed":
+                reclaimed += count * self.width
+                rest = self.db.getrange(ikey, count * self.width, -1)
+                log.debug("SET %s <%d bins>", ikey, length - count)
+                pipe.set(ikey, rest)
+                pipe.set(okey, first + (count * interval))
+            elif count:
+                log.debug("LRANGE %s %r %r", ikey, -count, -1)
+                reclaimed += sum(len(v) for v in self.db.lrange(ikey, -count, -1))
+                log.debug("LTRIM %s %r %r", ikey, 0, -(count + 1))
+                pipe.ltrim(ikey, 0, -(count + 1))
+            pipe.execute()
+
+        return reclaimed
+
+    def slots(self, interval):
+        """Return the number of bins in a packed ring buffer.
+
+        Returns None for the last (unbounded) interval.
+        """
+        for i, (ival, samples) in enumerate(self.intervals):
+            if ival == interval:
+                if i == len(self.intervals) - 1:
+                    return None
+                return samples + 1
+        raise errors.RecordError("Invalid interval: %r" % interval)
+
+    def unpack(self, istart, istop, interval, lasttime, origin, convert=None,
+            db=None):
+        """Read a range of bins from a packed interval.
+
+        *istart* and *istop* are bin time stamps; *lasttime* and *origin* are
+        the interval's most recent and first bins. The range is read with at
+        most two GETRANGEs (when it wraps around the end of a ring buffer) and
+        decoded with a single :func:`struct.unpack`. Yields (timestamp,
+        value) two-tuples, where each value is passed through *convert*
+        (default: :meth:`Types.Double`). The bins are read from engine *db*
+        (default: :attr:`db`).
+        """
+        log = logger(self)
+        ikey = self.subkey(interval)
+        first, ranges = self.spans(istart, istop, interval, lasttime, int(origin))
+        if not ranges:
+            return
+
+        if db is None:
+            db = self.db
+        pipe = db.pipeline(transaction=False)
+        for begin, end in ranges:
+            log.debug("GETRANGE %s %r %r", ikey, begin, end)
+            pipe.getrange(ikey, begin, end)
+        for item in self.unpacked(''.join(pipe.execute()), first, interval,
+                convert):
+            yield item
+
+    def spans(self, istart, istop, interval, lasttime, origin):
+        """Locate bins *istart* to *istop* of a packed interval (see :meth:`unpack`).
+
+        Returns the time stamp of the first bin stored in the range and a list
+        of (begin, end) byte offsets to read with GETRANGE; the list is empty
+        if none of the bins are stored.
+        """
+        size = self.slots(interval)
+        earliest = origin
+        if size is not None:
+            earliest = max(origin, lasttime - ((size - 1) * interval))
+        istart, istop = max(istart, earliest), min(istop, lasttime)
+        if istart > istop:
+            return istart, []
+
+        first, count = (istart - origin)/interval, (istop - istart)/interval + 1
+        ranges = [(first, count)]
+        if size is not None:
+            first %= size
+            head = min(count, size - first)
+            ranges = [(first, head), (0, count - head)]
+        return istart, [(slot * self.width, ((slot + n) * self.width) - 1)
+            for slot, n in ranges if n]
+
+    def unpacked(self, data, timestamp, interval, convert=None):
+        """Decode packed *data* holding consecutive bins from *timestamp* on."""
+        if convert is None:
+            convert = self.types.Double
+        for value in struct.unpack("<%dd" % (len(data)/self.width), data):
+            if value != value:
+                value = self.unbox(value)
+            else:
+                value = convert(value)
             yield (timestamp, value)
             timestamp += interval
 
-    def record(self, pipeline, data):
+    def pack(self, values):
+        """Pack *values* for storage in the packed layout.
+
+        None is stored as NaN. Integral floats are stored as a NaN with
+        :attr:`boxed` set, the integer in the low bits of its payload and
+        the float's sign in the sign bit; :meth:`unpacked` turns them back
+        into floats.
+        """
+        nan = float("nan")
+        values = [v is None and nan or self.box(v) for v in values]
+        return struct.pack("<%dd" % len(values), *values)
+
+    def box(self, value):
+        """Box *value* in a NaN if it is an integral float (see :meth:`pack`)."""
+        if not isinstance(value, float) or not value.is_integer() or \
+                abs(value) >= self.boxlimit:
+            return value
+        bits = self.boxed | int(abs(value))
+        if str(value).startswith("-"):
+            bits |= 1 << 63
+        return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+    def unbox(self, value):
+        """Return the float boxed in NaN *value*, or None if it isn't boxed."""
+        bits = struct.unpack("<Q", struct.pack("<d", value))[0]
+        if bits & self.boxed != self.boxed:
+            return None
+        value = float(bits & (self.boxlimit - 1))
+        if bits >> 63:
+            value = -value
+        return value
+
+    def record(self, pipeline, data, state=None):
         """Add new data to the series.
 
         *data* is an iterable consisting of two-tuples (timestamp, value).
@@ -399,73 +1811,827 @@ class Records(object):
         All of the updates are queued in the *pipeline*. The caller is
         responsible for locking the relevant keys in the database, creating the
         pipeline and, finally, executing it. This approach allows for atomic
-        updates of both single and multiple values.
+        updates of both single and multiple values. If the caller has already
+        fetched the values of the series' :meth:`statekeys`, it may pass them
+        as *state*.
         """
         if not data:
             return
         log = logger(self)
 
-        nintervals = len(self.intervals) - 1
+        if state is None:
+            lkeys = self.statekeys()
+            log.debug("MGET %r", lkeys)
+            state = self.db.mget(lkeys)
+        self.commit(pipeline, self.prepare(self.convert(data), state))
+
+    def prepare(self, data, state, shared=None):
+        """Compute the changes :meth:`record` makes for converted *data*.
+
+        *state* holds the values of the series' :meth:`statekeys`. Nothing is
+        written, but bins that late points are merged into (see :meth:`late`)
+        are read. *shared* is passed to :meth:`update`, unless the series
+        changes *data* first. Returns the changes, to be queued with
+        :meth:`commit`.
+        """
+        n = len(self.intervals)
+        lasts, counter, patches, dropped = state[:n], None, [], 0
+        if not self.lateness and lasts[0] is not None:
+            lasttime = self.fromlast(lasts[0])[0]
+            dropped = len([x for x in data if x[0] <= lasttime])
+        if self.cf == "rate":
+            data, counter = self.derive(data, state[-1])
+            shared = None
+        if self.lateness:
+            data, lasts, late, dropped = self.late(data, lasts)
+            patches = self.patches(late, lasts, state[n:])
+            shared = None
+        updates = self.update(data, lasts, converted=True, shared=shared)
+        return updates, state[n:], counter, patches, dropped
+
+    def commit(self, pipeline, changes):
+        """Queue the *changes* from :meth:`prepare` in *pipeline*."""
+        log = logger(self)
+        updates, origins, counter, patches, dropped = changes
+        if counter is not None:
+            pipeline.set(self.counterkey(), counter)
+        # Late bins are addressed relative to the current last bins, so they
+        # have to be written before any new bins.
+        for command, key, position, value in patches:
+            log.debug("%s %s %r %r", command.upper(), key, position, value)
+            getattr(pipeline, command)(key, position, value)
+        if dropped:
+            log.debug("INCR %s %r", self.latekey, dropped)
+            pipeline.incr(self.latekey, dropped)
+        self.store(pipeline, updates, origins)
+
+    def late(self, data, lasts):
+        """Separate the points in *data* that arrived after their bins were written.
+
+        *lasts* are the series' current `!last` values (see :meth:`update`).
+        Points more than :attr:`lateness` seconds older than the last bin of
+        the first interval are dropped. In each interval, the rest of the
+        points no newer than the last bin are merged into the `!last` value
+        (if they belong in the last bin) or collected by bin. Returns the
+        (sorted) points to pass to :meth:`update`, the new *lasts*, a
+        {timestamp: values} dictionary of late points for each interval and
+        the number of points dropped.
+        """
+        data = sorted(data, key=operator.itemgetter(0))
+        if lasts[0] is None:
+            return data, lasts, [{} for last in lasts], 0
+
+        watermark = self.fromlast(lasts[0])[0] - self.lateness
+        ontime = [x for x in data if x[0] >= watermark]
+        newlasts, late = [], []
+        for (interval, samples), last in zip(self.intervals, lasts):
+            bins = {}
+            if last is not None:
+                lasttime, lastval, points = self.fromlast(last)
+                for timestamp, value in ontime:
+                    if timestamp > lasttime:
+                        break
+                    bins.setdefault(nearest(timestamp, interval), []).append(value)
+                values = bins.pop(lasttime, None)
+                if values:
+                    last = self.tolast(lasttime, *self.fold(lastval, values, points))
+            newlasts.append(last)
+            late.append(bins)
+        return ontime, newlasts, late, len(data) - len(ontime)
+
+    def fold(self, value, values, points=0):
+        """Merge *values* into a bin holding *value* (and *points* more points).
+
+        Returns the new value and number of points, like :meth:`consolidate`.
+        """
         cfunc = self.cfs[self.cf]
-        dirty = {}
-        lkeys = [self.subkey(i, "last") for i, s in self.intervals]
-        log.debug("MGET %r", lkeys)
-        for i, last in enumerate(self.db.mget(lkeys)):
+        if value is None:
+            value, values, points = values[0], values[1:], 0
+        for v in values:
+            points, value = cfunc(value, v, points)
+            points += 1
+        return value, points
+
+    def patches(self, late, lasts, origins=None):
+        """Merge the *late* points from :meth:`late` into the bins already written.
+
+        The bins are read from :attr:`db`. Returns a list of (command, key,
+        position, value) writes; late points for bins that have been trimmed
+        (or sealed) are ignored.
+        """
+        log = logger(self)
+        bins = []
+        for i, points in enumerate(late):
             interval, samples = self.intervals[i]
-            ikey = self.subkey(interval)
-            lkey = lkeys[i]
+            for timestamp in sorted(points):
+                bins.append((i, interval, timestamp, points[timestamp]))
+        if not bins:
+            return []
+
+        writes = []
+        if self.layout == "packed":
+            for i, interval, timestamp, values in bins:
+                lasttime = self.fromlast(lasts[i])[0]
+                old = list(self.unpack(timestamp, timestamp, interval, lasttime,
+                    origins[i], convert=self.full))
+                if not old:
+                    continue
+                origin, size = int(origins[i]), self.slots(interval)
+                slot = (timestamp - origin)/interval
+                if size is not None:
+                    slot %= size
+                value, points = self.fold(old[0][1], values)
+                writes.append(("setrange", self.subkey(interval),
+                    slot * self.width, self.pack([value])))
+            return writes
+
+        pipe = self.db.pipeline(transaction=False)
+        offsets = []
+        for i, interval, timestamp, values in bins:
+            lasttime = self.fromlast(lasts[i])[0]
+            offset = (lasttime - timestamp)/interval
+            log.debug("LINDEX %s %r", self.subkey(interval), offset)
+            pipe.lindex(self.subkey(interval), offset)
+            offsets.append(offset)
+        for (i, interval, timestamp, values), offset, old in \
+                zip(bins, offsets, pipe.execute()):
+            if old is None:
+                continue
+            value, points = self.fold(self.parse(old), values)
+            writes.append(("lset", self.subkey(interval), offset, value))
+        return writes
+
+    def convert(self, data):
+        """Return a list of validated (timestamp, value) two-tuples from *data*."""
+        return [(self.types.Time(t), self.types.Value(v)) for t, v in data]
+
+    def derive(self, data, counter):
+        """Convert the counter values in *data* to per-second rates.
+
+        *data* is a list of converted (timestamp, value) two-tuples and
+        *counter* the series' last counter (from :meth:`counterkey`), or
+        None. Each value after the first becomes the rate at which the
+        counter grew since the previous one. Values no newer than the last
+        counter are ignored. A counter that goes backwards is taken to have
+        wrapped (see :meth:`wrap`). Returns the rates and the new counter,
+        or None if the counter didn't change.
+        """
+        lasttime, lastval = None, None
+        if counter is not None:
+            lasttime, lastval, points = self.fromlast(counter)
+        rates = []
+        for timestamp, value in data:
+            if value is None or (lasttime is not None and timestamp <= lasttime):
+                continue
+            if lasttime is not None:
+                delta = value - lastval
+                if delta < 0:
+                    delta = self.wrap(lastval, value)
+                rates.append((timestamp, float(delta) / (timestamp - lasttime)))
+            lasttime, lastval = timestamp, value
+        if lasttime is None or (counter is not None and not rates):
+            return rates, None
+        return rates, self.tolast(lasttime, lastval, 0)
+
+    def wrap(self, last, value):
+        """Return how much a counter grew when it dropped from *last* to *value*.
+
+        If *last* fits in 32 (or 64) bits and the counter would have grown by
+        less than half of that range by wrapping around, it's a wrap;
+        otherwise, the counter was reset and grew from zero.
+        """
+        for bits in (32, 64):
+            top = 2 ** bits
+            if last < top:
+                delta = top - last + value
+                if delta < top // 2:
+                    return delta
+                break
+        return value
 
-            lasttime, lastval, lasti = None, None, 0
+    def update(self, data, lasts, converted=False, shared=None):
+        """Consolidate new *data* into each interval.
+
+        *lasts* are the series' current `!last` values, in :attr:`intervals`
+        order. Returns a list with the new (timestamp, value, points) bins
+        for each interval. Nothing is written to the database, so invalid data
+        raises before any updates are queued. If *converted* is True, *data*
+        has already been passed through :meth:`convert`. If *shared* is a
+        dictionary, the bins that *data* falls into are kept there and
+        reused by later calls (for other series) with the same *data* and
+        last bins, so only the cf is applied again (see :class:`Group`).
+        """
+        if not converted:
+            data = self.convert(data)
+        states = []
+        for last in lasts:
+            lasttime, lastval = None, None
             if last is not None:
                 lasttime, lastval, lasti = last.split()
-                lasti = self.types.Number(lasti)
-
-            idata = ((self.types.Time(t), self.types.Value(v)) for t, v in data)
-            if lasttime is not None:
-                notrecent = lambda x: x[0] <= lasttime
                 lasttime = self.types.Time(lasttime)
                 lastval = self.types.Value(lastval)
-                idata = dropwhile(notrecent, idata)
-                idata = chain([(lasttime, lastval)], idata)
-            idata = self.consolidate(idata, interval, cfunc, lasti)
+                self.types.Number(lasti)
+            states.append((lasttime, lastval))
+
+        def since(lasttime, lastval):
+            # The points after an interval's last bin, following that bin.
+            if lasttime is None:
+                return data
+            return list(chain([(lasttime, lastval)],
+                dropwhile(lambda x: x[0] <= lasttime, data)))
+
+        def layout(interval, lasttime, idata):
+            if shared is None:
+                return None
+            key = ("layout", interval, lasttime)
+            if key not in shared:
+                shared[key] = numeric.layout(idata, interval)
+            return shared[key]
+
+        cf = self.folds.get(self.cf, self.cf)
+        if self.vectorize and numeric.numpy is not None:
+            updates = []
+            for (interval, samples), (lasttime, lastval) in \
+                    zip(self.intervals, states):
+                idata = since(lasttime, lastval)
+                updates.append(numeric.consolidate(idata, interval, cf,
+                    bins=idata and layout(interval, lasttime, idata) or None))
+            if None not in updates:
+                return updates
+
+        cfunc = self.cfs[self.cf]
+        if shared is not None:
+            updates = []
+            for (interval, samples), (lasttime, lastval) in \
+                    zip(self.intervals, states):
+                key = ("bins", interval, lasttime)
+                if key not in shared:
+                    shared[key] = self.bins(since(lasttime, lastval), interval)
+                bins = shared[key]
+                if lasttime is not None:
+                    # The last bin's value is the only one that differs.
+                    bins = [(bins[0][0], [lastval] + bins[0][1][1:])] + bins[1:]
+                updates.append(list(self.folded(bins, interval, cfunc)))
+            return updates
+        return [list(self.consolidate(since(*state), interval, cfunc))
+            for (interval, samples), state in zip(self.intervals, states)]
+
+    def bins(self, data, interval):
+        """Group *data* by the bins :meth:`consolidate` would fold them into.
+
+        Returns a list of (timestamp, values) two-tuples for the bins holding
+        points, in order.
+        """
+        bins = []
+        for timestamp, value in data:
+            timestamp = nearest(timestamp, interval)
+            if bins and bins[-1][0] == timestamp:
+                bins[-1][1].append(value)
+                continue
+            if bins and bins[-1][0] > timestamp:
+                raise errors.RecordError(
+                    "Series out of order: %d more recent than %d" % (
+                        bins[-1][0], timestamp))
+            bins.append((timestamp, [value]))
+        return bins
+
+    def folded(self, bins, interval, cfunc, missing=None):
+        """Fold the values of *bins* (see :meth:`bins`) with *cfunc*.
+
+        Yields the same (timestamp, value, points) tuples as
+        :meth:`consolidate`, filling gaps with *missing* values.
+        """
+        lasttime = None
+        for timestamp, values in bins:
+            while lasttime is not None and timestamp - lasttime > interval:
+                lasttime += interval
+                yield (lasttime, missing, 0)
+            value, i = values[0], 0
+            for v in values[1:]:
+                i, value = cfunc(value, v, i)
+                i += 1
+            yield (timestamp, value, i)
+            lasttime = timestamp
+
+    def store(self, pipeline, updates, origins=None):
+        """Queue the consolidated *updates* from :meth:`update` in *pipeline*.
+
+        The packed layout also needs the current *origins* of each interval.
+        """
+        if self.layout == "packed":
+            return self.storepacked(pipeline, updates, origins)
+        log = logger(self)
+        nintervals = len(self.intervals) - 1
+        dirty = {}
+        for i, bins in enumerate(updates):
+            if not bins:
+                continue
+            interval, samples = self.intervals[i]
+            ikey = self.subkey(interval)
 
             # Only remove the possibly redundant first entry if we're actually
             # going to write new data.
-            needspop = True
-            for timestamp, value, points in idata:
-                if needspop:
-                    log.debug("LPOP %s", ikey)
-                    pipeline.lpop(ikey)
-                    needspop = False
-                log.debug("LPUSH %s %r", ikey, value)
-                pipeline.lpush(ikey, value)
-
-            if not needspop:
-                dirty.setdefault("last", [])
-                dirty["last"].append((lkey, self.tolast(timestamp, value, points)))
-                # Don't trim the last interval, letting it grow.
-                if i < nintervals:
-                    log.debug("LTRIM %s %r %r", ikey, 0, samples)
-                    pipeline.ltrim(ikey, 0, samples)
-        last = dirty.get("last", [])
-        if last:
-            last = dict(last)
-            log.debug("MSET %r", last)
-            pipeline.mset(last)
-            pipeline.sadd(self.namespace, "%s %s %s" % (
-                self.subject, self.attribute, self.cf))
+            log.debug("LPOP %s", ikey)
+            pipeline.lpop(ikey)
+            # Bins that would be trimmed right away (during a backfill, say)
+            # aren't sent at all.
+            values = [v for t, v, p in bins]
+            if i < nintervals:
+                values = values[-(samples + 1):]
+            log.debug("LPUSH %s <%d bins>", ikey, len(values))
+            pipeline.lpush(ikey, *values)
+
+            timestamp, value, points = bins[-1]
+            dirty[self.subkey(interval, "last")] = \
+                self.tolast(timestamp, value, points)
+            # Don't trim the last interval, letting it grow.
+            if i < nintervals:
+                log.debug("LTRIM %s %r %r", ikey, 0, samples)
+                pipeline.ltrim(ikey, 0, samples)
+        if dirty:
+            log.debug("MSET %r", dirty)
+            pipeline.mset(dirty)
+            self.register(pipeline)
+
+    def storepacked(self, pipeline, updates, origins):
+        """Queue the consolidated *updates* in the packed layout.
+
+        Each interval's new bins are contiguous, so they're written with a
+        single SETRANGE (or two, if they wrap around the end of a ring
+        buffer).
+        """
+        log = logger(self)
+        dirty = {}
+        for i, bins in enumerate(updates):
+            if not bins:
+                continue
+            interval, samples = self.intervals[i]
+            ikey = self.subkey(interval)
+
+            origin = origins and origins[i] or None
+            if origin is None:
+                origin = bins[0][0]
+                dirty[self.subkey(interval, "origin")] = origin
+            slot = (bins[0][0] - int(origin))/interval
+            values = [v for t, v, p in bins]
+
+            size = self.slots(interval)
+            chunks = [(slot, values)]
+            if size is not None:
+                if len(values) > size:
+                    slot += len(values) - size
+                    values = values[-size:]
+                slot %= size
+                chunks = [(slot, values[:size - slot]), (0, values[size - slot:])]
+            for slot, chunk in chunks:
+                if chunk:
+                    log.debug("SETRANGE %s %r <%d bins>", ikey, slot * self.width,
+                        len(chunk))
+                    pipeline.setrange(ikey, slot * self.width, self.pack(chunk))
+
+            timestamp, value, points = bins[-1]
+            dirty[self.subkey(interval, "last")] = \
+                self.tolast(timestamp, value, points)
+        if dirty:
+            log.debug("MSET %r", dirty)
+            pipeline.mset(dirty)
+            self.register(pipeline)
+
+    def migrate(self, layout):
+        """Atomically convert the series to a different storage *layout*.
+
+        Every bin (and the `!last` keys) are copied at full precision, and
+        the keys used by the current layout are removed. Returns a new
+        :class:`Records` instance using *layout*.
+        """
+        if layout not in self.layouts:
+            raise errors.RecordError("Invalid layout: %s" % layout)
+        if self.types.sketches and layout != "list":
+            raise errors.RecordError("Sketches require the list layout")
+        new = Records(self.subject, self.attribute, self.cf)
+        new.layout = layout
+        if layout == self.layout:
+            return new
+
+        n = len(self.intervals)
+        with self.lock(self.db, self.subkey("lock")):
+            state = self.db.mget(self.statekeys())
+            lasts, origins = state[:n], state[n:]
+            updates = []
+            for i, last in enumerate(lasts):
+                bins = []
+                if last is not None:
+                    interval, samples = self.intervals[i]
+                    origin = origins and origins[i] or None
+                    data = self.dump(interval, self.fromlast(last)[0], origin)
+                    bins = [(t, v, 0) for t, v in data]
+                updates.append(bins)
+
+            pipe = self.db.pipeline(transaction=True)
+            pipe.delete(*self.keys())
+            if [x for x in lasts if x is not None]:
+                new.store(pipe, updates)
+                pipe.mset(dict((self.subkey(i, "last"), last) for (i, s), last \
+                    in zip(self.intervals, lasts) if last is not None))
+            pipe.execute()
+
+        return new
+
+    def dump(self, interval, lasttime, origin=None):
+        """Return every bin in an *interval*, from oldest to most recent.
+
+        Unlike :meth:`select`, the values are returned at full precision.
+        """
+        if self.layout == "packed":
+            return list(self.unpack(0, lasttime, interval, lasttime, origin,
+                convert=self.full))
+
+        data = self.db.lrange(self.subkey(interval), 0, -1)
+        data.reverse()
+        timestamp = lasttime - ((len(data) - 1) * interval)
+        bins = []
+        for value in data:
+            bins.append((timestamp, self.parse(value)))
+            timestamp += interval
+        return bins
+
+    def full(self, value):
+        """Convert a double stored in the packed layout at full precision."""
+        if value != value:
+            return None
+        elif value.is_integer():
+            return int(value)
+        return value
+
+    def parse(self, value):
+        """Convert a *value* stored in the list layout at full precision."""
+        if value == "None":
+            return None
+        elif value.startswith(sketch.Sketch.prefix):
+            return sketch.decode(value)
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
 
     def extend(self, iterable):
         """Atomically extend the series with new values from *iterable*.
 
         Each value is a two-tuple consisting of (timestamp, value) that will be
-        passed to :meth:`record`.
+        passed to :meth:`record`. The :attr:`writer` determines whether the
+        update is made under a client-side :class:`Lock` or by a single call
+        to the server-side :class:`Script` (which requires the list layout).
         """
+        if self.writer == "script":
+            return self.scripted(iterable)
         with self.lock(self.db, self.subkey("lock")):
             pipe = self.db.pipeline(transaction=True)
             self.record(pipe, iterable)
             pipe.execute()
 
+    def scripted(self, iterable, pipeline=None):
+        """Atomically extend the series using the server-side :class:`Script`.
+
+        The consolidation is done by the database in a single round trip;
+        no client-side lock is taken. If *pipeline* is not None, the call is
+        queued there instead of being sent immediately. The members of a
+        :class:`Group` are all written by the same call.
+        """
+        if self.layout != "list":
+            raise errors.RecordError("The script writer requires the list layout")
+        data = [(self.types.Time(t), self.types.Value(v)) for t, v in iterable]
+        if not data:
+            return
+
+        members = getattr(self, "members", [self])
+        keys, args = [], [len(members)]
+        for records in members:
+            args.extend([records.cf, records.member, len(records.intervals)])
+            for interval, samples in records.intervals:
+                keys.extend([records.subkey(interval),
+                    records.subkey(interval, "last")])
+                args.extend([interval, samples])
+            keys.append(records.namespace)
+            keys.extend(records.indexkeys())
+        keys.append(self.latekey)
+        for timestamp, value in data:
+            if isinstance(value, float):
+                value = repr(value)
+            args.extend([timestamp, value])
+        return self.script(self.db, keys, args, client=pipeline)
+
+    @classmethod
+    def bulk(self, series):
+        """Atomically extend many series at once.
+
+        *series* is an iterable of (records, data) two-tuples, where *data*
+        would be passed to :meth:`extend`. Instead of taking a lock and
+        running a pipeline for each series, the series are committed in
+        batches of up to :attr:`batchsize`, each batch costing a constant
+        number of round trips. Each series is updated atomically; a series
+        whose data is rejected doesn't affect the rest of its batch.
+
+        Series stored on different :class:`engines.Shards` are committed in
+        parallel. Returns a list of (records, exception) two-tuples
+        describing the rejected series.
+        """
+        shards = {}
+        for records, data in series:
+            shards.setdefault(id(records.db), []).append((records, data))
+
+        def commit(series):
+            rejected = []
+            for i in xrange(0, len(series), self.batchsize):
+                batch = series[i:i + self.batchsize]
+                locked = [(r, d) for r, d in batch if r.writer != "script"]
+                scripted = [(r, d) for r, d in batch if r.writer == "script"]
+                if locked:
+                    rejected.extend(self.bulklocked(locked))
+                if scripted:
+                    rejected.extend(self.bulkscripted(scripted))
+            return rejected
+
+        return sum(engines.parallel(commit, shards.values()), [])
+
+    @classmethod
+    def bulklocked(self, batch):
+        """Extend a *batch* of series using the lock-based writer.
+
+        The locks for every series in the batch are taken with a single
+        pipeline of SETNX commands and all of the `!last` values are read with
+        one MGET. The updates (and the lock releases) are then committed in a
+        single transaction. Series whose locks are held by another writer fall
+        back to :meth:`extend`.
+        """
+        log = logger(self)
+        rejected, locked, contended, lockkeys, released = [], [], [], [], []
+        db = batch[0][0].db
+
+        expire = time.time() + self.bulkexpire
+        pipe = db.pipeline(transaction=False)
+        for records, data in batch:
+            for key in records.lockkeys():
+                pipe.setnx(key, expire)
+        acquired = iter(pipe.execute())
+        for records, data in batch:
+            keys = records.lockkeys()
+            results = [next(acquired) for key in keys]
+            if all(results):
+                locked.append((records, data))
+                lockkeys.extend(keys)
+            else:
+                contended.append((records, data))
+                released.extend(k for k, r in zip(keys, results) if r)
+        if released:
+            db.delete(*released)
+
+        try:
+            lkeys = []
+            for records, data in locked:
+                lkeys.extend(records.statekeys())
+            log.debug("MGET %r", lkeys)
+            state = lkeys and db.mget(lkeys) or []
+
+            pipe = db.pipeline(transaction=True)
+            offset = 0
+            for records, data in locked:
+                m = len(records.statekeys())
+                rstate, offset = state[offset:offset + m], offset + m
+                try:
+                    records.record(pipe, data, rstate)
+                except records.rejections, e:
+                    rejected.append((records, e))
+            if lockkeys:
+                pipe.delete(*lockkeys)
+            pipe.execute()
+        except:
+            if lockkeys:
+                db.delete(*lockkeys)
+            raise
+
+        for records, data in contended:
+            try:
+                records.extend(data)
+            except records.rejections, e:
+                rejected.append((records, e))
+
+        return rejected
+
+    @classmethod
+    def bulkscripted(self, batch):
+        """Extend a *batch* of series using the scripted writer.
+
+        Each series is updated by its own atomic call to the :class:`Script`;
+        the calls are sent in a single pipeline.
+        """
+        rejected, queued = [], []
+        db = batch[0][0].db
+        pipe = db.pipeline(transaction=False)
+        for records, data in batch:
+            try:
+                records.scripted(data, pipeline=pipe)
+            except records.rejections, e:
+                rejected.append((records, e))
+                continue
+            queued.append(records)
+
+        if queued:
+            for records, result in zip(queued, pipe.execute(raise_on_error=False)):
+                if isinstance(result, Exception):
+                    e = self.script.error(result)
+                    if not isinstance(e, records.rejections):
+                        raise e
+                    rejected.append((records, e))
+
+        return rejected
+
+    @property
+    def rejections(self):
+        """Exceptions raised for invalid data.
+
+        These include the :class:`Types` validation *exception*, if any.
+        """
+        excs = (TypeError, ValueError, errors.RecordError)
+        if self.types.exception is not None:
+            excs += (self.types.exception,)
+        return excs
+
+    def check(self, iterable):
+        """Validate the values from *iterable* like :meth:`extend` would.
+
+        The values are converted, sorted and consolidated on their own (as
+        if the series were empty), but nothing is read or written. Returns
+        the converted (timestamp, value) two-tuples, sorted by time stamp;
+        raises the same exceptions as :meth:`extend` for invalid data.
+        """
+        data = sorted(self.convert(iterable), key=operator.itemgetter(0))
+        if data:
+            self.prepare(data, [None] * len(self.statekeys()))
+        return data
+
+    def queue(self, iterable, pipeline=None):
+        """Queue new values from *iterable* to be recorded by :meth:`drain`.
+
+        The values are validated (see :meth:`check`) but not stored, so
+        queueing them is cheap and takes no lock. Each is appended to the
+        series' raw queue (see :meth:`rawkey`) with the time it was queued,
+        and the series is added to the :attr:`pending` set. If *pipeline* is
+        not None, the updates are queued there instead of being sent
+        immediately.
+        """
+        log = logger(self)
+        now = int(time.time())
+        raw = [self.tolast(t, v, now) for t, v in self.check(iterable)]
+        if not raw:
+            return
+
+        pipe = pipeline
+        if pipe is None:
+            pipe = self.db.pipeline(transaction=True)
+        rkey = self.rawkey()
+        for i in xrange(0, len(raw), 1000):
+            log.debug("RPUSH %s <%d values>", rkey, len(raw[i:i + 1000]))
+            pipe.rpush(rkey, *raw[i:i + 1000])
+        pipe.sadd(self.pending, self.member)
+        if pipeline is None:
+            pipe.execute()
+
+    def locked(self):
+        """Return a context manager holding the series' lock."""
+        return self.lock(self.db, self.subkey("lock"))
+
+    def drain(self):
+        """Record the values waiting in the series' :meth:`queue`.
+
+        The waiting values are sorted by time stamp and recorded (by the
+        :attr:`writer`) in the same transaction that removes them from the
+        queue. Values queued in the meantime are left for the next call. If
+        the transaction fails (for example, because the server-side
+        :class:`Script` rejected the values), they're put back in the queue
+        and the error is raised. Returns the number of values recorded.
+        """
+        log = logger(self)
+        rkey = self.rawkey()
+        with self.locked():
+            log.debug("LRANGE %s 0 -1", rkey)
+            raw = self.db.lrange(rkey, 0, -1)
+            if not raw:
+                return 0
+
+            data = []
+            for value in raw:
+                timestamp, value, queued = value.split()
+                data.append((self.types.Time(timestamp), self.parse(value)))
+            data.sort(key=operator.itemgetter(0))
+
+            pipe = self.db.pipeline(transaction=True)
+            if self.writer == "script":
+                self.scripted(data, pipeline=pipe)
+            else:
+                self.record(pipe, data)
+            log.debug("LTRIM %s %r %r", rkey, len(raw), -1)
+            pipe.ltrim(rkey, len(raw), -1)
+            results = pipe.execute(raise_on_error=False)
+            failed = [r for r in results if isinstance(r, Exception)]
+            if failed:
+                if not isinstance(results[-1], Exception):
+                    self.requeue(raw)
+                raise self.script.error(failed[0])
+        return len(raw)
+
+    def requeue(self, raw):
+        """Put *raw* values (from the series' queue) back at its head."""
+        log = logger(self)
+        rkey = self.rawkey()
+        pipe = self.db.pipeline(transaction=True)
+        for i in xrange(len(raw), 0, -1000):
+            log.debug("LPUSH %s <%d values>", rkey, len(raw[max(0, i - 1000):i]))
+            pipe.lpush(rkey, *reversed(raw[max(0, i - 1000):i]))
+        pipe.execute()
+
+    def quarantine(self):
+        """Set aside the values waiting in the series' queue.
+
+        Called when they can't be recorded (see :func:`tsar.maintenance.work`),
+        so they don't block the workers. The values are moved to the
+        series' :meth:`quarantinekey`, the series is added to the
+        :attr:`quarantined` set and the values are counted in
+        :attr:`quarantinecount`. Returns the number of values set aside.
+        """
+        log = logger(self)
+        rkey, qkey = self.rawkey(), self.quarantinekey()
+        with self.locked():
+            raw = self.db.lrange(rkey, 0, -1)
+            if not raw:
+                return 0
+            pipe = self.db.pipeline(transaction=True)
+            for i in xrange(0, len(raw), 1000):
+                log.debug("RPUSH %s <%d values>", qkey, len(raw[i:i + 1000]))
+                pipe.rpush(qkey, *raw[i:i + 1000])
+            pipe.ltrim(rkey, len(raw), -1)
+            pipe.sadd(self.quarantined, self.member)
+            pipe.incr(self.quarantinecount, len(raw))
+            pipe.execute()
+        return len(raw)
+
+    @classmethod
+    def backlog(self, now=None):
+        """Measure the values waiting to be recorded by :meth:`drain`.
+
+        Returns a dictionary with the number of "series" in the
+        :attr:`pending` set, the number of "values" waiting in their queues
+        and the "lag", the age (in seconds) of the oldest waiting value.
+        """
+        global db
+        if now is None:
+            now = time.time()
+
+        def measure(engine):
+            members = engine.smembers(self.pending)
+            pipe = engine.pipeline(transaction=False)
+            for member in members:
+                rkey = series(*member.split()).rawkey()
+                pipe.llen(rkey)
+                pipe.lindex(rkey, 0)
+            return len(members), pipe.execute()
+
+        waiting, values, queued = 0, 0, []
+        for n, results in engines.parallel(measure, engines.each(db)):
+            waiting += n
+            values += sum(results[::2])
+            queued.extend(int(r.split()[2]) for r in results[1::2] if r is not None)
+        lag = queued and max(0, now - min(queued)) or 0
+        return {"series": waiting, "values": values, "lag": lag}
+
+    @classmethod
+    def dropped(self):
+        """Measure the points dropped for arriving too late (see :attr:`lateness`).
+
+        Returns a dictionary with the lateness "window" (in seconds) and the
+        number of "points" dropped so far.
+        """
+        global db
+        points = sum(int(engine.get(self.latekey) or 0)
+            for engine in engines.each(db))
+        return {"window": self.lateness, "points": points}
+
+    @classmethod
+    def quarantines(self):
+        """Measure the queued values set aside by :meth:`quarantine`.
+
+        Returns a dictionary with the number of "series" in the
+        :attr:`quarantined` set and the number of "values" set aside so far.
+        """
+        global db
+        series = values = 0
+        for engine in engines.each(db):
+            pipe = engine.pipeline(transaction=False)
+            count, total = pipe.scard(self.quarantined).get(
+                self.quarantinecount).execute()
+            series += count
+            values += int(total or 0)
+        return {"series": series, "values": values}
+
     def append(self, value):
         """Atomically append a new *value* to the series.
 
@@ -473,3 +2639,117 @@ class Records(object):
         passed to :meth:`record`.
         """
         self.extend([value])
+
+class Group(Records):
+    """Several series sharing a stream of raw values.
+
+    A group is named like a :class:`Records` instance, but its *cf* joins
+    several consolidation functions with :attr:`delim` (for example,
+    "ave+max+min"). New values are validated once and recorded into every
+    member series (see :attr:`members`) in a single atomic commit; queued
+    values are stored and drained once for the whole group.
+    """
+    delim = "+"
+
+    def __init__(self, subject, attribute, cf, exception=None, excs=None):
+        cfs = cf.split(self.delim)
+        if len(set(cfs)) != len(cfs):
+            raise errors.RecordError("Duplicate cf: %s" % cf)
+        cfs.sort()
+        self.members = [Records(subject, attribute, c, exception=exception,
+            excs=excs) for c in cfs]
+        super(Group, self).__init__(subject, attribute, cfs[0],
+            exception=exception, excs=excs)
+        self.cf = self.delim.join(cfs)
+        # Groups take raw numbers, even if one of the members is a sketch.
+        self.types.sketches = False
+        if "lock" in [r.writer for r in self.members]:
+            self.writer = "lock"
+
+    def getdb(self):
+        return self.__dict__.get("db")
+
+    def setdb(self, db):
+        self.__dict__["db"] = db
+        for records in self.members:
+            records.db = db
+
+    db = property(getdb, setdb,
+        doc="The engine holding the group (and all of its members).")
+
+    def keys(self):
+        for records in self.members:
+            for key in records.keys():
+                yield key
+
+    def lockkeys(self):
+        return [r.subkey("lock") for r in self.members]
+
+    def statekeys(self):
+        return sum([r.statekeys() for r in self.members], [])
+
+    def locked(self):
+        """Return a context manager holding the locks of every member."""
+        return nested(*[self.Lock()(self.db, k) for k in self.lockkeys()])
+
+    def record(self, pipeline, data, state=None):
+        """Add new data to every member series (see :meth:`Records.record`).
+
+        The data is converted and binned once for the whole group; each
+        member only folds the bins with its own cf.
+        """
+        if not data:
+            return
+        if state is None:
+            state = self.db.mget(self.statekeys())
+        data = self.convert(data)
+
+        changes, offset, shared = [], 0, {}
+        for records in self.members:
+            m = len(records.statekeys())
+            rstate, offset = state[offset:offset + m], offset + m
+            changes.append((records, records.prepare(data, rstate, shared)))
+        # Count the points dropped by the group once, not once per member.
+        dropped = max(prepared[-1] for records, prepared in changes)
+        for records, prepared in changes:
+            records.commit(pipeline, prepared[:-1] + (0,))
+        if dropped:
+            pipeline.incr(self.latekey, dropped)
+
+    def extend(self, iterable):
+        """Atomically extend every member series with *iterable*."""
+        if self.writer == "script":
+            return self.scripted(iterable)
+        with self.locked():
+            pipe = self.db.pipeline(transaction=True)
+            self.record(pipe, iterable)
+            pipe.execute()
+
+    def check(self, iterable):
+        """Validate the values from *iterable* for every member series."""
+        data = sorted(self.convert(iterable), key=operator.itemgetter(0))
+        shared = {}
+        if data:
+            for records in self.members:
+                records.prepare(data, [None] * len(records.statekeys()), shared)
+        return data
+
+    def delete(self):
+        """Remove every member series (and the group's queue) from the database."""
+        for records in self.members:
+            records.delete()
+        pipe = self.db.pipeline(transaction=True)
+        pipe.delete(self.rawkey(), self.quarantinekey())
+        pipe.srem(self.pending, self.member)
+        pipe.srem(self.quarantined, self.member)
+        pipe.execute()
+
+def series(subject, attribute, cf, **kwargs):
+    """Return the series named by *subject*, *attribute* and *cf*.
+
+    If *cf* names several consolidation functions (see :attr:`Group.delim`),
+    returns a :class:`Group`; otherwise, a :class:`Records` instance.
+    """
+    if Group.delim in cf:
+        return Group(subject, attribute, cf, **kwargs)
+    return Records(subject, attribute, cf, **kwargs)
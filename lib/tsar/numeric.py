@@ -0,0 +1,285 @@
+"""\
+Vectorized consolidation
+------------------------
+
+Consolidate (timestamp, value) series with NumPy, producing the same bins as
+:meth:`tsar.model.Records.consolidate`. Time stamps are binned with integer
+arithmetic and each bin is reduced at once (with :func:`numpy.minimum.reduceat`
+and friends) instead of calling the consolidation function for every point.
+
+    >>> data = [(60 * i, i) for i in range(6)]
+    >>> consolidate(data, 120, "add")
+    [(0, 1, 1), (120, 5, 1), (240, 9, 1)]
+
+Bins of several series are combined the same way (see
+:meth:`tsar.model.Records.aggregate`):
+
+    >>> aggregate([[(0, 1), (60, 2)], [(60, 3.5), (120, None)]], "sum")
+    [(0, 1), (60, 5.5), (120, None)]
+
+Long series are downsampled with Largest-Triangle-Three-Buckets (see
+:func:`tsar.util.lttb`) by computing whole buckets at once, too.
+
+If NumPy isn't installed, :data:`numpy` is None and the callers should use
+the generator instead.
+"""
+
+try:
+    import numpy
+except ImportError: # pragma: nocover
+    numpy = None
+
+from . import errors
+
+__all__ = ["aggregate", "consolidate", "layout", "lttb", "numpy"]
+
+cfs = ("ave", "min", "max", "first", "last", "add", "sub")
+"""Consolidation functions that can be vectorized."""
+exact = 2 ** 52
+"""Integers smaller than this (in sum) are handled exactly as doubles."""
+bucketsize = 16
+"""Minimum average number of points in each bucket for :func:`lttb` to pay off."""
+
+def layout(data, interval):
+    """Bin the time stamps of *data* into bins *interval* seconds wide.
+
+    Returns the rounded time stamps and the first index, last index and
+    number of points of each bin, as arrays that :func:`consolidate` can
+    reuse for any series with the same time stamps. Raises
+    :class:`errors.RecordError` if the time stamps go backwards.
+    """
+    # Round each time stamp to the nearest interval, like util.nearest().
+    t = numpy.fromiter((x for x, _ in data), numpy.int64, len(data))
+    distance = t % interval
+    distance[distance > (interval // 2)] -= interval
+    t -= distance
+
+    backwards = numpy.flatnonzero(t[1:] < t[:-1])
+    if len(backwards):
+        k = backwards[0]
+        raise errors.RecordError("Series out of order: %d more recent than %d" %
+            (t[k], t[k + 1]))
+
+    starts = numpy.flatnonzero(numpy.r_[True, t[1:] != t[:-1]])
+    ends = numpy.r_[starts[1:], len(t)] - 1
+    return t, starts, ends, ends - starts + 1
+
+def consolidate(data, interval, cf, missing=None, bins=None):
+    """Consolidate *data* into bins *interval* seconds wide.
+
+    *data* is a sequence of (timestamp, value) two-tuples with increasing
+    timestamps, and *cf* the name of one of :attr:`Records.cfs
+    <tsar.model.Records.cfs>`. Gaps between the bins are filled with
+    *missing* values. *bins* is the :func:`layout` of *data*, if it's
+    already known. Returns a list of (timestamp, value, points) tuples,
+    or None if the values can't be consolidated exactly (for example,
+    because they include None, NaN or very large integers, or because *cf*
+    isn't one of the :data:`cfs`).
+    """
+    if cf not in cfs:
+        return None
+    if not data:
+        return []
+    values = [x for _, x in data]
+    try:
+        v = numpy.array(values, dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if not numpy.isfinite(v).all():
+        return None
+    isfloat = numpy.fromiter((type(x) is float for x in values), bool, len(v))
+    if numpy.abs(v[~isfloat]).sum() >= exact:
+        return None
+
+    if bins is None:
+        bins = layout(data, interval)
+    t, starts, ends, counts = bins
+
+    if cf in ("first", "last"):
+        index = starts if cf == "first" else ends
+        result = [values[k] for k in index]
+    elif cf in ("min", "max"):
+        # Keep the first of equal values, just like min() and max().
+        reduce = numpy.minimum if cf == "min" else numpy.maximum
+        best = numpy.repeat(reduce.reduceat(v, starts), counts)
+        hits = numpy.flatnonzero(v == best)
+        first = numpy.r_[True, t[hits][1:] != t[hits][:-1]]
+        result = [values[k] for k in hits[first]]
+    else:
+        result = arithmetic(v, isfloat, values, starts, counts, cf)
+
+    if cf == "ave":
+        points = numpy.where(counts > 1, counts, 0)
+    else:
+        points = counts - 1
+
+    bins = t[starts].tolist()
+    points = points.tolist()
+    if bins[-1] - bins[0] == interval * (len(bins) - 1):
+        return zip(bins, result, points)
+
+    # Fill the gaps between the bins.
+    filled = []
+    lasttime = bins[0]
+    for timestamp, value, i in zip(bins, result, points):
+        while timestamp - lasttime > interval:
+            lasttime += interval
+            filled.append((lasttime, missing, 0))
+        filled.append((timestamp, value, i))
+        lasttime = timestamp
+    return filled
+
+def arithmetic(v, isfloat, values, starts, counts, cf):
+    """Fold each bin with an arithmetic *cf* (ave, add or sub).
+
+    Integer bins are reduced exactly with :func:`numpy.add.reduceat`. Bins
+    with floats are folded one position at a time across all of the bins
+    (in the same order as the generator) so that rounding matches too.
+    """
+    floats = numpy.logical_or.reduceat(isfloat, starts)
+    if cf != "ave" and not floats.any():
+        i = numpy.asarray(v, dtype=numpy.int64)
+        total = numpy.add.reduceat(i, starts)
+        if cf == "sub":
+            total = 2 * i[starts] - total
+        return total.tolist()
+
+    # Visit the bins from the longest to the shortest, so the bins that are
+    # still being folded at each position are always a prefix.
+    order = numpy.argsort(-counts, kind="mergesort")
+    length, first = counts[order], starts[order]
+    acc = v[first]
+    for k in xrange(1, length[0]):
+        n = numpy.searchsorted(-length, -k)
+        y = v[first[:n] + k]
+        if cf == "ave":
+            acc[:n] += (y - acc[:n]) / (k + 1)
+        elif cf == "add":
+            acc[:n] += y
+        else:
+            acc[:n] -= y
+    result = numpy.empty_like(acc)
+    result[order] = acc
+
+    single = counts == 1
+    if cf == "ave":
+        keep = single
+    else:
+        keep = single | ~floats
+    out = result.tolist()
+    for k in numpy.flatnonzero(keep):
+        out[k] = values[starts[k]] if single[k] else int(out[k])
+    return out
+
+def aggregate(data, operator):
+    """Combine the aligned bins of several series with *operator*.
+
+    *data* is a list of lists of (timestamp, value) two-tuples, and
+    *operator* one of :attr:`Records.aggregates
+    <tsar.model.Records.aggregates>` or a percentile (like "p95"). The series
+    are laid out in a matrix (with NaN for missing values) and each column
+    is reduced at once. Returns the same list of (timestamp, value)
+    two-tuples as :func:`tsar.model.combine`, or None if the values can't
+    be combined exactly (for example, because they include sketches or very
+    large integers).
+    """
+    series = [d for d in data if d]
+    if not series:
+        return []
+    values = [x for d in series for _, x in d]
+    present = numpy.fromiter((x is not None for x in values), bool, len(values))
+    try:
+        v = numpy.array([x for x in values if x is not None], dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if v.ndim != 1 or not numpy.isfinite(v).all():
+        return None
+    isfloat = numpy.zeros(len(values), bool)
+    isfloat[present] = [type(x) is float for x in values if x is not None]
+
+    # Lay the series out in rows, with a column for each time stamp.
+    t = numpy.fromiter((x for d in series for x, _ in d), numpy.int64, len(values))
+    columns, position = numpy.unique(t, return_inverse=True)
+    row = numpy.repeat(numpy.arange(len(series)), [len(d) for d in series])
+    shape = (len(series), len(columns))
+    matrix = numpy.full(shape, numpy.nan)
+    matrix[row[present], position[present]] = v
+    floats = numpy.zeros(shape, bool)
+    floats[row, position] = isfloat
+
+    counts = (~numpy.isnan(matrix)).sum(axis=0)
+    timestamps = columns.tolist()
+    if operator == "count":
+        return zip(timestamps, counts.tolist())
+
+    empty = counts == 0
+    anyfloat = floats.any(axis=0)
+    if operator in ("sum", "avg"):
+        if numpy.nansum(numpy.abs(numpy.where(floats, 0, matrix)), axis=0).max() >= exact:
+            return None
+        result = numpy.nansum(matrix, axis=0)
+        if operator == "avg":
+            result = result / numpy.where(empty, 1, counts)
+            anyfloat[:] = True
+    elif operator in ("min", "max"):
+        # Keep the first of equal values, just like min() and max().
+        fill, pick = (numpy.inf, numpy.argmin) if operator == "min" else \
+            (-numpy.inf, numpy.argmax)
+        best = pick(numpy.where(numpy.isnan(matrix), fill, matrix), axis=0)
+        result = matrix[best, numpy.arange(len(columns))]
+        anyfloat = floats[best, numpy.arange(len(columns))]
+    else:
+        q = float(operator[1:])
+        result = numpy.zeros(len(columns))
+        full = ~empty
+        if full.any():
+            result[full] = numpy.nanpercentile(matrix[:, full], q, axis=0,
+                interpolation="linear")
+        anyfloat[:] = True
+
+    out = result.tolist()
+    for k in numpy.flatnonzero(empty | ~anyfloat):
+        out[k] = None if empty[k] else int(out[k])
+    return zip(timestamps, out)
+
+def lttb(data, points):
+    """Downsample *data* like :func:`tsar.util.lttb`.
+
+    The averages of all of the buckets are computed at once; only the
+    choice of each bucket's point (which depends on the previous one) loops,
+    over whole buckets. Returns None if the values aren't all numbers, or
+    if the buckets would hold fewer than :data:`bucketsize` points on
+    average (:func:`tsar.util.lttb` is faster then).
+    """
+    if len(data) < bucketsize * points:
+        return None
+    data = [x for x in data if x[1] is not None]
+    try:
+        v = numpy.fromiter((y for _, y in data), float, len(data))
+    except (TypeError, ValueError):
+        return None
+    if not numpy.isfinite(v).all():
+        return None
+    t = numpy.fromiter((x for x, _ in data), float, len(data))
+    n = len(data)
+    if points >= n:
+        return data
+    if points < 3:
+        return [data[0], data[-1]][:points]
+
+    every = float(n - 2) / (points - 2)
+    bounds = numpy.minimum((numpy.arange(points) * every).astype(int) + 1, n)
+    counts = numpy.diff(bounds)
+    cx = numpy.add.reduceat(t, bounds[1:-1]) / counts[1:]
+    cy = numpy.add.reduceat(v, bounds[1:-1]) / counts[1:]
+
+    a, kept = 0, [data[0]]
+    for i in xrange(points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        ax, ay = t[a], v[a]
+        areas = numpy.abs((ax - cx[i]) * (v[start:end] - ay) -
+            (ax - t[start:end]) * (cy[i] - ay))
+        a = start + int(numpy.argmax(areas))
+        kept.append(data[a])
+    kept.append(data[-1])
+    return kept
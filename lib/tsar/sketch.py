@@ -0,0 +1,236 @@
+"""\
+Quantile sketches
+-----------------
+
+Summarize distributions with the mergeable sketch described in "DDSketch: A
+Fast and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees"
+(Masson et al, VLDB 2019). Each value is counted in a bucket whose width grows
+with its magnitude, so every quantile is estimated within a relative
+:attr:`Sketch.accuracy` of the true value, and sketches merge exactly by adding
+their counts.
+
+    >>> sketch = Sketch.of(range(1, 101))
+    >>> round(sketch.quantile(0.99))
+    99.0
+    >>> decode(encode(sketch)) == sketch
+    True
+"""
+
+import math
+
+__all__ = ["Sketch", "decode", "encode", "merge", "quantile"]
+
+class Sketch(object):
+    """A mergeable summary of a distribution of values."""
+
+    accuracy = 0.01
+    """Relative accuracy of the estimated quantiles."""
+    gamma = (1 + accuracy) / (1 - accuracy)
+    lngamma = math.log(gamma)
+    maxbins = 512
+    """Maximum number of buckets on either side of zero.
+
+    When a sketch grows past this, its lowest buckets are collapsed together,
+    which only affects the accuracy of the values closest to zero.
+    """
+    tiny = 1e-9
+    """Values smaller (in magnitude) than this are counted as zero."""
+    prefix = "dd:"
+    """Prefix of encoded sketches (see :func:`encode`)."""
+
+    def __init__(self):
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def of(cls, values):
+        """Return a new sketch of the numbers in *values*."""
+        sketch = cls()
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+    def __eq__(self, other):
+        if not isinstance(other, Sketch):
+            return False
+        return encode(self) == encode(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return encode(self)
+    __str__ = __repr__
+
+    def key(self, value):
+        """Return the key of the bucket counting (positive) *value*."""
+        return int(math.ceil(math.log(value) / self.lngamma))
+
+    def estimate(self, key):
+        """Return the value represented by bucket *key*."""
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        """Count a number *value* *count* times."""
+        if value > self.tiny:
+            store, key = self.positive, self.key(value)
+        elif value < -self.tiny:
+            store, key = self.negative, self.key(-value)
+        else:
+            store, key = None, None
+            self.zero += count
+        if store is not None:
+            store[key] = store.get(key, 0) + count
+            if len(store) > self.maxbins:
+                self.collapse(store)
+        self.count += count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        return self
+
+    def merge(self, other):
+        """Add the counts of sketch *other* to this one."""
+        if not other.count:
+            return self
+        for store, ostore in ((self.positive, other.positive),
+                (self.negative, other.negative)):
+            for key, count in ostore.iteritems():
+                store[key] = store.get(key, 0) + count
+            if len(store) > self.maxbins:
+                self.collapse(store)
+        self.zero += other.zero
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        return self
+
+    def update(self, value):
+        """Merge *value* (a number, a :class:`Sketch` or None) into the sketch."""
+        if value is None:
+            return self
+        elif isinstance(value, Sketch):
+            return self.merge(value)
+        return self.add(value)
+
+    def collapse(self, store):
+        """Fold the lowest buckets of *store* into the lowest one kept."""
+        keys = sorted(store)
+        excess = len(keys) - self.maxbins
+        floor = keys[excess]
+        store[floor] += sum(store.pop(k) for k in keys[:excess])
+
+    def quantile(self, q):
+        """Return the estimated *q* quantile (0 <= *q* <= 1) of the values.
+
+        Returns None if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = 0
+        value = self.max
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                value = -self.estimate(key)
+                break
+        else:
+            seen += self.zero
+            if seen > rank:
+                value = 0
+            else:
+                for key in sorted(self.positive):
+                    seen += self.positive[key]
+                    if seen > rank:
+                        value = self.estimate(key)
+                        break
+        return min(max(value, self.min), self.max)
+
+def number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def parse(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+def encode(sketch):
+    """Return a compact string holding *sketch*.
+
+    The string has no spaces. The buckets on either side of zero are listed
+    as "<key>x<count>" items, where each key is stored as the distance from
+    the previous one.
+    """
+    stores = []
+    for store in (sketch.positive, sketch.negative):
+        items, last = [], 0
+        for key in sorted(store):
+            items.append("%dx%d" % (key - last, store[key]))
+            last = key
+        stores.append(','.join(items))
+    if not sketch.count:
+        return sketch.prefix
+    return "%s%s:%s:%d:%s:%s" % (sketch.prefix, number(sketch.min),
+        number(sketch.max), sketch.zero, stores[0], stores[1])
+
+def decode(value):
+    """Return the :class:`Sketch` encoded in string *value*.
+
+    Raises ValueError if *value* isn't an encoded sketch.
+    """
+    if not value.startswith(Sketch.prefix):
+        raise ValueError("Invalid sketch: %r" % value)
+    sketch = Sketch()
+    value = value[len(Sketch.prefix):]
+    if not value:
+        return sketch
+    try:
+        smin, smax, zero, positive, negative = value.split(':')
+        sketch.min, sketch.max, sketch.zero = parse(smin), parse(smax), int(zero)
+        sketch.count = sketch.zero
+        for store, items in ((sketch.positive, positive),
+                (sketch.negative, negative)):
+            key = 0
+            for item in filter(None, items.split(',')):
+                delta, count = item.split('x')
+                key += int(delta)
+                store[key] = int(count)
+                sketch.count += store[key]
+    except ValueError:
+        raise ValueError("Invalid sketch: %r" % value)
+    return sketch
+
+def merge(x, y, i):
+    """Merge *y* into *x*, where each is a number, a :class:`Sketch` or None.
+
+    This is the "sketch" consolidation function (see
+    :attr:`tsar.model.Records.cfs`). *x* is only changed in place when *i* is
+    not zero (that is, when an earlier call returned it); otherwise, a new
+    sketch is returned. Bins with only missing values stay None.
+    """
+    if i == 0 or not isinstance(x, Sketch):
+        x = Sketch().update(x)
+    x.update(y)
+    return (i, x.count and x or None)
+
+def quantile(value, q):
+    """Return the *q* quantile of *value* (a number, a :class:`Sketch` or None)."""
+    if isinstance(value, Sketch):
+        return value.quantile(q)
+    return value
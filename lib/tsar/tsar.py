@@ -28,9 +28,16 @@ def run():
     tsar = Tsar(commands={
         "clean": manage.Clean,
         "collect": Collect,
+        "consolidate": manage.Consolidate,
+        "import": manage.Import,
         "last": manage.Last,
+        "migrate": manage.Migrate,
+        "rebalance": manage.Rebalance,
         "record": manage.Record,
+        "reindex": manage.Reindex,
+        "seal": manage.Seal,
         "serve": Serve,
+        "sweep": manage.Sweep,
     })
     tsar.run()
 
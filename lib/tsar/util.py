@@ -1,6 +1,7 @@
 import functools
 import logging
 import operator
+import sre_parse
 import sys
 
 try:
@@ -100,6 +101,7 @@ def parsedsn(dsnstring, **defaults):
         if ':' in user:
             user, _, dsn["password"] = user.partition(':')
         dsn["user"] = user
+    host = rest
     if '/' in rest:
         host, _, dsn["database"] = rest.partition('/')
     if ':' in host:
@@ -110,6 +112,47 @@ def parsedsn(dsnstring, **defaults):
 
     return dsn
 
+def parseschema(schema):
+    """Parse a retention *schema* like "<pattern>=<interval>:<samples>,...".
+
+    Returns a (pattern, intervals) two-tuple for :attr:`Records.schemas
+    <tsar.model.Records.schemas>`. Raises ValueError if the intervals aren't
+    positive and increasing.
+    """
+    pattern, _, rest = schema.rpartition("=")
+    if not pattern:
+        raise ValueError("missing pattern: %r" % schema)
+    intervals = []
+    for chunk in rest.split(","):
+        interval, _, samples = chunk.partition(":")
+        intervals.append((int(interval), int(samples)))
+    for i, (interval, samples) in enumerate(intervals):
+        if interval <= 0 or samples <= 0:
+            raise ValueError("invalid interval: %d:%d" % (interval, samples))
+        if i and interval <= intervals[i - 1][0]:
+            raise ValueError("intervals must increase: %r" % schema)
+    return pattern, intervals
+
+def literal(pattern):
+    """Return the prefix of every string matched by regular expression *pattern*.
+
+    Only the literal characters at the start of *pattern* count, so the
+    prefix may be shorter than necessary (or empty), never longer.
+    """
+    parsed = sre_parse.parse(pattern)
+    if parsed.pattern.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return ""
+    prefix = []
+    for op, arg in parsed:
+        if op != sre_parse.LITERAL:
+            break
+        prefix.append(chr(arg))
+    return "".join(prefix)
+
+def wildcard(pattern):
+    """Return True if glob *pattern* (see :mod:`fnmatch`) contains wildcards."""
+    return any(c in pattern for c in "*?[")
+
 def nearest(value, interval):
     """Round *value* to the nearest value evenly divisible by *interval*."""
     distance = value % interval
@@ -134,6 +177,67 @@ def trim(s, subs, reverse=False):
 
 rtrim = functools.partial(trim, reverse=True)
 
+# Downsampling to a number of points.
+
+def lttb(data, points):
+    """Downsample *data* to *points* points with Largest-Triangle-Three-Buckets.
+
+    *data* is a sequence of (timestamp, value) tuples. Points with None values
+    are dropped. The first and last points are kept, and the rest are split
+    into *points* - 2 buckets; each bucket keeps the point forming the
+    largest triangle with the point kept from the previous bucket and the
+    average of the next one, which preserves the shape of the series.
+    """
+    data = [x for x in data if x[1] is not None]
+    n = len(data)
+    if points >= n:
+        return data
+    if points < 3:
+        return [data[0], data[-1]][:points]
+
+    every = float(n - 2) / (points - 2)
+    a, kept = 0, [data[0]]
+    for i in xrange(points - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        after = data[end:min(int((i + 2) * every) + 1, n)]
+        cx = sum(float(t) for t, v in after) / len(after)
+        cy = sum(float(v) for t, v in after) / len(after)
+        ax, ay = data[a]
+        best, area = start, -1
+        for k in xrange(start, end):
+            x, y = data[k]
+            size = abs((ax - cx) * (y - ay) - (ax - x) * (cy - ay))
+            if size > area:
+                best, area = k, size
+        a = best
+        kept.append(data[a])
+    kept.append(data[-1])
+    return kept
+
+def minmax(data, points):
+    """Downsample *data* to at most *points* points, keeping extremes.
+
+    *data* is a sequence of (timestamp, value) tuples. Points with None values
+    are dropped. The rest are split into *points*/2 buckets, and each bucket
+    keeps its (first) minimum and maximum, in order.
+    """
+    data = [x for x in data if x[1] is not None]
+    n = len(data)
+    if points >= n:
+        return data
+    if points < 2:
+        return data[:points]
+
+    buckets = points / 2
+    kept = []
+    for i in xrange(buckets):
+        start, end = (i * n) / buckets, ((i + 1) * n) / buckets
+        values = [v for t, v in data[start:end]]
+        low = start + values.index(min(values))
+        high = start + values.index(max(values))
+        kept.extend(data[k] for k in sorted(set([low, high])))
+    return kept
+
 # Various filters for numerical differentiation.
 
 # N-point stencils (see eg http://www.holoborodko.com/pavel/?page_id=239)
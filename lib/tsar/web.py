@@ -11,6 +11,8 @@ except ImportError:
     mimetypes = None
 
 from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from urllib2 import quote, unquote
 
 from neat import neat
@@ -19,7 +21,8 @@ from . import errors, model
 from .commands import DBMixin, DaemonizingSubCommand
 from .commands import (
     Application, CommandLineMixin, DaemonizingMixin, LoggingMixin)
-from .util import Decorator, adiff, derive, differentiators, json, parsedsn, trim
+from .util import (Decorator, adiff, derive, differentiators, json, lttb,
+    minmax, parsedsn, trim, wildcard)
 
 __all__ = ["Records", "service"]
 
@@ -50,6 +53,10 @@ class AllRecords(neat.Resource):
         "accept": "_accept",
         "content-type": "_content",
     }
+    bulk = True
+    """If True, record all of the series in a request with :meth:`model.Records.bulk`."""
+    queue = False
+    """If True, :meth:`model.Records.queue` new data for the consolidation workers."""
     filters = {
         "skipnull": lambda r: (x for x in r if x[1] is not None),
         "derive": derive,
@@ -57,6 +64,22 @@ class AllRecords(neat.Resource):
     for name, ds in differentiators.items():
         for n in ds:
             filters["%s-%d" % (name, n)] = partial(adiff, points=n, fxns=ds)
+    downsamplers = {
+        "lttb": (model.numeric.lttb, lttb),
+        "minmax": (None, minmax),
+    }
+    """Ways to reduce each series to maxpoints= points (see :meth:`downsample`).
+
+    Each maps to a vectorized function (which may return None if it can't
+    handle the data) and a pure Python one.
+    """
+
+    @neat.wsgify
+    def __call__(self, req):
+        try:
+            return super(AllRecords, self).__call__(req)
+        except errors.PoolError, e:
+            raise errors.HTTPServiceUnavailable(e.args[0])
 
     def decodeid(self, id):
         return tuple(unquote(id.encode("utf8")).split('/'))
@@ -82,19 +105,68 @@ class AllRecords(neat.Resource):
         if not content:
             raise errors.HTTPBadRequest("No data")
 
+        series = []
         for key, data in content.items():
             try:
                 subject, attribute, cf = key
-                records = model.Records(subject, attribute, cf, 
+                records = model.series(subject, attribute, cf,
                     exception=errors.HTTPBadRequest)
             except (TypeError, ValueError):
                 raise errors.HTTPBadRequest("Invalid resource id")
-            self.extend(records, data)
+            series.append((records, data))
+
+        if self.queue:
+            rejected, pipes = [], {}
+            for records, data in series:
+                pipe = pipes.setdefault(id(records.db),
+                    records.db.pipeline(transaction=True))
+                try:
+                    records.queue(data, pipeline=pipe)
+                except records.rejections, e:
+                    rejected.append((records, e))
+            model.engines.parallel(lambda p: p.execute(), pipes.values())
+            self.reject(rejected)
+            raise errors.HTTPAccepted("Records queued")
+        elif not self.bulk:
+            for records, data in series:
+                self.extend(records, data)
+        else:
+            self.reject(model.Records.bulk(series))
 
         raise errors.HTTPNoContent("Records created")
 
+    def reject(self, rejected):
+        """Report the series rejected by :meth:`model.Records.bulk`.
+
+        The rest of the series in the request have already been recorded. If
+        any of the rejected series contained bad data, the response is a Bad
+        Request; otherwise, it's a Conflict.
+        """
+        if not rejected:
+            return
+
+        status = errors.HTTPConflict
+        reasons = []
+        for records, e in sorted(rejected, key=lambda x: x[0].member):
+            if not isinstance(e, errors.RecordError):
+                status = errors.HTTPBadRequest
+            reason = e.args and e.args[0] or "Bad data"
+            reasons.append("%s (%s)" % (self.encodeid(records), reason))
+        raise status("Rejected %d series: %s" % (len(reasons), "; ".join(reasons)))
+
     def _get(self, **base):
         filters = [f for f in self.req.GET.pop("filters", "").split(',') if f]
+        maxpoints = self.req.GET.pop("maxpoints", None)
+        method = self.req.GET.pop("downsample", "lttb")
+        if maxpoints is not None:
+            try:
+                maxpoints = int(maxpoints)
+                if maxpoints < 2:
+                    raise ValueError(maxpoints)
+            except ValueError:
+                raise errors.HTTPBadRequest("Invalid maxpoints: %r" % maxpoints)
+        if method not in self.downsamplers:
+            raise errors.HTTPBadRequest("Invalid downsample method: %r" % method)
         queries = []
         query = base.copy()
         for k, v in self.req.params.items():
@@ -112,21 +184,117 @@ class AllRecords(neat.Resource):
         if query:
             queries.append(query)
 
-        data = {}
+        # Every series in the request is read in one batch, which costs a
+        # constant number of round trips per shard (see model.Records.fetch).
+        # Wildcard queries match series in the indexes; aggregate queries
+        # combine their matches into a single series.
+        planned, aggregated = [], []
         for query in queries:
             subject, attribute, cf = \
                 [query.pop(x, None) for x in "subject attribute cf".split()]
+            now = query.pop("now", None)
+            operator = query.pop("aggregate", None)
+            if operator or any(wildcard(x) for x in (subject, attribute, cf) if x):
+                try:
+                    matches = model.Records.glob(subject, attribute, cf)
+                except errors.RecordError, e:
+                    raise errors.HTTPBadRequest(e.args[0])
+                for records in matches:
+                    records.types.exception = errors.HTTPBadRequest
+                    records.types.now = now
+                    if not operator:
+                        planned.append((records, query))
+                if operator:
+                    key = self.encodeid(subject, attribute or "*",
+                        "%s(%s)" % (operator, cf or "*"))
+                    aggregated.append((key, operator, matches, query))
+                continue
             records = model.Records(subject, attribute, cf, 
                 exception=errors.HTTPBadRequest)
-            records.types.now = query.pop("now", None)
-            result = records.query(**query)
-            if filters:
-                try:
-                    result = self.filter(result, filters)
-                except KeyError, e:
-                    raise errors.HTTPBadRequest("Invalid filter: %r" % e.args[0])
-            data[self.encodeid(records)] = list(result)
+            records.types.now = now
+            planned.append((records, query))
+
+        def refine(result):
+            if not filters:
+                return result
+            try:
+                return self.filter(result, filters)
+            except KeyError, e:
+                raise errors.HTTPBadRequest("Invalid filter: %r" % e.args[0])
+
+        def output(result, stitched=False):
+            if stitched:
+                # Filter each segment on its own (the filters expect evenly
+                # spaced points), then downsample the whole series and tag
+                # the points with their interval.
+                steps, points = {}, []
+                for interval, segment in groupby(result, itemgetter(2)):
+                    for point in refine((t, v) for t, v, i in segment):
+                        steps[point[0]] = interval
+                        points.append(point)
+                if maxpoints is not None:
+                    points = self.downsample(points, maxpoints, method)
+                return [(t, v, steps[t]) for t, v in points]
+            result = refine(result)
+            if maxpoints is not None:
+                return self.downsample(result, maxpoints, method)
+            return list(result)
+
+        data = {}
+        for (records, query), result in zip(planned,
+                model.Records.fetch(planned)):
+            stitched = records.types.Flag(query.get("stitch", False)) and \
+                query.get("step") is None
+            data[self.encodeid(records)] = output(result, stitched)
+
+        for key, operator, matches, query in aggregated:
+            try:
+                result = model.Records.aggregate(matches, operator,
+                    query.get("start", 0), query.get("stop", -1),
+                    query.get("interval"))
+            except errors.RecordError, e:
+                raise errors.HTTPBadRequest(e.args[0])
+            data[key] = output(result)
+
+        return data
 
+    def downsample(self, result, maxpoints, method):
+        """Reduce *result* to at most *maxpoints* points.
+
+        A *result* that's short enough is returned unchanged. Otherwise, the
+        first point of each gap (a run of None values) is kept so plots still
+        break there (the longest gaps first, up to about half of *maxpoints*)
+        and the rest of the points are downsampled. Raises :class:`errors.HTTPBadRequest` if
+        the values aren't numbers (like lists of quantiles).
+        """
+        result = list(result)
+        if len(result) <= maxpoints:
+            return result
+
+        gaps, start = [], None
+        for i, (timestamp, value) in enumerate(result + [(None, 0)]):
+            if value is None and start is None:
+                start = i
+            elif value is not None and start is not None:
+                gaps.append((i - start, start))
+                start = None
+        gaps = sorted(sorted(gaps, reverse=True)[:(maxpoints - 2)/2],
+            key=itemgetter(1))
+        points = maxpoints - len(gaps)
+
+        vectorized, generic = self.downsamplers[method]
+        data = None
+        if vectorized is not None and model.Records.vectorize and \
+                model.numeric.numpy is not None:
+            data = vectorized(result, points)
+        if data is None:
+            try:
+                data = generic(result, points)
+            except TypeError:
+                raise errors.HTTPBadRequest("Only numbers can be downsampled")
+        if gaps:
+            data = sorted(data + [result[i] for length, i in gaps],
+                key=itemgetter(0))
         return data
 
     def filter(self, result, filters):
@@ -203,8 +371,8 @@ class Records(AllRecords):
         writer.writerow("subject attribute cf timestamp value".split())
         for k, v in self._get().items():
             s, a, c = self.decodeid(k)
-            for t, v in v:
-                writer.writerow((s, a, c, t, v))
+            for point in v:
+                writer.writerow((s, a, c) + tuple(point[:2]))
 
         self.response.status_int = 200
 
@@ -216,6 +384,31 @@ class Ping(neat.Resource):
         self.response.status_int = 200
         self.response.content_type = "text/plain"
 
+class Metrics(neat.Resource):
+    prefix = "/_metrics"
+
+    def get(self):
+        metrics = {
+            "queue": model.Records.backlog(),
+            "late": model.Records.dropped(),
+            "quarantine": model.Records.quarantines(),
+            "pool": pool(model.db),
+        }
+        self.response.body = json.dumps(metrics)
+        self.response.status_int = 200
+        self.response.content_type = "application/json"
+
+def pool(db):
+    """Summarize the connection pools behind *db*."""
+    pools = [p.metrics() for p in model.engines.pools(db)]
+    summary = dict((k, sum(p[k] for p in pools))
+        for k in ("inuse", "checkouts", "wait", "exhausted"))
+    summary["maxwait"] = max([p["maxwait"] for p in pools] or [0.0])
+    sizes = [p["size"] for p in pools]
+    summary["size"] = None if None in sizes else sum(sizes)
+    summary["pools"] = len(pools)
+    return summary
+
 class Static(neat.Resource):
     prefix = "/"
     public = ""
@@ -274,6 +467,7 @@ def Server(host, port, backend="", public=False, **kwargs):
         AllRecords(),
         Records(),
         Ping(),
+        Metrics(),
     ]
     if public is not False:
         static = Static()
@@ -299,6 +493,7 @@ class Serve(DBMixin, DaemonizingSubCommand):
         else:
             public = os.path.abspath(public)
 
+        AllRecords.queue = self.params.queue
         self.log.info("Starting server at http://%s:%s/", host, port)
         server = Server(host, int(port),
             public=public,
@@ -316,6 +511,18 @@ class Serve(DBMixin, DaemonizingSubCommand):
     def pre_run(self):
         DaemonizingSubCommand.pre_run(self)
         DBMixin.pre_run(self)
+        if self.params.max_matches < 1:
+            self.argparser.error("the maximum number of matches must be positive")
+        model.Records.maxmatches = self.params.max_matches
+
+    def pooloptions(self):
+        """Size the connection pools to match the server's thread pool."""
+        options = DBMixin.pooloptions(self)
+        if options["pool_size"] is None:
+            options["pool_size"] = int(self.params.nthreads)
+        if options["pool_timeout"] is None:
+            options["pool_timeout"] = float(self.params.timeout)
+        return options
 
     def setup(self):
         Application.setup(self)
@@ -339,6 +546,11 @@ class Serve(DBMixin, DaemonizingSubCommand):
             help="timeout (seconds) for accepted connections (default: %s)" % default_timeout)
         self.add_param("-b", "--backend", default=default_backend,
             help="set backend tag (default: %s)" % default_backend)
+        self.add_param("-Q", "--queue", default=False, action="store_true",
+            help="queue new records for the consolidate workers")
+        self.add_param("-M", "--max-matches", default=model.Records.maxmatches,
+            type=int, help="maximum number of series matched by a wildcard "
+                "query (default: %d)" % model.Records.maxmatches)
         self.add_param("-P", "--public", default=False,
             help="specify public directory for static files (default: no static files)")
         self.add_param("server", nargs="?",
@@ -208,6 +208,10 @@
         return url;
       };
 
+      // About one point per pixel is enough (see maxpoints).
+      if (options.parameters.maxpoints === undefined && plotelem.width()) {
+        options.parameters.maxpoints = plotelem.width();
+      }
       var url = options.service + "?";
       for (var param in options.parameters) {
         var value = options.parameters[param];
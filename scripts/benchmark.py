@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""\
+Compare the storage cost of daily records in each layout.
+
+Usage: PYTHONPATH=lib python scripts/benchmark.py [DSN] [DAYS]
+
+Writes DAYS days of hourly cosine samples to each layout, then seals them
+into Gorilla chunks, reporting the bytes per daily bin as measured by Redis
+MEMORY USAGE. The database named by DSN is flushed.
+"""
+
+import sys
+
+from math import cos
+
+from tsar import model
+from tsar.util import parsedsn
+
+def usage(db, records):
+    keys = [records.subkey(records.intervals[-1][0]), records.chunkkey()]
+    return sum(db.execute_command("MEMORY", "USAGE", k) or 0 for k in keys)
+
+def main(dsn="redis://localhost:6379/15", days="730"):
+    days = int(days)
+    dsn = parsedsn(dsn)
+    db = model.db = model.connect(host=dsn["host"], port=dsn["port"],
+        db=dsn["database"], password=dsn["password"])
+    start = 1278007837
+    data = [(start + (i * 3600), round(100 * cos(i / 24.0), 2)) \
+        for i in range(days * 24)]
+
+    for layout in model.Records.layouts:
+        db.flushdb()
+        records = model.Records("benchmark", "cosine", "ave")
+        records.layout = layout
+        records.extend(data)
+        bins = len(list(records.query(0, -1, interval=86400)))
+        before = usage(db, records)
+        records.seal(86400)
+        after = usage(db, records)
+        print "%-8s %5d bins  %6.2f bytes/bin  %6.2f bytes/bin sealed" % (
+            layout, bins, before / float(bins), after / float(bins))
+    db.flushdb()
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
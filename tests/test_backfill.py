@@ -0,0 +1,90 @@
+import random
+
+from StringIO import StringIO
+
+from tsar import backfill, errors, model
+
+from tests import BaseTest, log, unittest
+
+class TestBackfill(BaseTest):
+    first = 1278007837
+
+    def setUp(self):
+        self.redis, model.db = model.db, model.connect("memory")
+        self.random = random.Random(42)
+        self.series = {}
+        for subject in ("foo", "bar"):
+            for cf in ("ave", "max", "min+max"):
+                key = (subject, "load", cf)
+                self.series[key] = [(self.first + 60 * i, self.random.randint(0, 50))
+                    for i in range(1000)]
+        self.rows = [key + (str(t), str(v))
+            for key, data in self.series.items() for t, v in data]
+        self.random.shuffle(self.rows)
+
+    def tearDown(self):
+        model.db = self.redis
+
+    def test_readcsv(self):
+        stream = StringIO("subject,attribute,cf,timestamp,value\n\n"
+            "foo,bar,ave,60,1.5\nfoo,bar,ave,120,None\n")
+        self.assertEqual(list(backfill.readcsv(stream)), [
+            ("foo", "bar", "ave", "60", "1.5"),
+            ("foo", "bar", "ave", "120", "None")])
+        stream = StringIO("foo,bar,60,1\n")
+        self.assertRaises(errors.RecordError, list, backfill.readcsv(stream))
+
+    def test_binary(self):
+        stream = StringIO()
+        for key in sorted(self.series):
+            backfill.writebinary(stream, key, self.series[key])
+        stream.seek(0)
+        rows = list(backfill.readbinary(stream))
+        self.assertEqual(len(rows), len(self.rows))
+        self.assertEqual(sorted(backfill.groups(backfill.sort(rows))),
+            sorted((k, [(t, "%r" % float(v)) for t, v in d])
+                for k, d in self.series.items()))
+
+        truncated = StringIO(stream.getvalue()[:-3])
+        self.assertRaises(errors.RecordError, list, backfill.readbinary(truncated))
+
+    def test_sort(self):
+        expected = list(backfill.sort(self.rows))
+        self.assertEqual(expected, sorted(r[:3] + (int(r[3]), r[4])
+            for r in self.rows))
+        self.assertEqual(list(backfill.sort(self.rows, size=77)), expected)
+
+    def test_sort_stable(self):
+        rows = [("foo", "bar", "last", "60", str(i)) for i in (3, 1, 2)]
+        self.assertEqual([r[4] for r in backfill.sort(rows, size=2)],
+            ["3", "1", "2"])
+        self.assertRaises(errors.RecordError, list,
+            backfill.sort([("foo", "bar", "last", "x", "1")]))
+
+    def test_owner(self):
+        owners = [backfill.owner(key, 3) for key in sorted(self.series)]
+        self.assertTrue(all(0 <= o < 3 for o in owners))
+        self.assertEqual(owners, [backfill.owner(key, 3)
+            for key in sorted(self.series)])
+
+    def test_load(self):
+        for key, data in self.series.items():
+            model.series("expected-" + key[0], *key[1:]).extend(data)
+        series = backfill.groups(backfill.sort(self.rows, size=500))
+        self.assertEqual(backfill.load(series, size=1500),
+            (len(self.series), len(self.rows), []))
+        for subject, attribute, cf in self.series:
+            for cf in cf.split("+"):
+                records = model.Records(subject, attribute, cf)
+                expected = model.Records("expected-" + subject, attribute, cf)
+                self.assertEqual(list(records.query(0, -1)),
+                    list(expected.query(0, -1)))
+
+    def test_rejected(self):
+        rows = [("foo", "bar", "nosuch", "60", "1"), ("foo", "bar", "ave", "60", "x"),
+            ("foo", "baz", "ave", "60", "1")]
+        nseries, npoints, rejected = backfill.load(
+            backfill.groups(backfill.sort(rows)))
+        self.assertEqual((nseries, npoints), (1, 1))
+        self.assertEqual(sorted(k for k, e in rejected),
+            [("foo", "bar", "ave"), ("foo", "bar", "nosuch")])
@@ -1,5 +1,8 @@
 from tests import BaseTest, log
+from tsar.collectors.commands import Collector
 from tsar.collectors.helpers import *
+from tsar.collectors.proc import Proc
+from tsar.sketch import Sketch
 
 class TestHelpers(BaseTest):
     
@@ -34,3 +37,45 @@ class TestHelpers(BaseTest):
     def test_insert_int(self):
         self.assertEqual(insert(range(10), 3, 10),
             [0, 1, 2, 10, 3, 4, 5, 6, 7, 8, 9])
+
+class TestPrepare(BaseTest):
+
+    def setUp(self):
+        # prepare() only needs the collector's cfs, not its command line.
+        self.collector = Collector.__new__(Collector)
+        self.proc = Proc.__new__(Proc)
+
+    def test_numbers(self):
+        self.assertEqual(list(self.collector.prepare([("h", "a", 10, 5)])),
+            [["h", "a", "ave+max+min", 10, 5]])
+        self.assertEqual(list(self.collector.prepare([("h", "a", 10, 5.5)],
+            cfs={"max": max})), [["h", "a", "max", 10, 5.5]])
+
+    def test_samples(self):
+        records = sorted(self.collector.prepare([("h", "a", 10, [3, 1, 2, 4])]))
+        self.assertEqual(records, [
+            ["h", "a", "ave", 10, 3],
+            ["h", "a", "max", 10, 4],
+            ["h", "a", "min", 10, 1],
+            ["h", "a", "sketch", 10, Sketch.of([3, 1, 2, 4])],
+        ])
+
+    def test_explicit(self):
+        self.assertEqual(list(self.collector.prepare([("h", "a", "last", 10, 5)])),
+            [("h", "a", "last", 10, 5)])
+
+    def test_rates(self):
+        data = [
+            ("h", "net_eth0_rxbytes", 10, 500),
+            ("h", "disk_sda_major", 10, 8),
+            ("h", "mem_free", 10, 7),
+        ]
+        records = list(self.proc.prepare(data))
+        self.assertEqual(records, [
+            ["h", "net_eth0_rxbytes", "ave+max+min", 10, 500],
+            ["h", "disk_sda_major", "ave+max+min", 10, 8],
+            ["h", "mem_free", "ave+max+min", 10, 7],
+            ["h", "net_eth0_rxbytes", "rate", 10, 500],
+        ])
+        self.assertEqual(list(self.proc.prepare(data[:1], cfs={"last": None})),
+            [["h", "net_eth0_rxbytes", "last", 10, 500]])
@@ -0,0 +1,328 @@
+import os
+import shutil
+import struct
+import tempfile
+
+from tsar import engines, model
+from tsar.util import parsedsn
+
+from tests import BaseTest, log, unittest
+
+class TestMemory(BaseTest):
+
+    def setUp(self):
+        self.db = model.connect("memory")
+
+    def test_connect(self):
+        dsn = parsedsn("memory://")
+        self.assertEqual(dsn["driver"], "memory")
+        self.assertTrue(isinstance(self.db, engines.Memory))
+        self.assertRaises(model.errors.Error, model.connect, "nosuch")
+
+    def test_strings(self):
+        self.assertEqual(self.db.get("a"), None)
+        self.assertTrue(self.db.setnx("a", 1.5))
+        self.assertFalse(self.db.setnx("a", 2))
+        self.assertEqual(self.db.getset("a", 3), "1.5")
+        self.db.mset({"b": "x", "c": 4})
+        self.assertEqual(self.db.mget(["a", "b", "c", "d"]), ["3", "x", "4", None])
+        self.assertEqual(self.db.type("a"), "string")
+        self.assertEqual(self.db.type("d"), "none")
+        self.assertEqual(self.db.incr("c", 2), 6)
+        self.assertEqual(self.db.incr("e"), 1)
+        self.assertEqual(self.db.get("c"), "6")
+
+    def test_ranges(self):
+        values = struct.pack("<4d", 1, 2, 3, 4)
+        self.db.setrange("a", 16, values[:16])
+        self.db.setrange("a", 0, values[:16])
+        self.assertTrue(isinstance(self.db.data["a"], self.db.buffers))
+        self.assertEqual(self.db.strlen("a"), 32)
+        self.assertEqual(self.db.getrange("a", 8, 23), struct.pack("<2d", 2, 1))
+        self.assertEqual(self.db.getrange("a", -8, -1), struct.pack("<d", 2))
+
+        # Unaligned writes fall back to plain strings.
+        self.db.setrange("b", 3, "abc")
+        self.assertEqual(self.db.get("b"), "\0\0\0abc")
+        self.assertEqual(self.db.getrange("b", 2, 3), "\0a")
+
+    def test_lists(self):
+        self.db.lpush("a", 1, 2, 3)
+        self.db.lpush("a", 4)
+        self.assertEqual(self.db.lrange("a", 0, -1), ["4", "3", "2", "1"])
+        self.assertEqual(self.db.lrange("a", -2, 10), ["2", "1"])
+        self.assertEqual(self.db.lpop("a"), "4")
+        self.db.ltrim("a", 0, 1)
+        self.assertEqual(self.db.lrange("a", 0, -1), ["3", "2"])
+        self.db.lset("a", 1, 5)
+        self.assertEqual(self.db.lindex("a", 1), "5")
+        self.assertRaises(model.errors.Error, self.db.lset, "a", 5, 0)
+        self.db.ltrim("a", 5, 10)
+        self.assertFalse(self.db.exists("a"))
+
+    def test_zsets(self):
+        self.db.zadd("a", "x", 1, "y", 2, "z", 3)
+        self.assertEqual(self.db.zremrangebyscore("a", "-inf", 2), 2)
+        self.assertEqual(self.db.zrangebyscore("a", 0, 10), ["z"])
+        self.assertEqual(self.db.zremrangebyscore("a", 3, 3), 1)
+        self.assertFalse(self.db.exists("a"))
+
+        self.db.zadd("b", "ab", 0, "abc", 0, "b", 0, "c", 0)
+        self.assertEqual(self.db.zrangebylex("b", "[ab", "(c"), ["ab", "abc", "b"])
+        self.assertEqual(self.db.zrangebylex("b", "(ab", "+", 0, 2), ["abc", "b"])
+        self.assertEqual(list(engines.lexscan(self.db, "b", "ab", 1)), ["ab", "abc"])
+        self.assertEqual(list(engines.lexscan(self.db, "b", count=3)),
+            ["ab", "abc", "b", "c"])
+        self.assertEqual(self.db.zrem("b", "b", "x"), 1)
+
+    def test_sets(self):
+        self.assertEqual(self.db.sadd("a", "x", "y"), 2)
+        self.assertEqual(self.db.srem("a", "x", "z"), 1)
+        self.assertEqual(self.db.smembers("a"), set(["y"]))
+        self.assertEqual(list(engines.scan(self.db, "a", 10)), ["y"])
+        self.db.zadd("b", "x", 3, "y", 1, "z", 2)
+        self.assertEqual(self.db.zcard("b"), 3)
+        self.assertEqual(self.db.zrangebyscore("b", 2, "+inf"), ["z", "x"])
+
+    def test_keys(self):
+        self.db.set("a!b", 1)
+        self.db.set("a!c", 1)
+        self.db.lpush("x", 1)
+        self.assertEqual(sorted(self.db.keys("a!*")), ["a!b", "a!c"])
+        self.assertTrue(self.db.renamenx("x", "y"))
+        self.assertFalse(self.db.renamenx("y", "a!b"))
+        self.assertEqual(self.db.delete("a!b", "nosuch"), 1)
+        self.db.flushdb()
+        self.assertEqual(self.db.keys("*"), [])
+
+    def test_pipeline(self):
+        self.db.lpush("a", 1)
+        pipe = self.db.pipeline(transaction=True)
+        pipe.set("b", 1).get("a").llen("a")
+        results = pipe.execute(raise_on_error=False)
+        self.assertEqual(results[0], True)
+        self.assertTrue(isinstance(results[1], TypeError))
+        self.assertEqual(results[2], 1)
+
+        pipe.get("a")
+        self.assertRaises(TypeError, pipe.execute)
+        self.assertEqual(pipe.execute(), [])
+
+class TestFile(TestMemory):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.db = self.connect()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def connect(self):
+        dsn = parsedsn("file://" + self.root)
+        return model.connect(dsn["driver"], host=dsn["host"], db=dsn["database"])
+
+    def test_connect(self):
+        self.assertTrue(isinstance(self.db, engines.File))
+        self.assertEqual(self.db.root, self.root)
+
+    def test_ranges(self):
+        super(TestFile, self).test_ranges()
+        self.assertTrue(isinstance(self.db.data["a"], engines.Ring))
+        self.assertTrue(os.path.exists(os.path.join(self.root, "a.ring")))
+        self.assertFalse(isinstance(self.db.data["b"], engines.Ring))
+
+    def test_paths(self):
+        for key in ["a!b!c", "a!!c", "..!.!x%y", "records!a b"]:
+            path = self.db.path(key)
+            self.assertTrue(path.startswith(self.root + os.sep))
+            self.assertEqual(self.db.key(path), key)
+
+    def test_persist(self):
+        self.db.setrange("a!b", 0, struct.pack("<2d", 1, 2))
+        self.db.setrange("a!b", 8, struct.pack("<d", 3))
+        self.db.lpush("a!c", 1, 2)
+        self.db.sadd("s", "x")
+        self.db.set("x", 1)
+        pipe = self.db.pipeline()
+        pipe.zadd("z", "x", 1).renamenx("x", "y")
+        pipe.execute()
+
+        db = self.connect()
+        self.assertEqual(sorted(db.keys()), ["a!b", "a!c", "s", "y", "z"])
+        self.assertEqual(db.get("a!b"), struct.pack("<2d", 1, 3))
+        self.assertEqual(db.lrange("a!c", 0, -1), ["2", "1"])
+        self.assertEqual(db.smembers("s"), set(["x"]))
+        self.assertEqual(db.get("y"), "1")
+        self.assertEqual(db.zrangebyscore("z", "-inf", "+inf"), ["x"])
+
+        db.delete("a!b", "y")
+        db.flushdb()
+        files = [f for d, _, fs in os.walk(self.root) for f in fs]
+        self.assertEqual(files, [])
+
+    def test_journal(self):
+        self.db.sadd("s", "x", "y")
+        path = os.path.join(self.root, "s.set")
+        size = os.path.getsize(path)
+        self.db.sadd("s", "x")
+        self.db.srem("s", "z")
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(self.db.dirty, set())
+
+        self.db.sadd("s", "z")
+        self.db.srem("s", "x")
+        self.assertTrue(os.path.getsize(path) > size)
+        self.assertEqual(self.connect().smembers("s"), set(["y", "z"]))
+
+        maxjournal, engines.File.maxjournal = engines.File.maxjournal, 3
+        try:
+            for member in "abcd":
+                self.db.sadd("s", member)
+            self.assertTrue(self.db.journaled["s"] < 3)
+        finally:
+            engines.File.maxjournal = maxjournal
+        with open(path, "ab") as f:
+            f.write("\x80\x02")
+        self.assertEqual(self.connect().smembers("s"), set("abcdyz"))
+
+        self.db.srem("s", *"abcdyz")
+        self.assertFalse(os.path.exists(path))
+
+    def test_maps(self):
+        maxmaps, engines.Ring.maxmaps = engines.Ring.maxmaps, 1
+        try:
+            self.db.setrange("a", 0, struct.pack("<d", 1))
+            self.db.setrange("b", 0, struct.pack("<d", 2))
+            self.assertEqual(self.db.get("a"), struct.pack("<d", 1))
+            self.assertEqual(self.db.get("b"), struct.pack("<d", 2))
+            self.assertEqual(self.db.data["a"].map, None)
+            self.db.setrange("a", 8, struct.pack("<d", 3))
+            self.assertEqual(self.db.get("a"), struct.pack("<2d", 1, 3))
+
+            # Each engine only closes its own maps.
+            root = tempfile.mkdtemp()
+            try:
+                other = model.connect("file", host=root)
+                other.setrange("c", 0, struct.pack("<d", 4))
+                self.assertNotEqual(self.db.data["a"].map, None)
+                self.assertNotEqual(other.data["c"].map, None)
+            finally:
+                shutil.rmtree(root)
+        finally:
+            engines.Ring.maxmaps = maxmaps
+
+class TestShards(BaseTest):
+
+    def setUp(self):
+        self.keys = ["subject%d!attribute!ave" % i for i in range(3000)]
+
+    def shards(self, names):
+        return engines.Shards([model.connect("memory") for n in names], names)
+
+    def test_shard(self):
+        shards = self.shards(["a", "b", "c"])
+        counts = dict((id(e), 0) for e in shards.engines)
+        for key in self.keys:
+            counts[id(shards.shard(key))] += 1
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_add(self):
+        old = self.shards(["a", "b", "c"])
+        new = engines.Shards(old.engines + [model.connect("memory")],
+            ["a", "b", "c", "d"])
+        moved = [k for k in self.keys if old.shard(k) is not new.shard(k)]
+        self.assertTrue(500 < len(moved) < 1000, len(moved))
+        for key in moved:
+            self.assertTrue(new.shard(key) is new.engines[-1])
+
+    def test_parallel(self):
+        self.assertEqual(engines.parallel(lambda x: x * 2, range(10)), range(0, 20, 2))
+        self.assertRaises(ZeroDivisionError, engines.parallel, lambda x: 1/x, [1, 0])
+        self.assertEqual(engines.each(self.shards(["a", "b"]))[0].__class__,
+            engines.Memory)
+
+    def test_connectdsn(self):
+        db = model.connectdsn("memory://, memory://x")
+        self.assertTrue(isinstance(db, engines.Shards))
+        self.assertEqual(db.names, ["memory://", "memory://x"])
+        self.assertTrue(isinstance(model.connectdsn("memory://"), engines.Memory))
+
+class TestReplicated(BaseTest):
+
+    def setUp(self):
+        self.primary = model.connect("memory")
+        self.replicas = [model.connect("memory") for i in range(2)]
+        self.db = engines.Replicated(self.primary, self.replicas)
+
+    def test_proxy(self):
+        self.db.set("a", 1)
+        self.assertEqual(self.primary.get("a"), "1")
+        self.assertEqual(self.replicas[0].get("a"), None)
+
+    def test_reader(self):
+        readers = [self.db.reader() for i in range(4)]
+        self.assertEqual([id(r) for r in readers],
+            [id(r) for r in self.replicas[1:] + self.replicas[:1]] * 2)
+        self.assertTrue(self.db.reader(0) is self.primary)
+
+    def test_fail(self):
+        self.db.fail(self.replicas[0])
+        for i in range(3):
+            self.assertTrue(self.db.reader() is self.replicas[1])
+        self.db.fail(self.replicas[1])
+        self.assertTrue(self.db.reader() is self.primary)
+
+        # Failed replicas are checked again after an interval.
+        self.db.status = [(t - self.db.interval, lag) for t, lag in self.db.status]
+        self.assertTrue(self.db.reader() in self.replicas)
+
+    def test_check(self):
+        # A Redis server that isn't replicating is never read.
+        db = engines.Replicated(self.primary, [model.connect(db=15)])
+        self.assertEqual(db.check(0), None)
+        self.assertTrue(db.reader() is self.primary)
+
+    def test_connectdsn(self):
+        db = model.connectdsn("memory://|memory://r1|memory://r2,memory://b")
+        self.assertEqual(db.names, ["memory://", "memory://b"])
+        self.assertTrue(isinstance(db.engines[0], engines.Replicated))
+        self.assertEqual(len(db.engines[0].replicas), 2)
+        self.assertTrue(isinstance(db.engines[1], engines.Memory))
+
+class TestPool(BaseTest):
+
+    def setUp(self):
+        self.db = model.connectdsn("redis://localhost:6379/15", pool_size=1,
+            pool_timeout=0.1)
+        self.pool = self.db.connection_pool
+
+    def test_metrics(self):
+        self.assertTrue(isinstance(self.pool, engines.Pool))
+        self.db.set("a", 1)
+        self.assertEqual(self.db.get("a"), "1")
+        self.db.delete("a")
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics["size"], 1)
+        self.assertEqual(metrics["checkouts"], 3)
+        self.assertEqual(metrics["inuse"], 0)
+        self.assertEqual(metrics["exhausted"], 0)
+        self.assertEqual(engines.pools(self.db), [self.pool])
+
+    def test_exhausted(self):
+        connection = self.pool.get_connection("GET")
+        try:
+            self.assertRaises(model.errors.PoolError, self.db.get, "a")
+        finally:
+            self.pool.release(connection)
+        self.assertEqual(self.db.get("a"), None)
+        metrics = self.pool.metrics()
+        self.assertEqual(metrics["exhausted"], 1)
+        self.assertEqual(metrics["checkouts"], 2)
+        self.assertTrue(metrics["maxwait"] < 0.1)
+
+    def test_unbounded(self):
+        db = model.connectdsn("redis://localhost:6379/15|memory://")
+        self.assertEqual(db.primary.connection_pool.size, None)
+        self.assertEqual(len(engines.pools(db)), 1)
+        self.assertEqual(engines.pools(model.connect("memory")), [])
@@ -0,0 +1,40 @@
+from math import cos
+
+from tsar import gorilla
+
+from tests import BaseTest, log, unittest
+
+class TestGorilla(BaseTest):
+    first = 1278007837
+
+    def assertRoundTrip(self, data):
+        result = gorilla.decode(gorilla.encode(data))
+        self.assertEqual(len(result), len(data))
+        for (t1, v1), (t2, v2) in zip(data, result):
+            self.assertEqual(t1, t2)
+            if v1 != v1:
+                self.assertTrue(v2 != v2)
+            else:
+                self.assertEqual(float(v1), v2)
+
+    def test_empty(self):
+        self.assertEqual(gorilla.decode(gorilla.encode([])), [])
+
+    def test_regular(self):
+        data = [(self.first + (i * 86400), int(100 * cos(i))) for i in range(365)]
+        self.assertRoundTrip(data)
+        # Regular time stamps cost a bit each; values only a few bytes.
+        self.assertTrue(len(gorilla.encode(data)) < 4 * len(data))
+
+    def test_irregular(self):
+        data = []
+        timestamp = -self.first
+        for i in range(500):
+            timestamp += [1, 60, 300, 4000, 86400, 2**40][i % 6]
+            data.append((timestamp, 100 * cos(i) * 10 ** (i % 40 - 20)))
+        self.assertRoundTrip(data)
+
+    def test_special(self):
+        data = [(i, v) for i, v in enumerate(
+            [0.0, -0.0, float("nan"), float("inf"), -float("inf"), 1e308, 5e-324])]
+        self.assertRoundTrip(data)
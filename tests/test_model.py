@@ -1,11 +1,23 @@
+import shutil
+import tempfile
+import threading
+import time
+
+from itertools import groupby
 from math import cos
+from operator import itemgetter
 
-from tsar import errors, model
+from tsar import engines, errors, maintenance, model, sketch
 
 from tests import AppTest, BaseTest, log, unittest
 
 model.db = model.connect(db=15)
 
+# The script writer doesn't handle every cf, and the packed layout only holds
+# numbers.
+scripted = sorted(set(model.Records.cfs) - set(["rate", "sketch"]))
+packable = sorted(set(model.Records.cfs) - set(["sketch"]))
+
 class TestRecords(BaseTest):
     first = 1278007837
     
@@ -178,14 +190,15 @@ class TestRecords(BaseTest):
 
     def test_keys(self):
         self.records.append((1,2))
-        keys = set(list(self.records.keys()) + ["records"])
+        keys = set(list(self.records.keys()) + ["records"] +
+            self.records.indexkeys())
         self.assertEqual(keys, set(model.db.keys("*")))
 
     def test_rename(self):
         new = model.Records("new", "records", "last")
         self.records.append((1,2))
         self.records.rename(new)
-        newkeys = set(list(new.keys()) + ["records"])
+        newkeys = set(list(new.keys()) + ["records"] + new.indexkeys())
         self.assertEqual(newkeys, set(model.db.keys("*")))
 
     def test_rename_conflicts(self):
@@ -219,3 +232,1384 @@ class TestRecords(BaseTest):
 
         c = model.Records("spam", "eggs", "last")
         self.assertNotEqual(a, c)
+
+class TestScriptRecords(TestRecords):
+
+    def setUp(self):
+        super(TestScriptRecords, self).setUp()
+        self.records.writer = "script"
+
+class SeriesTest(BaseTest):
+    first = 1278007837
+
+    def setUp(self):
+        super(SeriesTest, self).setUp()
+        self.db = model.db
+        self.db.flushdb()
+
+        self.data = []
+        timestamp = self.first
+        for i in range(2000):
+            value = 100 * cos(i)
+            if i % 3:
+                value = int(value)
+            elif i % 7 == 0:
+                value = value * 1e-7
+            elif i % 5 == 0:
+                value = int(value) / 8.0
+            self.data.append((timestamp, value))
+            timestamp += 25 + (i % 11) * 40
+
+    def tearDown(self):
+        super(SeriesTest, self).tearDown()
+        self.db.flushdb()
+
+    def dump(self):
+        data = {}
+        for key in self.db.keys("*"):
+            if self.db.type(key) == "list":
+                data[key] = self.db.lrange(key, 0, -1)
+            elif self.db.type(key) == "set":
+                data[key] = self.db.smembers(key)
+            elif self.db.type(key) == "zset":
+                data[key] = tuple(self.db.zrangebyscore(key, "-inf", "+inf"))
+            else:
+                data[key] = self.db.get(key)
+        self.db.flushdb()
+        return data
+
+class TestScriptEquivalence(SeriesTest):
+
+    def write(self, writer, cf, data):
+        records = model.Records("foo", "bar", cf)
+        records.writer = writer
+        for i in range(0, len(data), 150):
+            records.extend(data[i:i + 150])
+        records.extend(data[-10:])
+        return self.dump()
+
+    def assertEquivalent(self, cf, data):
+        expected = self.write("lock", cf, data)
+        self.assertTrue(expected)
+        self.assertEqual(self.write("script", cf, data), expected)
+
+    def test_cfs(self):
+        for cf in scripted:
+            self.assertEquivalent(cf, self.data)
+
+    def test_none(self):
+        data = [(t, i % 5 and v or None) for i, (t, v) in enumerate(self.data)]
+        for cf in "min max first last".split():
+            self.assertEquivalent(cf, data)
+
+    def test_out_of_order(self):
+        records = model.Records("foo", "bar", "last")
+        records.writer = "script"
+        data = list(reversed(self.data[:10]))
+        self.assertRaises(errors.RecordError, records.extend, data)
+        self.assertEqual(self.db.keys("*"), [])
+
+class TestScriptEquivalenceUnvectorized(TestScriptEquivalence):
+
+    def setUp(self):
+        super(TestScriptEquivalenceUnvectorized, self).setUp()
+        model.Records.vectorize = False
+
+    def tearDown(self):
+        model.Records.vectorize = True
+        super(TestScriptEquivalenceUnvectorized, self).tearDown()
+
+class TestBulk(SeriesTest):
+    writer = "lock"
+
+    def series(self):
+        series = []
+        for i, cf in enumerate(scripted):
+            records = model.Records("foo%d" % i, "bar", cf)
+            records.writer = self.writer
+            series.append((records, self.data[i * 10:]))
+        return series
+
+    def test_bulk(self):
+        for records, data in self.series():
+            records.extend(data)
+        expected = self.dump()
+        self.assertEqual(model.Records.bulk(self.series()), [])
+        self.assertEqual(self.dump(), expected)
+
+    def test_bulk_batches(self):
+        for records, data in self.series():
+            records.extend(data)
+        expected = self.dump()
+        batchsize = model.Records.batchsize
+        model.Records.batchsize = 2
+        try:
+            self.assertEqual(model.Records.bulk(self.series()), [])
+        finally:
+            model.Records.batchsize = batchsize
+        self.assertEqual(self.dump(), expected)
+
+    def test_bulk_rejected(self):
+        series = self.series()
+        bad = series[1][0]
+        series[1] = (bad, list(reversed(series[1][1])))
+        series[2] = (series[2][0], [(1278007837, "ten")])
+        rejected = dict((r.member, e) for r, e in model.Records.bulk(series))
+        self.assertEqual(sorted(rejected), [bad.member, series[2][0].member])
+        self.assertTrue(isinstance(rejected[bad.member], errors.RecordError))
+        self.assertTrue(isinstance(rejected[series[2][0].member], TypeError))
+        self.assertEqual(len(self.db.smembers("records")), len(series) - 2)
+        self.assertFalse(self.db.keys("*!lock"))
+
+    def test_bulk_contended(self):
+        series = self.series()
+        records = series[0][0]
+        self.db.set(records.subkey("lock"), 0)
+        self.assertEqual(model.Records.bulk(series), [])
+        self.assertEqual(len(self.db.smembers("records")), len(series))
+
+class TestBulkScript(TestBulk):
+    writer = "script"
+
+class TestSchemas(SeriesTest):
+    layout = "list"
+
+    def setUp(self):
+        super(TestSchemas, self).setUp()
+        self.layout, model.Records.layout = model.Records.layout, self.layout
+        model.Records.schemas = [
+            ("proc/*", [(10, 360), (60, 120)]),
+            ("dcache-info/*", [(3600, 24)]),
+        ]
+
+    def tearDown(self):
+        super(TestSchemas, self).tearDown()
+        model.Records.schemas = []
+        model.Records.layout = self.layout
+
+    def test_schema(self):
+        self.assertEqual(model.Records("proc", "cpu", "ave").intervals,
+            [(10, 360), (60, 120)])
+        self.assertEqual(model.Records("dcache-info", "x", "max").intervals,
+            [(3600, 24)])
+        self.assertEqual(model.Records("procs", "cpu", "ave").intervals,
+            model.Records.intervals)
+        records = model.Records("proc", "cpu", "ave", intervals=[(60, 10)])
+        self.assertEqual(records.intervals, [(60, 10)])
+
+    def test_record(self):
+        records = model.Records("proc", "cpu", "last")
+        data = [(self.first + i * 10, i) for i in range(1000)]
+        records.extend(data)
+        self.assertEqual(set(self.db.keys("*")),
+            set(list(records.keys()) + ["records"] + records.indexkeys()))
+        result = list(records.query(0, -1, interval=10))
+        self.assertEqual(result[-1], (self.first + 9990 + 3, 999))
+        self.assertEqual(len(result), 361)
+        self.assertEqual(list(records.query(0, -1)),
+            list(records.query(0, -1, interval=60)))
+        self.assertEqual(list(records.query(0, -1, interval=3600)), [])
+
+        records.delete()
+        self.assertEqual(self.db.keys("*"), [])
+
+    def test_coarse(self):
+        records = model.Records("dcache-info", "pools", "max")
+        records.extend(self.data)
+        result = list(records.query(0, -1))
+        self.assertEqual([t % 3600 for t, v in result], [0] * len(result))
+        self.assertAlmostEqual(result[-1][1], max(v for t, v in self.data
+            if model.nearest(t, 3600) == model.nearest(self.data[-1][0], 3600)),
+            places=2)
+
+    def test_rename(self):
+        records = model.Records("proc", "cpu", "last")
+        records.extend(self.data[:10])
+        expected = list(records.query(0, -1))
+        other = model.Records("proc", "mem", "last")
+        records.rename(other)
+        self.assertEqual(list(other.query(0, -1)), expected)
+        self.assertRaises(errors.RecordError, other.rename,
+            model.Records("mem", "mem", "last"))
+
+class TestSchemasPacked(TestSchemas):
+    layout = "packed"
+
+class TestPackedRecords(TestRecords):
+
+    def setUp(self):
+        super(TestPackedRecords, self).setUp()
+        self.records.layout = model.Records.layout = "packed"
+
+    def tearDown(self):
+        super(TestPackedRecords, self).tearDown()
+        model.Records.layout = "list"
+
+    def test_packed(self):
+        self.records.extend(self.data)
+        for interval, samples in self.records.intervals:
+            ikey = self.records.subkey(interval)
+            self.assertEqual(self.db.type(ikey), "string")
+            size = self.records.slots(interval)
+            if size is not None:
+                self.assertTrue(self.db.strlen(ikey) <= size * self.records.width)
+
+    def test_integral(self):
+        # Integral floats keep their type, like in the list layout.
+        t = model.nearest(self.first, 60)
+        values = [1.0, 1.5, 2, -3.0, -0.0, None, 0, 2.0 ** 49]
+        data = [(t + i * 60, v) for i, v in enumerate(values)]
+        self.records.extend(data)
+        result = list(self.records.query(t, data[-1][0], interval=60))
+        self.assertEqual([(x, type(v)) for x, v in result],
+            [(x, type(v)) for x, v in data])
+        self.assertEqual(result, data)
+        self.assertEqual(str(result[4][1]), "-0.0")
+
+    def test_wrap(self):
+        t = self.first
+        data = [(t + i * 60, i) for i in range(3000)]
+        for i in range(0, len(data), 700):
+            self.records.extend(data[i:i + 700])
+        result = list(self.records.query(0, -1, interval=60))
+        self.assertEqual(len(result), 1441)
+        self.assertEqual([v for t, v in result], range(3000 - 1441, 3000))
+
+class TestPackedEquivalence(SeriesTest):
+
+    def query(self, records):
+        results = []
+        last = self.data[-1][0]
+        for start, stop in [(0, last * 2), (last - 3600, last),
+                (last - 86400, last - 3600), (self.first, self.first + 7200)]:
+            results.append(list(records.query(start, stop)))
+            for interval, samples in records.intervals:
+                results.append(list(records.query(start, stop, interval=interval)))
+        return results
+
+    def write(self, layout, cf):
+        records = model.Records("foo", "bar", cf)
+        records.layout = layout
+        for i in range(0, len(self.data), 150):
+            records.extend(self.data[i:i + 150])
+        return records
+
+    def test_query(self):
+        for cf in packable:
+            expected = self.query(self.write("list", cf))
+            self.db.flushdb()
+            self.assertEqual(self.query(self.write("packed", cf)), expected)
+            self.db.flushdb()
+
+    def test_migrate(self):
+        records = self.write("list", "ave")
+        expected = self.dump()
+
+        records = self.write("list", "ave")
+        packed = records.migrate("packed")
+        self.assertEqual(set(self.db.keys("*")),
+            set(list(packed.keys()) + ["records"] + packed.indexkeys()))
+        self.assertEqual(self.db.get(packed.subkey(60, "last")),
+            expected[packed.subkey(60, "last")])
+
+        # Packed values are all doubles, so integral floats come back as ints.
+        records = packed.migrate("list")
+        result = self.dump()
+        self.assertEqual(sorted(result), sorted(expected))
+        for key, values in expected.items():
+            if isinstance(values, list):
+                values = [model.Types().Value(v) for v in values]
+                result[key] = [model.Types().Value(v) for v in result[key]]
+            self.assertEqual(result[key], values)
+
+    def test_script_requires_list(self):
+        records = model.Records("foo", "bar", "last")
+        records.writer, records.layout = "script", "packed"
+        self.assertRaises(errors.RecordError, records.extend, self.data)
+
+class TestSeal(SeriesTest):
+    age = 86400 * 10
+
+    def setUp(self):
+        super(TestSeal, self).setUp()
+        self.records = model.Records("foo", "bar", "ave")
+        self.records.layout = self.layout
+        self.records.chunksize = 5
+        # Sixty days, four samples a day.
+        self.data = [(self.first + (i * 21600), self.data[i][1]) \
+            for i in range(240)]
+        self.records.extend(self.data)
+        self.daily = list(self.records.query(0, -1, interval=86400))
+
+    def test_seal(self):
+        sealed = self.records.seal(self.age)
+        self.assertEqual(sealed, 50)
+        self.assertEqual(self.db.zcard(self.records.chunkkey()), 10)
+        self.assertEqual(list(self.records.query(0, -1, interval=86400)), self.daily)
+        self.assertEqual(list(self.records.query(0, -1)), self.daily)
+
+        start, stop = self.daily[3][0], self.daily[-3][0]
+        self.assertEqual(list(self.records.query(start, stop, interval=86400)),
+            self.daily[3:-2])
+
+        # Already sealed bins aren't sealed again.
+        self.assertEqual(self.records.seal(self.age), 0)
+        self.records.extend([(self.data[-1][0] + 86400 * 5, 10)])
+        self.assertEqual(self.records.seal(self.age), 5)
+        self.assertEqual(list(self.records.query(0, self.daily[-1][0],
+            interval=86400)), self.daily)
+
+    def test_seal_young(self):
+        self.assertEqual(self.records.seal(86400 * 365), 0)
+        self.assertFalse(self.db.exists(self.records.chunkkey()))
+
+    def test_delete(self):
+        self.records.seal(self.age)
+        self.records.delete()
+        self.assertEqual(self.db.keys("*"), [])
+
+    def test_rename(self):
+        self.records.seal(self.age)
+        new = model.Records("new", "records", "ave")
+        new.layout = self.layout
+        self.records.rename(new)
+        self.assertEqual(list(new.query(0, -1, interval=86400)), self.daily)
+
+    def test_expire(self):
+        hourly = list(self.records.query(0, -1, interval=3600))
+        self.assertTrue(self.records.expire(self.age) > 0)
+        self.assertEqual(list(self.records.query(0, -1, interval=86400)),
+            self.daily[-11:])
+        self.assertEqual(self.records.expire(self.age), 0)
+        # The bounded intervals are left alone.
+        self.assertEqual(list(self.records.query(0, -1, interval=3600)), hourly)
+
+    def test_expire_sealed(self):
+        self.records.seal(self.age)
+        self.assertTrue(self.records.expire(86400 * 5) > 0)
+        self.assertFalse(self.db.exists(self.records.chunkkey()))
+        self.assertEqual(list(self.records.query(0, -1, interval=86400)),
+            self.daily[-6:])
+        self.records.extend([(self.data[-1][0] + 86400, 10)])
+        self.assertEqual(len(list(self.records.query(0, -1, interval=86400))), 7)
+
+    def test_expire_empty(self):
+        records = model.Records("new", "records", "ave")
+        records.layout = self.layout
+        self.assertEqual(records.expire(self.age), 0)
+
+    def test_cache(self):
+        self.records.seal(self.age)
+        model.Records.chunkcache.clear()
+        list(self.records.query(0, -1, interval=86400))
+        self.assertEqual(len(model.Records.chunkcache), 10)
+
+class TestSealPacked(TestSeal):
+    layout = "packed"
+TestSeal.layout = "list"
+
+class MemoryTest(object):
+
+    def setUp(self):
+        self.redis, model.db = model.db, model.connect("memory")
+        super(MemoryTest, self).setUp()
+
+    def tearDown(self):
+        super(MemoryTest, self).tearDown()
+        model.db = self.redis
+
+class TestMemoryRecords(MemoryTest, TestRecords):
+    pass
+
+class TestMemoryPackedRecords(MemoryTest, TestPackedRecords):
+
+    def test_buffers(self):
+        self.records.extend(self.data)
+        for interval, samples in self.records.intervals:
+            ikey = self.records.subkey(interval)
+            self.assertTrue(isinstance(self.db.data[ikey], model.engines.array))
+
+class TestMemoryBulk(MemoryTest, TestBulk):
+    pass
+
+class TestMemorySeal(MemoryTest, TestSealPacked):
+    pass
+
+class FileTest(MemoryTest):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.redis, model.db = model.db, model.connect("file", db=self.root)
+        super(MemoryTest, self).setUp()
+
+    def tearDown(self):
+        super(FileTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+class TestFilePackedRecords(FileTest, TestPackedRecords):
+    pass
+
+class TestFileSeal(FileTest, TestSealPacked):
+    pass
+
+class TestFileEquivalence(SeriesTest):
+    query = TestPackedEquivalence.__dict__["query"]
+    write = TestPackedEquivalence.__dict__["write"]
+
+    def test_query(self):
+        root = tempfile.mkdtemp()
+        redis = model.db
+        try:
+            for cf in packable:
+                model.db = redis
+                expected = self.query(self.write("list", cf))
+                redis.flushdb()
+
+                model.db = model.connect("file", db=root)
+                self.assertEqual(self.query(self.write("packed", cf)), expected)
+
+                # Reopen the directory.
+                model.db = model.connect("file", db=root)
+                records = model.Records("foo", "bar", cf)
+                records.layout = "packed"
+                self.assertEqual(self.query(records), expected)
+                model.db.flushdb()
+        finally:
+            model.db = redis
+            shutil.rmtree(root)
+
+class TestQueue(SeriesTest):
+
+    def setUp(self):
+        super(TestQueue, self).setUp()
+        self.records = model.Records("foo", "bar", "ave")
+        self.records.writer = self.writer
+
+    def test_drain(self):
+        expected = model.Records("direct", "bar", "ave")
+        expected.extend(self.data)
+
+        # Batches may be queued in any order; drain sorts them.
+        batches = [self.data[i:i + 300] for i in range(0, len(self.data), 300)]
+        for batch in reversed(batches):
+            self.records.queue(batch)
+        self.assertEqual(self.db.smembers(model.Records.pending), set(["foo bar ave"]))
+        self.assertEqual(list(self.records.query(0, -1)), [])
+
+        backlog = model.Records.backlog()
+        self.assertEqual(backlog["series"], 1)
+        self.assertEqual(backlog["values"], len(self.data))
+        self.assertTrue(0 <= backlog["lag"] < 5)
+
+        self.assertEqual(maintenance.work(self.db), len(self.data))
+        self.assertEqual(maintenance.work(self.db), None)
+        self.assertFalse(self.db.exists(self.records.rawkey()))
+        self.assertEqual(model.Records.backlog(),
+            {"series": 0, "values": 0, "lag": 0})
+        for interval, samples in self.records.intervals:
+            self.assertEqual(
+                list(self.records.query(0, -1, interval=interval)),
+                list(expected.query(0, -1, interval=interval)))
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, self.records.queue, [(self.first, "ten")])
+        # Values that only fail when they're consolidated are rejected, too.
+        self.assertRaises(TypeError, self.records.queue,
+            [(self.first + 63, None), (self.first, 5)])
+        self.assertEqual(model.Records.backlog()["values"], 0)
+
+    def test_quarantine(self):
+        # A value that can't be merged into the bin already written.
+        self.records.extend([(self.first, 5)])
+        self.records.queue([(self.first + 30, None)])
+        self.assertRaises(TypeError, self.records.drain)
+        self.assertEqual(self.db.llen(self.records.rawkey()), 1)
+
+        other = model.Records("spam", "bar", "ave")
+        other.writer = self.writer
+        other.queue(self.data[:10])
+        self.assertEqual(sorted(maintenance.work(self.db) for i in range(3)),
+            [None, 0, 10])
+        self.assertFalse(self.db.exists(self.records.rawkey()))
+        self.assertEqual(len(self.db.lrange(self.records.quarantinekey(), 0, -1)), 1)
+        self.assertEqual(model.Records.quarantines(), {"series": 1, "values": 1})
+        self.assertEqual(list(self.records.query(0, -1, interval=60)),
+            [(model.nearest(self.first, 60), 5)])
+
+        self.records.delete()
+        self.assertEqual(model.Records.quarantines()["series"], 0)
+
+    def test_delete(self):
+        self.records.queue(self.data[:10])
+        self.records.delete()
+        self.assertEqual(self.records.drain(), 0)
+
+class TestQueueScript(TestQueue):
+    writer = "script"
+TestQueue.writer = "lock"
+
+class TestMemoryQueue(MemoryTest, TestQueue):
+    pass
+
+class TestIndexes(SeriesTest):
+    writer = "lock"
+
+    def setUp(self):
+        super(TestIndexes, self).setUp()
+        self.members = []
+        for subject in ("host1", "host2", "other"):
+            for attribute in ("load", "mem"):
+                records = model.Records(subject, attribute, "ave")
+                records.writer = self.writer
+                records.extend(self.data[:3])
+                self.members.append(records.member)
+
+    def find(self, **kwargs):
+        return sorted(r.member for r in model.Records.find(count=2, **kwargs))
+
+    def test_all(self):
+        self.assertEqual(sorted(r.member for r in model.Records.all()),
+            sorted(self.members))
+
+    def test_find(self):
+        self.assertEqual(self.find(subject="host1"),
+            ["host1 load ave", "host1 mem ave"])
+        self.assertEqual(self.find(attribute="load"),
+            ["host1 load ave", "host2 load ave", "other load ave"])
+        self.assertEqual(self.find(subject="host2", attribute="mem"),
+            ["host2 mem ave"])
+        self.assertEqual(self.find(prefix="host"), sorted(self.members)[:4])
+        self.assertEqual(self.find(prefix="host1 m"), ["host1 mem ave"])
+        self.assertEqual(self.find(prefix="nosuch"), [])
+        self.assertEqual(self.find(subject="nosuch"), [])
+
+    def test_delete(self):
+        model.Records("host1", "load", "ave").delete()
+        self.assertEqual(self.find(subject="host1"), ["host1 mem ave"])
+        self.assertEqual(self.find(prefix="host1"), ["host1 mem ave"])
+
+    def test_rename(self):
+        model.Records("host1", "load", "ave").rename(
+            model.Records("host3", "load", "ave"))
+        self.assertEqual(self.find(subject="host1"), ["host1 mem ave"])
+        self.assertEqual(self.find(attribute="load"),
+            ["host2 load ave", "host3 load ave", "other load ave"])
+
+    def test_reindex(self):
+        self.db.delete(*model.Records("host1", "load", "ave").indexkeys())
+        self.assertEqual(self.find(prefix="host"), [])
+        self.assertEqual(model.Records.reindex(), len(self.members))
+        self.assertEqual(self.find(prefix="host"), sorted(self.members)[:4])
+
+    def glob(self, *args, **kwargs):
+        return [r.member for r in model.Records.glob(*args, **kwargs)]
+
+    def test_glob(self):
+        self.assertEqual(self.glob("host*", "load", "ave"),
+            ["host1 load ave", "host2 load ave"])
+        self.assertEqual(self.glob("host1", "*", "ave"),
+            ["host1 load ave", "host1 mem ave"])
+        self.assertEqual(self.glob("*", "m?m", "*"),
+            ["host1 mem ave", "host2 mem ave", "other mem ave"])
+        self.assertEqual(self.glob("*t*", "*", None, count=2),
+            sorted(self.members))
+        self.assertEqual(self.glob("host[2-9]", "*", "ave"),
+            ["host2 load ave", "host2 mem ave"])
+        self.assertEqual(self.glob("host1", "load", "ave"), ["host1 load ave"])
+        self.assertEqual(self.glob("host*", "load", "max"), [])
+
+    def test_glob_limit(self):
+        self.assertEqual(len(self.glob("host*", "*", "ave", limit=4)), 4)
+        self.assertRaises(errors.RecordError, self.glob, "host*", "*", "ave",
+            limit=3)
+
+    def test_fetch(self):
+        packed = model.Records("packed", "load", "ave")
+        packed.layout = "packed"
+        packed.extend(self.data)
+        series = [model.Records(*m.split()) for m in self.members] + [packed]
+        series[1].extend(self.data)
+        sketches = model.Records("sketches", "load", "sketch")
+        sketches.extend(self.data)
+        queries = [(r, {}) for r in series] + [
+            (series[1], {"start": self.data[100][0], "stop": self.data[200][0],
+                "interval": "60"}),
+            (series[1], {"start": 0, "stop": -1, "interval": 3600}),
+            (packed, {"interval": 86400}), (series[1], {"interval": 7}),
+            (sketches, {"interval": 3600}), (sketches, {"q": "0,0.9"}),
+            (model.Records("nosuch", "load", "ave"), {})]
+        expected = [list(r.query(**query)) for r, query in queries]
+        self.assertEqual(model.Records.fetch(queries), expected)
+        self.assertEqual(model.Records.fetch([]), [])
+        self.assertRaises(TypeError, model.Records.fetch,
+            [(series[0], {"q": "0.5"})])
+
+class TestAggregate(SeriesTest):
+
+    def setUp(self):
+        super(TestAggregate, self).setUp()
+        self.series = []
+        for i, subject in enumerate(("schedd1", "schedd2", "schedd3")):
+            records = model.Records(subject, "running_jobs", "last")
+            records.extend(self.data[i * 100:])
+            self.series.append(records)
+        self.vectorize = model.Records.vectorize
+
+    def tearDown(self):
+        model.Records.vectorize = self.vectorize
+        super(TestAggregate, self).tearDown()
+
+    def expected(self, reduce, interval, count=False, start=0, stop=-1):
+        bins = {}
+        for records in self.series:
+            for timestamp, value in records.query(start, stop, interval):
+                bins.setdefault(timestamp, []).append(value)
+        result = []
+        for timestamp in sorted(bins):
+            values = [v for v in bins[timestamp] if v is not None]
+            if values:
+                result.append((timestamp, reduce(values)))
+            elif count:
+                result.append((timestamp, 0))
+            else:
+                result.append((timestamp, None))
+        return result
+
+    def test_aggregate(self):
+        operators = {
+            "sum": sum,
+            "avg": lambda xs: sum(xs) / float(len(xs)),
+            "min": min,
+            "max": max,
+            "count": len,
+        }
+        for vectorize in (True, False):
+            model.Records.vectorize = vectorize
+            for name, reduce in operators.items():
+                for interval in (60, 3600):
+                    self.assertEqual(model.Records.aggregate(self.series, name,
+                        interval=interval), self.expected(reduce, interval,
+                        name == "count"))
+
+    def test_percentile(self):
+        data = model.Records.aggregate(self.series, "p50", interval=3600)
+        median = self.expected(lambda xs: sorted(xs)[len(xs) / 2], 3600)
+        self.assertEqual([t for t, v in data], [t for t, v in median])
+        model.Records.vectorize = False
+        for e, r in zip(model.Records.aggregate(self.series, "p90", interval=3600),
+                self.expected(lambda xs: model.percentile(xs, 90), 3600)):
+            self.assertEqual(e[0], r[0])
+            self.assertAlmostEqual(e[1], r[1])
+        self.assertEqual(model.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(model.percentile([5], 99.9), 5)
+
+    def test_align(self):
+        # The others would be read from the minute interval, but this one
+        # ended days ago and needs the daily interval.
+        start, stop = self.data[-100][0], self.data[-1][0]
+        old = model.Records("schedd4", "running_jobs", "last")
+        old.extend(self.data[:50])
+        self.assertEqual(model.Records.aggregate(self.series, "count", start,
+            stop), self.expected(len, 60, True, start, stop))
+        self.series.append(old)
+        data = model.Records.aggregate(self.series, "count", start, stop)
+        self.assertEqual(data, self.expected(len, 86400, True, start, stop))
+        self.assertEqual(len(data), 1)
+        self.assertEqual(model.Records.aggregate(self.series[:1], "sum", 0, -1,
+            interval=7), [])
+        self.assertEqual(model.Records.aggregate([], "sum"), [])
+
+    def test_invalid(self):
+        for name in ("median", "p101", "p", "px", "pnan"):
+            self.assertRaises(errors.RecordError, model.Records.aggregate,
+                self.series, name)
+        self.assertRaises(errors.RecordError, model.Records.aggregate,
+            [model.Records("foo", "bar", "sketch")], "sum")
+
+class TestMemoryAggregate(MemoryTest, TestAggregate):
+    pass
+
+class TestStitch(SeriesTest):
+    layout = "list"
+
+    def setUp(self):
+        super(TestStitch, self).setUp()
+        self.records = model.Records("foo", "bar", "ave")
+        self.records.layout = self.layout
+        self.records.extend(self.data)
+        self.start, self.stop = self.data[0][0], self.data[-1][0]
+
+    def segments(self, data):
+        return [(i, [(t, v) for t, v, _ in points])
+            for i, points in groupby(data, itemgetter(2))]
+
+    def test_stitch(self):
+        data = list(self.records.query(self.start, self.stop, stitch=True))
+        timestamps = [t for t, v, i in data]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+
+        (hourly, coarse), (minutely, fine) = self.segments(data)
+        self.assertEqual((hourly, minutely), (3600, 60))
+        self.assertEqual(fine, list(self.records.query(fine[0][0], self.stop,
+            interval=60)))
+        self.assertEqual(len(fine), 1441)
+        hours = list(self.records.query(self.start, self.stop, interval=3600))
+        self.assertEqual(coarse, hours[:len(coarse)])
+        self.assertTrue(coarse[-1][0] < fine[0][0] <= coarse[-1][0] + 7200)
+
+        # The default query falls back to the hourly interval.
+        self.assertEqual(list(self.records.query(self.start, self.stop)),
+            list(self.records.query(self.start, self.stop, interval=3600)))
+
+    def test_stitch_recent(self):
+        start = self.stop - 3600
+        self.assertEqual(list(self.records.query(start, self.stop, stitch="1")),
+            [(t, v, 60) for t, v in self.records.query(start, self.stop)])
+        self.assertEqual(list(model.Records("nosuch", "bar", "ave").query(
+            stitch=True)), [])
+        self.assertRaises(ValueError, self.records.query, stitch="maybe")
+
+    def test_resample(self):
+        start = self.stop - 7200
+        data = list(self.records.query(start, self.stop, step=600))
+        minutes = [(t, v) for t, v in self.records.query(start, self.stop,
+            interval=60) if v is not None]
+        expected = [(t, v) for t, v, i in self.records.consolidate(minutes, 600,
+            model.cma) if t >= model.nearest(start, 600)]
+        self.assertEqual(data, expected)
+        self.assertEqual(set(b[0] - a[0] for a, b in zip(data, data[1:])),
+            set([600]))
+
+    def test_resample_spread(self):
+        hours = list(self.records.query(self.start, self.stop, interval=3600))
+        data = list(self.records.query(self.start, self.stop, interval=3600,
+            step=600))
+        first = model.nearest(self.start, 600)
+        self.assertEqual([x for x in data if x[0] < hours[0][0] + 1800],
+            [(t, hours[0][1]) for t in range(first, hours[0][0] + 1800, 600)])
+
+        stitched = list(self.records.query(self.start, self.stop, stitch=True,
+            step=300))
+        timestamps = [t for t, v in stitched]
+        self.assertEqual(timestamps, range(timestamps[0], timestamps[-1] + 1, 300))
+        self.assertEqual(timestamps[-1], model.nearest(self.stop, 300))
+        for step in (0, -60, "x"):
+            self.assertRaises((TypeError, ValueError), self.records.query,
+                step=step)
+
+    def test_after_last(self):
+        self.assertEqual(list(self.records.query(self.stop + 600,
+            self.stop + 1200, interval=60)), [])
+
+class TestPackedStitch(TestStitch):
+    layout = "packed"
+
+class TestMemoryStitch(MemoryTest, TestStitch):
+    pass
+
+class TestIndexesScript(TestIndexes):
+    writer = "script"
+
+class TestMemoryIndexes(MemoryTest, TestIndexes):
+    pass
+
+class TestSweep(SeriesTest):
+
+    def setUp(self):
+        super(TestSweep, self).setUp()
+        self.data = [(self.first + (i * 21600), i % 17) for i in range(240)]
+        self.now = self.data[-1][0]
+        self.live = model.Records("live", "bar", "ave")
+        self.live.extend(self.data)
+        self.rate = model.Records("gone", "bar", "rate")
+        self.rate.extend(self.data[:20])
+        self.dead = [model.Records("gone%d" % i, "bar", "max") for i in range(5)]
+        for records in self.dead:
+            records.extend(self.data[:40])
+
+    def test_reap(self):
+        daily = list(self.live.query(0, -1, interval=86400))
+        result = maintenance.sweep(self.db, age=86400 * 30, count=2, now=self.now)
+        self.assertEqual(result["series"], 7)
+        self.assertEqual(result["reaped"], 6)
+        self.assertEqual(result["keys"],
+            5 * len(list(self.dead[0].keys())) + len(list(self.rate.keys())) + 1)
+        self.assertTrue(result["bytes"] > 0)
+        self.assertEqual(list(model.Records.all()), [self.live])
+        self.assertEqual(self.db.keys("records!gone*"), [])
+        self.assertEqual(list(self.live.query(0, -1, interval=86400)), daily)
+
+    def test_retention(self):
+        daily = list(self.live.query(0, -1, interval=86400))
+        result = maintenance.sweep(self.db, retention=86400 * 10, now=self.now)
+        self.assertEqual(result["reaped"], 0)
+        self.assertTrue(result["bytes"] > 0)
+        self.assertEqual(len(list(model.Records.all())), 7)
+        self.assertEqual(list(self.live.query(0, -1, interval=86400)), daily[-11:])
+
+    def test_moved_on(self):
+        # Series written (or queued) after they were found stale are kept.
+        cutoff = self.now - 86400 * 30
+        self.assertEqual(self.live.reap(cutoff), None)
+        self.dead[0].extend([(self.now, 1)])
+        self.assertEqual(self.dead[0].reap(cutoff), None)
+        self.dead[1].queue([(self.now, 1)])
+        self.assertEqual(self.dead[1].reap(cutoff), None)
+        self.assertTrue(self.dead[2].reap(cutoff))
+        self.assertEqual(len(list(model.Records.all())), 6)
+
+    def test_race(self):
+        # Values queued (without the lock) after the recheck aren't lost:
+        # Redis aborts the delete, and the memory engine holds the values
+        # back until the series is gone.
+        records, threads = self.dead[0], []
+        purge = records.purge
+        def queue(pipeline):
+            thread = threading.Thread(target=model.Records("gone0", "bar",
+                "max").queue, args=([(self.now, 1)],))
+            thread.start()
+            thread.join(.1)
+            threads.append(thread)
+            purge(pipeline)
+        records.purge = queue
+        values = records.reap(self.now)
+        threads[0].join()
+        self.assertEqual(self.db.llen(records.rawkey()), 1)
+        self.assertEqual(values is None,
+            records.member in self.db.smembers(model.Records.namespace))
+        if not isinstance(self.db, engines.Memory):
+            self.assertEqual(values, None)
+
+    def test_nothing(self):
+        self.assertEqual(maintenance.sweep(self.db, now=self.now),
+            {"series": 7, "reaped": 0, "keys": 0, "bytes": 0})
+
+class TestMemorySweep(MemoryTest, TestSweep):
+    pass
+
+class TestGroup(SeriesTest):
+    writer = "lock"
+
+    def setUp(self):
+        super(TestGroup, self).setUp()
+        self.group = model.series("foo", "bar", "min+max+ave")
+        self.group.writer = self.writer
+
+    def expected(self, data):
+        for cf in ("ave", "max", "min"):
+            records = model.Records("foo", "bar", cf)
+            records.writer = self.writer
+            records.extend(data)
+        return self.dump()
+
+    def test_series(self):
+        self.assertTrue(isinstance(self.group, model.Group))
+        self.assertEqual(self.group.cf, "ave+max+min")
+        self.assertEqual([r.cf for r in self.group.members], ["ave", "max", "min"])
+        self.assertFalse(isinstance(model.series("foo", "bar", "ave"), model.Group))
+
+    def test_duplicate(self):
+        self.assertRaises(errors.RecordError, model.series, "foo", "bar", "ave+ave")
+
+    def test_extend(self):
+        expected = self.expected(self.data)
+        self.group.extend(self.data)
+        self.assertEqual(self.dump(), expected)
+
+    def test_bulk(self):
+        expected = self.expected(self.data)
+        self.assertEqual(model.Records.bulk([(self.group, self.data)]), [])
+        self.assertEqual(self.dump(), expected)
+
+    def test_bulk_contended(self):
+        expected = self.expected(self.data)
+        # An expired lock on one member is taken over by extend().
+        self.db.set(self.group.members[1].subkey("lock"), 0)
+        self.assertEqual(model.Records.bulk([(self.group, self.data)]), [])
+        self.assertEqual(self.dump(), expected)
+
+    def test_drain(self):
+        expected = self.expected(self.data)
+        self.group.queue(self.data)
+        self.assertEqual(self.db.smembers(model.Records.pending),
+            set(["foo bar ave+max+min"]))
+        self.assertEqual(model.Records.backlog()["values"], len(self.data))
+        self.assertEqual(maintenance.work(self.db), len(self.data))
+        self.db.delete(model.Records.pending)
+        self.assertEqual(self.dump(), expected)
+
+    def test_delete(self):
+        self.group.extend(self.data[:10])
+        self.group.queue(self.data[10:20])
+        self.group.delete()
+        self.assertEqual(self.db.keys("*"), [])
+
+    def test_shared(self):
+        # The members fold the same bins, with or without NumPy (which
+        # gives up on None).
+        data = [(t, i % 5 and v or None) for i, (t, v) in enumerate(self.data)]
+        cfs = ("first", "last", "max", "min")
+        group = model.series("foo", "bar", "+".join(cfs))
+        group.writer = self.writer
+        default = model.Records.vectorize
+        try:
+            for vectorize in (True, False):
+                model.Records.vectorize = vectorize
+                for cf in cfs:
+                    records = model.Records("foo", "bar", cf)
+                    records.writer = self.writer
+                    for i in range(0, len(data), 150):
+                        records.extend(data[i:i + 150])
+                expected = self.dump()
+                for i in range(0, len(data), 150):
+                    group.extend(data[i:i + 150])
+                self.assertEqual(self.dump(), expected)
+        finally:
+            model.Records.vectorize = default
+
+    def test_folded(self):
+        records = self.group.members[0]
+        for interval, samples in records.intervals:
+            self.assertEqual(list(records.folded(records.bins(self.data, interval),
+                interval, model.cma)),
+                list(records.consolidate(self.data, interval, model.cma)))
+        self.assertRaises(errors.RecordError, records.bins,
+            list(reversed(self.data[:10])), 60)
+
+    def test_out_of_order(self):
+        self.assertRaises(errors.RecordError, self.group.extend,
+            list(reversed(self.data[:10])))
+
+    def test_atomic(self):
+        # A value one member rejects leaves every member untouched.
+        group = model.series("foo", "bar", "ave+min")
+        group.writer = self.writer
+        data = [(self.first, 5), (self.first + 1, None)]
+        self.assertRaises(TypeError, group.extend, data)
+        self.assertEqual(self.db.keys("*"), [])
+        rejected = model.Records.bulk([(group, data)])
+        self.assertEqual([(r, type(e)) for r, e in rejected], [(group, TypeError)])
+        self.assertEqual(self.db.keys("*"), [])
+
+    def test_dropped(self):
+        # Points dropped by a group are counted once, not once per member.
+        self.group.extend(self.data[10:])
+        self.group.extend(self.data[:5])
+        self.assertEqual(model.Records.dropped()["points"], 5)
+        self.assertEqual(model.Records.bulk([(self.group, self.data[:3])]), [])
+        self.assertEqual(model.Records.dropped()["points"], 8)
+        self.group.members[0].extend(self.data[:2])
+        self.assertEqual(model.Records.dropped()["points"], 10)
+
+class TestGroupScript(TestGroup):
+    writer = "script"
+
+    def test_bulk_contended(self):
+        # The script writer doesn't take locks.
+        pass
+
+class TestMemoryGroup(MemoryTest, TestGroup):
+    pass
+
+class TestSketchRecords(SeriesTest):
+
+    def setUp(self):
+        super(TestSketchRecords, self).setUp()
+        self.records = model.Records("foo", "bar", "sketch")
+
+    def test_extend(self):
+        self.records.extend(self.data)
+        expected = self.dump()
+        # Sketches merge exactly, so writing a day at a time is the same.
+        days = {}
+        for t, v in self.data:
+            days.setdefault(t // 86400, []).append((t, v))
+        for day in sorted(days):
+            self.records.extend(days[day])
+        self.assertEqual(self.dump(), expected)
+
+    def test_query(self):
+        self.records.extend(self.data)
+        bins = {}
+        for t, v in self.data:
+            bins.setdefault(model.nearest(t, 86400), []).append(v)
+        result = list(self.records.query(0, -1, interval=86400, q="0.1,0.9"))
+        self.assertEqual([t for t, v in result], sorted(bins))
+        for t, estimates in result:
+            values = sorted(bins[t])
+            for q, estimate in zip((0.1, 0.9), estimates):
+                expected = values[int(q * (len(values) - 1))]
+                self.assertTrue(abs(estimate - expected) <= 0.011 * abs(expected))
+
+        # The median is the default; a single quantile isn't wrapped in a list.
+        medians = list(self.records.query(0, -1, interval=86400))
+        self.assertEqual(medians,
+            list(self.records.query(0, -1, interval=86400, q=0.5)))
+        self.assertFalse(isinstance(medians[0][1], list))
+
+    def test_query_invalid(self):
+        self.assertRaises(ValueError, self.records.query, q="2")
+        self.assertRaises(ValueError, self.records.query, q="p99")
+        self.assertRaises(TypeError, model.Records("foo", "bar", "ave").query, q=0.5)
+
+    def test_sketches(self):
+        sketches = [(t, sketch.Sketch.of([v, -v, 0])) for t, v in self.data]
+        self.records.extend((t, str(s)) for t, s in sketches)
+        expected = self.dump()
+        self.records.extend(sketches)
+        self.assertEqual(self.dump(), expected)
+        self.assertRaises((TypeError, ValueError),
+            model.Records("foo", "bar", "ave").extend,
+            [(self.first, str(sketches[0][1]))])
+
+    def test_drain(self):
+        self.records.extend(self.data)
+        expected = self.dump()
+        self.records.queue(self.data)
+        self.assertEqual(self.records.drain(), len(self.data))
+        self.db.delete(model.Records.pending)
+        self.assertEqual(self.dump(), expected)
+
+    def test_group(self):
+        self.records.extend(self.data)
+        expected = self.dump()
+        group = model.series("foo", "bar", "sketch+max")
+        self.assertEqual(group.writer, "lock")
+        group.extend(self.data)
+        result = self.dump()
+        for key in expected:
+            if "!sketch" in key:
+                self.assertEqual(result[key], expected[key])
+
+    def test_layout(self):
+        layout, writer = model.Records.layout, model.Records.writer
+        model.Records.layout, model.Records.writer = "packed", "script"
+        try:
+            records = model.Records("foo", "bar", "sketch")
+            self.assertEqual((records.layout, records.writer), ("list", "lock"))
+        finally:
+            model.Records.layout, model.Records.writer = layout, writer
+        self.assertRaises(errors.RecordError, records.migrate, "packed")
+
+    def test_seal(self):
+        self.records.extend(self.data)
+        self.assertEqual(self.records.seal(0), 0)
+
+class TestRate(SeriesTest):
+
+    def setUp(self):
+        super(TestRate, self).setUp()
+        self.records = model.Records("foo", "bar", "rate")
+        self.counters, counter = [], 0
+        for i in range(1000):
+            timestamp = self.first + (60 * i)
+            self.counters.append((timestamp, counter))
+            counter += 60 * (i % 10)
+
+    def test_extend(self):
+        self.records.extend(self.counters)
+        result = list(self.records.query(0, -1, interval=60))
+        self.assertEqual(len(result), len(self.counters) - 1)
+        self.assertEqual([v for t, v in result[:12]],
+            [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 0, 1])
+        hourly = list(self.records.query(0, -1, interval=3600))
+        self.assertEqual(hourly[1], (self.first - self.first % 3600 + 3600, 4.5))
+
+    def test_batches(self):
+        self.records.extend(self.counters)
+        expected = list(self.records.query(0, -1, interval=60))
+        self.db.flushdb()
+        # The last counter is kept between batches.
+        for i in range(0, len(self.counters), 77):
+            self.records.extend(self.counters[i:i + 77])
+        self.assertEqual(list(self.records.query(0, -1, interval=60)), expected)
+
+    def test_first(self):
+        self.records.extend(self.counters[:1])
+        self.assertEqual(list(self.records.query(0, -1)), [])
+        self.records.extend(self.counters[1:2])
+        self.assertEqual(list(self.records.query(0, -1, interval=60)), [
+            (model.nearest(self.counters[1][0], 60), 0)])
+
+    def test_old(self):
+        self.records.extend(self.counters[:10])
+        self.records.extend(self.counters[:5] + [(self.counters[10][0], 10 ** 6)])
+        result = list(self.records.query(0, -1, interval=60))
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result[-1][1], round((10 ** 6 - self.counters[9][1]) / 60.0, 2))
+
+    def test_wrap(self):
+        t = self.first
+        for last, value, rate in [
+                (2 ** 32 - 100, 500, 10),
+                (2 ** 64 - 100, 500, 10),
+                (10 ** 6, 600, 10)]:
+            self.records.extend([(t, last), (t + 60, value)])
+            self.assertEqual(list(self.records.query(t, t + 60, interval=60))[-1][1],
+                rate)
+            t += 86400
+
+    def test_group(self):
+        self.records.extend(self.counters)
+        expected = self.dump()
+        group = model.series("foo", "bar", "max+rate")
+        self.assertEqual(group.writer, "lock")
+        group.extend(self.counters)
+        result = self.dump()
+        for key in expected:
+            if "!rate" in key:
+                self.assertEqual(result[key], expected[key])
+
+    def test_drain(self):
+        self.records.extend(self.counters)
+        expected = self.dump()
+        self.records.queue(self.counters)
+        self.assertEqual(self.records.drain(), len(self.counters))
+        self.db.delete(model.Records.pending)
+        self.assertEqual(self.dump(), expected)
+
+    def test_delete(self):
+        self.records.extend(self.counters[:10])
+        self.assertTrue(self.db.exists(self.records.counterkey()))
+        self.records.delete()
+        self.assertEqual(self.db.keys("*"), [])
+
+class TestLateness(SeriesTest):
+    layout = "list"
+
+    def setUp(self):
+        super(TestLateness, self).setUp()
+        model.Records.layout = self.layout
+        model.Records.lateness = 86400
+        self.records = model.Records("foo", "bar", "add")
+        self.points = [(self.first + 60 * i, i % 17) for i in range(3000)]
+
+    def tearDown(self):
+        super(TestLateness, self).tearDown()
+        model.Records.layout = "list"
+        model.Records.lateness = 0
+
+    def expected(self, data):
+        records = model.Records("expected", "bar", self.records.cf)
+        records.extend(data)
+        return [list(records.query(0, -1, interval=interval))
+            for interval, samples in records.intervals]
+
+    def result(self):
+        return [list(self.records.query(0, -1, interval=interval))
+            for interval, samples in self.records.intervals]
+
+    def test_late(self):
+        expected = self.expected(self.points)
+        late = set([1700, 1701, 2300, 2990])
+        self.records.extend([x for i, x in enumerate(self.points) if i not in late])
+        self.records.extend([self.points[i] for i in sorted(late)])
+        self.assertEqual(self.result(), expected)
+        self.assertEqual(model.Records.dropped(), {"window": 86400, "points": 0})
+
+    def test_last(self):
+        timestamp = model.nearest(self.first, 60) + 60
+        self.records.extend([(timestamp + 10, 1)])
+        self.records.extend([(timestamp - 10, 2), (timestamp + 70, 4)])
+        self.assertEqual(list(self.records.query(0, -1, interval=60)),
+            [(timestamp, 3), (timestamp + 60, 4)])
+
+    def test_dropped(self):
+        model.Records.lateness = 600
+        self.records.extend(self.points[10:])
+        expected = self.result()
+        self.records.extend(self.points[:10])
+        self.assertEqual(self.result(), expected)
+        self.assertEqual(model.Records.dropped(), {"window": 600, "points": 10})
+
+    def test_disabled(self):
+        model.Records.lateness = 0
+        self.records.extend(self.points[10:])
+        expected = self.result()
+        self.records.extend(self.points[:20])
+        self.assertEqual(self.result(), expected)
+        self.assertEqual(model.Records.dropped(), {"window": 0, "points": 20})
+
+    def test_group(self):
+        group = model.series("foo", "bar", "min+max")
+        late = set([1800, 2000])
+        group.extend([x for i, x in enumerate(self.points) if i not in late])
+        group.extend([self.points[i] for i in sorted(late)])
+        for records in group.members:
+            self.records = records
+            expected = model.Records("expected", "bar", records.cf)
+            expected.extend(self.points)
+            self.assertEqual(self.result(),
+                [list(expected.query(0, -1, interval=interval))
+                    for interval, samples in expected.intervals])
+
+class TestPackedLateness(TestLateness):
+    layout = "packed"
+
+class TestMemoryLateness(MemoryTest, TestLateness):
+    pass
+
+class TestShards(SeriesTest):
+
+    def setUp(self):
+        super(TestShards, self).setUp()
+        self.redis = model.db
+        self.dbs = [model.connect(db=i) for i in (12, 13, 14)]
+        for db in self.dbs:
+            db.flushdb()
+        self.names = ["redis://localhost/%d" % i for i in (12, 13, 14)]
+        model.db = model.engines.Shards(self.dbs[:2], self.names[:2])
+        self.series = [model.Records("subject%d" % i, "bar", "ave") for i in range(40)]
+
+    def tearDown(self):
+        super(TestShards, self).tearDown()
+        for db in self.dbs:
+            db.flushdb()
+        model.db = self.redis
+
+    def test_placement(self):
+        for records in self.series:
+            records.extend(self.data[:100])
+        for db in self.dbs[:2]:
+            members = db.smembers(model.Records.namespace)
+            self.assertTrue(len(members) > 5)
+            for member in members:
+                self.assertTrue(model.Records(*member.split()).db is db)
+        self.assertEqual(sorted(r.member for r in model.Records.all()),
+            sorted(r.member for r in self.series))
+
+    def test_bulk(self):
+        rejected = model.Records.bulk([(r, self.data) for r in self.series])
+        self.assertEqual(rejected, [])
+        expected = list(self.series[0].query(0, -1))
+        for records in self.series:
+            self.assertEqual(list(records.query(0, -1)), expected)
+
+    def test_queue(self):
+        for records in self.series:
+            records.queue(self.data[:10])
+        self.assertEqual(model.Records.backlog()["values"], 400)
+        recorded = 0
+        while True:
+            n = maintenance.work(model.db)
+            if n is None:
+                break
+            recorded += n
+        self.assertEqual(recorded, 400)
+        self.assertEqual(model.Records.backlog()["values"], 0)
+
+    def test_rebalance(self):
+        for records in self.series:
+            records.extend(self.data[:300])
+        expected = list(self.series[0].query(0, -1))
+
+        model.db = model.engines.Shards(self.dbs, self.names)
+        moved = 0
+        for source in self.dbs[:2]:
+            for records in model.Records.all(source):
+                if records.db is not source:
+                    self.assertTrue(records.move(source) > 0)
+                    moved += 1
+        self.assertTrue(0 < moved < 30)
+        self.assertEqual(len(self.dbs[2].smembers(model.Records.namespace)), moved)
+
+        for records in self.series:
+            records = model.Records(records.subject, records.attribute, records.cf)
+            self.assertEqual(list(records.query(0, -1)), expected)
+        total = sum(len(db.smembers(model.Records.namespace)) for db in self.dbs)
+        self.assertEqual(total, len(self.series))
+
+    def count(self, db):
+        """Record the MGETs and pipelines sent to *db*."""
+        calls = []
+        mget, pipeline = db.mget, db.pipeline
+        def counted(*args, **kwargs):
+            calls.append("mget")
+            return mget(*args, **kwargs)
+        def pipe(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            execute = pipe.execute
+            def run(*args, **kwargs):
+                calls.append("pipeline")
+                return execute(*args, **kwargs)
+            pipe.execute = run
+            return pipe
+        db.mget, db.pipeline = counted, pipe
+        return calls
+
+    def test_fetch(self):
+        for records in self.series:
+            records.extend(self.data[:300])
+        queries = [(r, {"start": self.data[100][0], "stop": self.data[200][0]})
+            for r in self.series]
+        expected = [list(r.query(**query)) for r, query in queries]
+        self.assertTrue(expected[0])
+        calls = [self.count(db) for db in self.dbs[:2]]
+        self.assertEqual(model.Records.fetch(queries), expected)
+        self.assertEqual(calls, [["mget", "pipeline"]] * 2)
+
+    def test_rename(self):
+        old, new = self.series[:2]
+        if old.db is new.db:
+            new = [r for r in self.series if r.db is not old.db][0]
+        self.assertRaises(errors.RecordError, old.rename, new)
+
+class TestMemoryShards(TestShards):
+
+    def setUp(self):
+        super(TestMemoryShards, self).setUp()
+        self.dbs = [model.connect("memory") for i in range(3)]
+        model.db = model.engines.Shards(self.dbs[:2], self.names[:2])
+        self.series = [model.Records("subject%d" % i, "bar", "ave") for i in range(40)]
+        model.Records.layout = "packed"
+
+    def tearDown(self):
+        super(TestMemoryShards, self).tearDown()
+        model.Records.layout = "list"
+
+class TestReplicas(SeriesTest):
+
+    def setUp(self):
+        super(TestReplicas, self).setUp()
+        self.redis = model.db
+        self.replica = model.connect("memory")
+        model.db = model.engines.Replicated(model.connect("memory"), [self.replica])
+        self.records = model.Records("foo", "bar", "ave")
+
+    def tearDown(self):
+        super(TestReplicas, self).tearDown()
+        model.db = self.redis
+
+    def test_query(self):
+        self.records.extend(self.data)
+        expected = list(self.records.query(0, -1, staleness=0))
+        self.assertTrue(expected)
+        self.assertEqual(list(self.records.query(0, -1)), [])
+
+        # Replicate.
+        self.replica.data.update(model.db.primary.data)
+        self.assertEqual(list(self.records.query(0, -1)), expected)
+        self.assertEqual(list(self.records.query(0, -1, interval=60)),
+            list(self.records.query(0, -1, interval=60, staleness="0")))
+
+    def test_failover(self):
+        self.records.extend(self.data)
+        expected = list(self.records.query(0, -1, staleness=0))
+        self.replica.set(self.records.subkey(60, "last"), "garbage")
+        self.assertEqual(list(self.records.query(0, -1)), expected)
+        self.assertEqual(model.db.status[0][1], None)
+
+    def test_fetch(self):
+        self.records.extend(self.data)
+        other = model.Records("spam", "bar", "ave")
+        other.extend(self.data[:100])
+        queries = [(self.records, {}), (other, {"staleness": "0"})]
+        expected = [list(r.query(staleness=0)) for r in (self.records, other)]
+        self.assertEqual(model.Records.fetch(queries), [[], expected[1]])
+
+        self.replica.data.update(model.db.primary.data)
+        self.assertEqual(model.Records.fetch(queries), expected)
+        self.replica.set(self.records.subkey(60, "last"), "garbage")
+        model.db.status[0] = (time.time(), 0)
+        self.assertEqual(model.Records.fetch(queries), expected)
+        self.assertEqual(model.db.status[0][1], None)
@@ -0,0 +1,110 @@
+import random
+
+from math import cos
+
+from tsar import errors, model, numeric, util
+
+from tests import BaseTest, log, unittest
+
+@unittest.skipIf(numeric.numpy is None, "NumPy is not installed")
+class TestNumeric(BaseTest):
+    first = 1278007837
+
+    def setUp(self):
+        self.records = model.Records("foo", "bar", "last")
+        self.random = random.Random(42)
+
+    def generate(self, n, floats=True, gaps=True):
+        data, t = [], self.first
+        for i in range(n):
+            t += self.random.choice([1, 7, 20, 59] + (gaps and [600] or []))
+            value = int(100 * cos(i))
+            if floats and self.random.random() < 0.5:
+                value = round(100 * cos(i), 2)
+            data.append((t, value))
+        return data
+
+    def assertSame(self, data, interval, cf):
+        expected = list(self.records.consolidate(data, interval,
+            self.records.cfs[cf]))
+        result = numeric.consolidate(data, interval, cf)
+        self.assertEqual(len(result), len(expected))
+        for e, r in zip(expected, result):
+            self.assertEqual(e, r)
+            self.assertEqual(type(e[1]), type(r[1]))
+            self.assertEqual(repr(e[1]), repr(r[1]))
+
+    def test_cfs(self):
+        for floats in (True, False):
+            data = self.generate(2000, floats=floats)
+            for cf in numeric.cfs:
+                for interval in (60, 3600, 86400):
+                    self.assertSame(data, interval, cf)
+
+    def test_contiguous(self):
+        data = self.generate(500, gaps=False)
+        for cf in numeric.cfs:
+            self.assertSame(data, 60, cf)
+
+    def test_ties(self):
+        data = [(self.first, 1), (self.first + 1, 1.0), (self.first + 2, 1)]
+        for cf in ("min", "max"):
+            self.assertSame(data, 60, cf)
+
+    def test_empty(self):
+        self.assertEqual(numeric.consolidate([], 60, "ave"), [])
+
+    def test_unsupported(self):
+        self.assertEqual(numeric.consolidate(self.generate(10), 60, "sketch"), None)
+
+    def test_fallback(self):
+        data = [(self.first, 1), (self.first + 1, None)]
+        self.assertEqual(numeric.consolidate(data, 60, "min"), None)
+        data = [(self.first, 2 ** 60), (self.first + 1, 1)]
+        self.assertEqual(numeric.consolidate(data, 60, "add"), None)
+
+    def test_order(self):
+        data = [(self.first + 3600, 1), (self.first, 2)]
+        self.assertRaises(errors.RecordError, numeric.consolidate, data, 60, "last")
+
+    def test_aggregate(self):
+        data = [self.generate(50, gaps=False) for i in range(4)]
+        data = [[(t - t % 60, v) for t, v in d] for d in data]
+        data = [[(t, v) for t, v in dict(d).items()] for d in data]
+        for d in data:
+            d.sort()
+            d[3] = (d[3][0], None)
+        for name, reduce in model.Records.aggregates.items():
+            expected = list(model.combine(data, reduce, name == "count"))
+            result = numeric.aggregate(data, name)
+            self.assertEqual(result, expected)
+            self.assertEqual([type(x[1]) for x in result],
+                [type(x[1]) for x in expected])
+        for name in ("p0", "p50", "p99.9"):
+            expected = model.combine(data, model.Records.aggregator(name))
+            for e, r in zip(expected, numeric.aggregate(data, name)):
+                self.assertEqual(e[0], r[0])
+                self.assertAlmostEqual(e[1], r[1])
+
+    def test_aggregate_fallback(self):
+        self.assertEqual(numeric.aggregate([], "sum"), [])
+        self.assertEqual(numeric.aggregate([[(60, None)]], "max"), [(60, None)])
+        self.assertEqual(numeric.aggregate([[(60, [1, 2])]], "sum"), None)
+        self.assertEqual(numeric.aggregate([[(60, 2 ** 60)], [(60, 1)]], "sum"), None)
+
+    def test_lttb(self):
+        data = [(t, v) for t, v in self.generate(20000, floats=False)]
+        data[10] = (data[10][0], None)
+        for points in (3, 100, 1000):
+            self.assertEqual(numeric.lttb(data, points), util.lttb(data, points))
+        self.assertEqual(numeric.lttb(data[:100], 10), None)
+        self.assertEqual(numeric.lttb([(i, [1, 2]) for i in range(100)], 2), None)
+
+    def test_record(self):
+        data = self.generate(1000)
+        for cf, cfunc in self.records.cfs.items():
+            records = model.Records("vectorized", "bar", cf)
+            lasts = [None] * len(records.intervals)
+            self.assertEqual(records.update(data, lasts),
+                [list(records.consolidate(data, interval, cfunc))
+                    for interval, samples in records.intervals])
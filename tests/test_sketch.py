@@ -0,0 +1,79 @@
+import random
+
+from tsar import sketch
+
+from tests import BaseTest, log, unittest
+
+class TestSketch(BaseTest):
+
+    def setUp(self):
+        self.random = random.Random(42)
+        self.values = [self.random.lognormvariate(3, 1) for i in range(10000)]
+
+    def assertAccurate(self, result, values, quantiles=(0.01, 0.5, 0.9, 0.99)):
+        values = sorted(values)
+        for q in quantiles:
+            expected = values[int(q * (len(values) - 1))]
+            estimate = result.quantile(q)
+            self.assertTrue(abs(estimate - expected) <= 0.011 * abs(expected),
+                "q=%r: %r != %r" % (q, estimate, expected))
+
+    def test_quantile(self):
+        result = sketch.Sketch.of(self.values)
+        self.assertAccurate(result, self.values)
+        self.assertEqual(result.quantile(0), min(self.values))
+        self.assertEqual(result.quantile(1), max(self.values))
+
+    def test_signs(self):
+        values = [self.random.gauss(0, 100) for i in range(5000)] + [0] * 100
+        self.assertAccurate(sketch.Sketch.of(values), values,
+            quantiles=(0.1, 0.25, 0.75, 0.9))
+        self.assertEqual(sketch.Sketch.of([0, 0, 0]).quantile(0.5), 0)
+
+    def test_merge(self):
+        parts = [sketch.Sketch.of(self.values[i:i + 100])
+            for i in range(0, len(self.values), 100)]
+        merged = sketch.Sketch()
+        for part in parts:
+            merged.merge(part)
+        self.assertEqual(merged, sketch.Sketch.of(self.values))
+        self.assertEqual(merged.count, len(self.values))
+
+    def test_bounded(self):
+        values = [10 ** (i / 100.0) for i in range(-1000, 1000)]
+        result = sketch.Sketch.of(values)
+        self.assertEqual(len(result.positive), sketch.Sketch.maxbins)
+        self.assertAccurate(result, values, quantiles=(0.9, 0.99))
+
+    def test_encode(self):
+        values = self.values[:500] + [0, -1.5, -20]
+        result = sketch.Sketch.of(values)
+        encoded = sketch.encode(result)
+        self.assertTrue(encoded.startswith(sketch.Sketch.prefix))
+        self.assertFalse(" " in encoded)
+        self.assertEqual(repr(result), encoded)
+        decoded = sketch.decode(encoded)
+        self.assertEqual(decoded.count, len(values))
+        self.assertEqual(sketch.encode(decoded), encoded)
+        self.assertEqual(sketch.decode(sketch.encode(sketch.Sketch())).count, 0)
+
+    def test_decode_invalid(self):
+        self.assertRaises(ValueError, sketch.decode, "10")
+        self.assertRaises(ValueError, sketch.decode, "dd:1:2")
+        self.assertRaises(ValueError, sketch.decode, "dd:1:2:0:1y2:")
+
+    def test_cf(self):
+        original = sketch.Sketch.of([1, 2])
+        i, result = sketch.merge(original, 3, 0)
+        self.assertEqual(original.count, 2)
+        self.assertEqual(result.count, 3)
+        i, again = sketch.merge(result, original, 1)
+        self.assertTrue(again is result)
+        self.assertEqual(result.count, 5)
+        self.assertEqual(sketch.merge(None, None, 0), (0, None))
+        self.assertEqual(sketch.merge(5, None, 0)[1].count, 1)
+
+    def test_quantile_values(self):
+        self.assertEqual(sketch.quantile(None, 0.5), None)
+        self.assertEqual(sketch.quantile(10, 0.99), 10)
+        self.assertEqual(sketch.quantile(sketch.Sketch(), 0.5), None)
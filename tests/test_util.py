@@ -22,3 +22,58 @@ class TestFilters(BaseTest):
         # Because self.data[2] has None as a neighbor
         self.assertEqual(data[0][0], self.data[3][0])
         self.assertEqual(len(self.data) - len(data), 5)
+
+    def test_lttb(self):
+        data = util.lttb(self.data, 100)
+        self.assertEqual(len(data), 100)
+        values = [x for x in self.data if x[1] is not None]
+        self.assertEqual((data[0], data[-1]), (values[0], values[-1]))
+        self.assertTrue(all(x in values for x in data))
+        self.assertEqual(data, sorted(data))
+        self.assertEqual(util.lttb(self.data, 2), [values[0], values[-1]])
+        self.assertEqual(util.lttb(self.data, 5000), values)
+
+    def test_lttb_spike(self):
+        data = [(i, 0) for i in range(100)]
+        data[57] = (57, 1000)
+        self.assertTrue((57, 1000) in util.lttb(data, 10))
+
+    def test_minmax(self):
+        data = util.minmax(self.data, 100)
+        self.assertTrue(len(data) <= 100)
+        values = [x for x in self.data if x[1] is not None]
+        self.assertEqual(data, sorted(data))
+        self.assertEqual(max(v for t, v in data), max(v for t, v in values))
+        self.assertEqual(min(v for t, v in data), min(v for t, v in values))
+        self.assertEqual(util.minmax([(0, 1), (1, 3), (2, 1), (3, 3)], 2),
+            [(0, 1), (1, 3)])
+        self.assertEqual(util.minmax([(0, 1), (1, 1), (2, 1)], 2), [(0, 1)])
+        self.assertEqual(util.minmax(self.data, 1), values[:1])
+
+class TestParseSchema(BaseTest):
+
+    def test_parse(self):
+        self.assertEqual(util.parseschema("proc/*=10:360,60:1440"),
+            ("proc/*", [(10, 360), (60, 1440)]))
+        self.assertEqual(util.parseschema("a=b=3600:24"), ("a=b", [(3600, 24)]))
+
+    def test_invalid(self):
+        for schema in ("10:360", "x=60:10,10:360", "x=0:10", "x=60", "x=a:b"):
+            self.assertRaises(ValueError, util.parseschema, schema)
+
+class TestLiteral(BaseTest):
+
+    def test_literal(self):
+        self.assertEqual(util.literal("records!foo!.*"), "records!foo!")
+        self.assertEqual(util.literal("records!fo[ab]"), "records!fo")
+        self.assertEqual(util.literal("records!foo*"), "records!fo")
+        self.assertEqual(util.literal("records\\!x|y"), "")
+        self.assertEqual(util.literal("(?i)records"), "")
+        self.assertEqual(util.literal(".*"), "")
+
+    def test_wildcard(self):
+        self.assertTrue(util.wildcard("prod_*"))
+        self.assertTrue(util.wildcard("host?"))
+        self.assertTrue(util.wildcard("host[12]"))
+        self.assertFalse(util.wildcard("host1"))
+
@@ -1,10 +1,13 @@
 import csv
+import sys
 
-from itertools import chain
+from itertools import chain, groupby
 from math import cos
+from operator import itemgetter
 
-from tsar import model
-from tsar.web import AllRecords, Records
+from tsar import maintenance, model
+from tsar.tsar import Tsar
+from tsar.web import AllRecords, Metrics, Records, Serve
 from tsar.util import json
 
 from tests import AppTest, BaseTest, log, unittest
@@ -122,6 +125,175 @@ class TestAllRecordsGet(RecordsTest):
         self.assertTrue("foo/bar/last" in body)
         self.assertTrue("spam/eggs/last" in body)
 
+    def test_get_planned(self):
+        for i in range(40):
+            model.Records("host%d" % i, "load", "last").extend(self.data[:20])
+        calls = []
+        mget, pipeline = self.db.mget, self.db.pipeline
+        def counted(*args):
+            calls.append("mget")
+            return mget(*args)
+        def pipe(*args, **kwargs):
+            calls.append("pipeline")
+            return pipeline(*args, **kwargs)
+        self.db.mget, self.db.pipeline = counted, pipe
+        try:
+            response = self.get("/records?" + "&".join(
+                "subject=host%d&attribute=load&cf=last&interval=60" % i
+                for i in range(40)) + "&filters=skipnull",
+                accept="application/json")
+        finally:
+            del self.db.mget, self.db.pipeline
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(calls, ["mget", "pipeline"])
+        body = json.loads(response.body)
+        self.assertEqual(len(body), 40)
+        expected = [list(x) for x in model.Records("host0", "load", "last").query(
+            interval=60) if x[1] is not None]
+        self.assertTrue(expected)
+        for i in range(40):
+            self.assertEqual(body["host%d/load/last" % i], expected)
+
+    def test_get_wildcard(self):
+        model.Records("food", "bar", "last").extend(self.data[:10])
+        response = self.get("/records?subject=foo*&attribute=b?r&cf=last"
+            "&start=0&stop=-1&subject=spam&attribute=eggs&cf=last",
+            accept="application/json")
+        self.assertEqual(response.status_int, 200)
+        body = json.loads(response.body)
+        self.assertEqual(sorted(body), ["foo/bar/last", "food/bar/last", "spam/eggs/last"])
+        expected = model.Records("food", "bar", "last").query(0, -1)
+        self.assertEqual(body["food/bar/last"], [list(x) for x in expected])
+        self.assertEqual(body["foo/bar/last"], body["spam/eggs/last"])
+
+        response = self.get("/records?subject=*&attribute=eggs&cf=*"
+            "&filters=skipnull", accept="application/json")
+        self.assertEqual(sorted(json.loads(response.body)), ["spam/eggs/last"])
+        response = self.get("/records?subject=nosuch*&attribute=bar&cf=last",
+            accept="application/json")
+        self.assertEqual(json.loads(response.body), {})
+
+    def test_get_aggregate(self):
+        model.Records("food", "bar", "last").extend(self.data[:10])
+        response = self.get("/records?subject=foo*&attribute=bar&cf=last"
+            "&aggregate=sum&interval=3600&subject=fo*&attribute=bar&cf=last"
+            "&aggregate=count&interval=3600", accept="application/json")
+        self.assertEqual(response.status_int, 200)
+        body = json.loads(response.body)
+        self.assertEqual(sorted(body), ["fo%2A/bar/count%28last%29",
+            "foo%2A/bar/sum%28last%29"])
+        counts = body["fo%2A/bar/count%28last%29"]
+        self.assertEqual(counts[0][1], 2)
+        self.assertEqual(counts[-1][1], 1)
+        expected = model.Records.aggregate(model.Records.glob("foo*", "bar", "last"),
+            "sum", interval=3600)
+        self.assertEqual(body["foo%2A/bar/sum%28last%29"], [list(x) for x in expected])
+
+        response = self.get("/records?subject=foo*&attribute=bar&cf=last"
+            "&aggregate=median", accept="application/json")
+        self.assertEqual(response.status_int, 400)
+
+        self.application = Records()
+        response = self.get("/records/spam/eggs/last?aggregate=max",
+            accept="text/csv")
+        self.assertEqual(response.status_int, 200)
+        rows = list(csv.reader(response.body.splitlines()))
+        self.assertEqual(rows[1][:3], ["spam", "eggs", "max(last)"])
+        self.assertEqual(len(rows) - 1, len(list(
+            model.Records("spam", "eggs", "last").query(0, -1))))
+
+    def test_get_maxpoints(self):
+        query = "/records?subject=foo&attribute=bar&cf=last&interval=60"
+        full = json.loads(self.get(query, accept="application/json").body)
+        self.assertEqual(len(full["foo/bar/last"]), 1441)
+        for method in ("lttb", "minmax"):
+            response = self.get(query + "&maxpoints=100&downsample=" + method,
+                accept="application/json")
+            self.assertEqual(response.status_int, 200)
+            data = json.loads(response.body)["foo/bar/last"]
+            self.assertTrue(0 < len(data) <= 100)
+            self.assertTrue(all(x in full["foo/bar/last"] for x in data))
+        response = self.get(query + "&maxpoints=100", accept="application/json")
+        data = json.loads(response.body)["foo/bar/last"]
+        self.assertEqual(len(data), 100)
+
+        # Gaps survive downsampling, and short series are left alone.
+        self.assertTrue(None in [v for t, v in full["foo/bar/last"]])
+        self.assertTrue(None in [v for t, v in data])
+        self.assertEqual(data, sorted(data))
+        response = self.get(query + "&maxpoints=1441", accept="application/json")
+        self.assertEqual(json.loads(response.body), full)
+
+        for params in ("&maxpoints=1", "&maxpoints=x", "&maxpoints=10&downsample=x"):
+            response = self.get(query + params, accept="application/json")
+            self.assertEqual(response.status_int, 400)
+
+        model.Records("foo", "bar", "sketch").extend(self.data)
+        response = self.get("/records?subject=foo&attribute=bar&cf=sketch"
+            "&interval=60&q=0,1&maxpoints=10", accept="application/json")
+        self.assertEqual(response.status_int, 400)
+
+    def test_get_stitch(self):
+        query = "/records?subject=foo&attribute=bar&cf=last"
+        response = self.get(query + "&stitch=1", accept="application/json")
+        self.assertEqual(response.status_int, 200)
+        data = json.loads(response.body)["foo/bar/last"]
+        self.assertEqual(sorted(set(i for t, v, i in data)), [60, 3600])
+        timestamps = [t for t, v, i in data]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+        minutes = [[t, v] for t, v, i in data if i == 60]
+        self.assertEqual(minutes, [list(x) for x in model.Records("foo", "bar",
+            "last").query(minutes[0][0], -1, interval=60)])
+
+        response = self.get(query + "&stitch=1&filters=skipnull",
+            accept="application/json")
+        filtered = json.loads(response.body)["foo/bar/last"]
+        self.assertEqual(filtered, [x for x in data if x[1] is not None])
+
+        # Filters run once per segment, so derive isn't applied twice.
+        response = self.get(query + "&stitch=1&filters=derive",
+            accept="application/json")
+        derived = json.loads(response.body)["foo/bar/last"]
+        expected = []
+        for interval, segment in groupby(data, itemgetter(2)):
+            points = self.application.filters["derive"](
+                [(t, v) for t, v, i in segment])
+            expected.extend([t, v, interval] for t, v in points)
+        self.assertEqual(derived, expected)
+
+        response = self.get(query + "&stitch=1&filters=derive&maxpoints=10",
+            accept="application/json")
+        downsampled = json.loads(response.body)["foo/bar/last"]
+        self.assertEqual(len(downsampled), 10)
+        self.assertTrue(all(x in derived for x in downsampled))
+
+        response = self.get(query + "&stitch=1&step=900", accept="application/json")
+        data = json.loads(response.body)["foo/bar/last"]
+        self.assertEqual(set(b[0] - a[0] for a, b in zip(data, data[1:])),
+            set([900]))
+
+        for params in ("&step=0", "&step=x", "&stitch=maybe"):
+            response = self.get(query + params, accept="application/json")
+            self.assertEqual(response.status_int, 400)
+
+        self.application = Records()
+        response = self.get("/records/foo/bar/last?stitch=1", accept="text/csv")
+        self.assertEqual(response.status_int, 200)
+        rows = list(csv.reader(response.body.splitlines()))
+        self.assertEqual(set(len(row) for row in rows), set([5]))
+
+    def test_get_wildcard_limit(self):
+        maxmatches, model.Records.maxmatches = model.Records.maxmatches, 1
+        try:
+            response = self.get("/records?subject=*&attribute=*&cf=last",
+                accept="application/json")
+            self.assertEqual(response.status_int, 400)
+            response = self.get("/records?subject=f*&attribute=*&cf=last",
+                accept="application/json")
+            self.assertEqual(response.status_int, 200)
+        finally:
+            model.Records.maxmatches = maxmatches
+
 class TestRecordsPost(RecordsTest):
 
     def test_post(self):
@@ -208,6 +380,21 @@ class TestRecordsGet(RecordsTest):
             [[1278028800, -69], [1278115200, -94], 
             [1278201600, -64], [1278288000, 99]])
 
+    def test_get_params_staleness(self):
+        replica = model.connect("memory")
+        db, model.db = model.db, model.engines.Replicated(model.db, [replica])
+        try:
+            response = self.get("/records/fullfoo/bar/last", accept="application/json")
+            self.assertEqual(json.loads(response.body)["fullfoo/bar/last"], [])
+            response = self.get("/records/fullfoo/bar/last?staleness=0",
+                accept="application/json")
+            self.assertEqual(len(json.loads(response.body)["fullfoo/bar/last"]), 4)
+            response = self.get("/records/fullfoo/bar/last?staleness=x",
+                accept="application/json")
+            self.assertEqual(response.status_int, 400)
+        finally:
+            model.db = db
+
     def test_get_params_now(self):
         start, now = 2 * -86400, 1278201600
         response = self.get("/records/fullfoo/bar/last?start=%d&now=%d" % (start, now),
@@ -229,6 +416,26 @@ class TestRecordsGet(RecordsTest):
         body = json.loads(response.body)
         self.assertEqual(len(body["fullfoo/bar/last"]), 25)
 
+    def test_get_quantiles(self):
+        model.Records("sketchfoo", "bar", "sketch").extend(self.data)
+        response = self.get("/records/sketchfoo/bar/sketch?interval=86400&q=0,1",
+            accept="application/json")
+        self.assertEqual(response.status_int, 200)
+        data = json.loads(response.body)["sketchfoo/bar/sketch"]
+        day = [v for t, v in self.data if model.nearest(t, 86400) == data[0][0]]
+        self.assertEqual(data[0][1], [min(day), max(day)])
+
+        response = self.get("/records/sketchfoo/bar/sketch?q=1.5",
+            accept="application/json")
+        self.assertEqual(response.status_int, 400)
+        response = self.get("/records/fullfoo/bar/last?q=0.5",
+            accept="application/json")
+        self.assertEqual(response.status_int, 400)
+
+        response = self.get("/records/sketch*/bar/*?interval=86400&q=0,1",
+            accept="application/json")
+        self.assertEqual(json.loads(response.body)["sketchfoo/bar/sketch"], data)
+
     def test_get_jsonp(self):
         response = self.get("/records/fullfoo/bar/last?callback=foo", 
             accept="application/json")
@@ -265,3 +472,129 @@ class TestRecordsGet(RecordsTest):
         values = [x[1] for x in data]
         self.assertTrue(None not in values)
         self.assertEqual(len(data), 277)
+
+class TestAllRecordsPost(RecordsTest):
+    cls = AllRecords
+
+    def test_post_partial(self):
+        data = {
+            "foo/bar/last": self.data,
+            "spam/eggs/last": [(self.first, "ten")],
+            "ham/eggs/last": list(reversed(self.data)),
+        }
+        response = self.post("/records", content_type="application/json",
+            body=json.dumps(data))
+        self.assertEqual(response.status_int, 400)
+        self.assertTrue("Rejected 2 series" in response.body)
+        self.assertTrue("spam/eggs/last" in response.body)
+        self.assertTrue("ham/eggs/last" in response.body)
+        self.assertEqual(self.db.smembers("records"), set(["foo bar last"]))
+
+    def test_post_conflict(self):
+        data = {
+            "foo/bar/last": self.data,
+            "ham/eggs/last": list(reversed(self.data)),
+        }
+        response = self.post("/records", content_type="application/json",
+            body=json.dumps(data))
+        self.assertEqual(response.status_int, 409)
+        self.assertTrue("ham/eggs/last" in response.body)
+
+class TestAllRecordsQueue(RecordsTest):
+    cls = AllRecords
+
+    def setUp(self):
+        super(TestAllRecordsQueue, self).setUp()
+        self.application.queue = True
+
+    def test_post(self):
+        data = {
+            "foo/bar/last": self.data,
+            "spam/eggs/last": [(self.first, "ten")],
+        }
+        response = self.post("/records", content_type="application/json",
+            body=json.dumps(data))
+        self.assertEqual(response.status_int, 400)
+        self.assertTrue("spam/eggs/last" in response.body)
+        self.assertEqual(self.db.smembers("records"), set())
+
+        response = self.post("/records", content_type="application/json",
+            body=json.dumps({"spam/eggs/ave": [(self.first, 5),
+                (self.first + 63, None)]}))
+        self.assertEqual(response.status_int, 400)
+
+        del(data["spam/eggs/last"])
+        response = self.post("/records", content_type="application/json",
+            body=json.dumps(data))
+        self.assertEqual(response.status_int, 202)
+
+        self.application = Metrics()
+        response = self.get("/_metrics", accept="application/json")
+        metrics = json.loads(response.body)
+        self.assertEqual(metrics["queue"]["series"], 1)
+        self.assertEqual(metrics["queue"]["values"], 2 * len(self.data))
+        self.assertEqual(metrics["quarantine"], {"series": 0, "values": 0})
+        self.assertEqual(metrics["pool"]["inuse"], 0)
+        self.assertTrue(metrics["pool"]["checkouts"] > 0)
+
+        self.assertEqual(maintenance.work(self.db), 2 * len(self.data))
+        self.assertEqual(maintenance.work(self.db), None)
+        self.assertEqual(self.db.smembers("records"), set(["foo bar last"]))
+
+        records = model.Records("foo", "bar", "last")
+        expected = model.Records("direct", "bar", "last")
+        expected.extend(self.data)
+        self.assertEqual(list(records.query(self.first, self.last)),
+            list(expected.query(self.first, self.last)))
+
+class TestServe(BaseTest):
+    settings = "writer layout lateness schemas maxmatches".split()
+
+    def setUp(self):
+        super(TestServe, self).setUp()
+        self.db = model.db
+        self.saved = dict((k, getattr(model.Records, k)) for k in self.settings)
+
+    def tearDown(self):
+        super(TestServe, self).tearDown()
+        model.db = self.db
+        for k, v in self.saved.items():
+            setattr(model.Records, k, v)
+
+    def serve(self, *args):
+        # The subcommand's parser reports errors to sys.stderr.
+        stderr, sys.stderr = sys.stderr, csv.StringIO()
+        self.stderr = sys.stderr
+        try:
+            tsar = Tsar(commands={"serve": Serve}, argv=["tsar", "serve",
+                "-D", "redis://localhost:6379/15"] + list(args))
+            tsar.pre_run()
+            serve = tsar.commands["serve"]
+            serve.params = tsar.params
+            serve.pre_run()
+        finally:
+            sys.stderr = stderr
+        return serve
+
+    def test_max_matches(self):
+        self.serve()
+        self.assertEqual(model.Records.maxmatches, self.saved["maxmatches"])
+        self.serve("--max-matches", "5")
+        self.assertEqual(model.Records.maxmatches, 5)
+        self.assertRaises(SystemExit, self.serve, "-M", "0")
+
+    def test_script_engines(self):
+        self.serve("-W", "script")
+        self.assertEqual(model.Records.writer, "script")
+        self.assertRaises(SystemExit, self.serve, "-W", "script", "-L", "list",
+            "-D", "memory://,redis://localhost:6379/15")
+        self.assertTrue("the memory engine doesn't support the script writer"
+            in self.stderr.getvalue())
+
+    def test_script_lateness(self):
+        self.serve("--lateness", "600")
+        self.assertEqual(model.Records.lateness, 600)
+        self.assertRaises(SystemExit, self.serve, "-W", "script",
+            "--lateness", "600")
+        self.assertTrue("the script writer doesn't support a lateness window"
+            in self.stderr.getvalue())